@@ -0,0 +1,101 @@
+# ------------ ADAPTIVE TRIAL COUNTS ------------
+# ----------------------------------------------
+# Online estimate of each condition's report error (reported angle minus
+# the angle at the press, on the circle) and a stopping rule that ends a
+# condition once the confidence interval of its circular mean is narrow
+# enough. Everything is kept as running sums, an update costs a handful of
+# float operations and runs after the report, never during the rotation.
+from math import asin, atan2, cos, degrees, log, radians, sin, sqrt
+from statistics import NormalDist
+
+
+# Signed difference a - b on the circle, in degrees in [-180, 180)
+def circularDifference(a, b):
+    return (a - b + 180) % 360 - 180
+
+
+class CircularEstimator(object):
+    # Running circular mean of angles (degrees) with a large-sample confidence
+    # interval (Fisher 1993, 4.4.4): the standard error of the mean direction is
+    # sqrt((1 - rho2) / (2 n R^2)), R the mean resultant length and rho2 the
+    # mean of cos(2 (angle - mean)).
+    def __init__(self):
+        self.n = 0
+        self._c = self._s = self._c2 = self._s2 = 0.0
+
+    def add(self, angleDeg):
+        angle = radians(angleDeg)
+        self.n += 1
+        self._c += cos(angle)
+        self._s += sin(angle)
+        self._c2 += cos(2 * angle)
+        self._s2 += sin(2 * angle)
+
+    # Circular mean in degrees, [-180, 180)
+    def mean(self):
+        return circularDifference(degrees(atan2(self._s, self._c)), 0)
+
+    # Mean resultant length, 1 = all angles identical, 0 = uniform
+    def resultantLength(self):
+        if not self.n:
+            return 0.0
+        return sqrt(self._c ** 2 + self._s ** 2) / self.n
+
+    # Circular standard deviation in degrees
+    def std(self):
+        R = self.resultantLength()
+        if R <= 0:
+            return float("inf")
+        return degrees(sqrt(-2 * log(R)))
+
+    # Half width (degrees) of the confidence interval of the mean,
+    # inf while it cannot be estimated yet
+    def ciHalfWidth(self, confidence=0.95):
+        R = self.resultantLength()
+        if self.n < 2 or R <= 0:
+            return float("inf")
+        mu = atan2(self._s, self._c)
+        rho2 = (self._c2 * cos(2 * mu) + self._s2 * sin(2 * mu)) / self.n
+        standardError = sqrt(max(0.0, 1 - rho2) / (2 * self.n * R ** 2))
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        if z * standardError >= 1:
+            return float("inf")
+        return degrees(asin(z * standardError))
+
+
+class StoppingRule(object):
+    # enabled: when off, update() only estimates and nothing ever stops
+    # ciHalfWidth: stop a condition once its CI half width (degrees) is below this
+    # minTrials: never stop a condition before it had this many trials
+    # maxTrials: always stop a condition after this many trials (None = no limit
+    #   other than the planned blocks)
+    def __init__(self, enabled=False, ciHalfWidth=10.0, confidence=0.95, minTrials=15, maxTrials=None):
+        self.enabled = enabled
+        self.ciHalfWidthLimit = ciHalfWidth
+        self.confidence = confidence
+        self.minTrials = minTrials
+        self.maxTrials = maxTrials
+        self.estimators = {}
+        self._stopped = set()
+
+    # Add a trial's report error (degrees) to a condition.
+    # Returns True when the condition has just been stopped.
+    def update(self, condition, errorDeg):
+        estimator = self.estimators.setdefault(condition, CircularEstimator())
+        estimator.add(errorDeg)
+        if not self.enabled or condition in self._stopped or estimator.n < self.minTrials:
+            return False
+        if (self.maxTrials is not None and estimator.n >= self.maxTrials) or (
+            estimator.ciHalfWidth(self.confidence) <= self.ciHalfWidthLimit
+        ):
+            self._stopped.add(condition)
+            return True
+        return False
+
+    def stopped(self, condition):
+        return condition in self._stopped
+
+    # (trials, mean, CI half width) of a condition, angles in degrees
+    def summary(self, condition):
+        estimator = self.estimators.get(condition, CircularEstimator())
+        return estimator.n, estimator.mean(), estimator.ciHalfWidth(self.confidence)
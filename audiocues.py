@@ -0,0 +1,196 @@
+# -------------- AUDIO CUES ----------------
+# -----------------------------------------
+# Optional sound cues for trial onset, press confirmation and misses.
+# All cues are synthesized/loaded into sound buffers once at startup and
+# played through psychtoolbox's low-latency backend, which can schedule a
+# sound to start exactly at a future flip. The real onset reported by the
+# audio driver is read back after the timing-critical part of the trial and
+# logged against the flip it was locked to.
+#
+# A cue's trigger is not sent when the cue is started but after the flip the
+# cue is locked to, and only once the previous trigger is at least
+# triggerGap old: a pulse on top of another one (the trialstart code goes out
+# with the first rotation frame, the eegLine code with the press) would merge
+# the two codes on the StimTracker's lines. A cue trigger can therefore come a
+# frame or two after the cue; its delay is logged with the trigger. Before a
+# pause without flips (the hold screen, "YOU MISSED") flush() waits out the
+# gap and sends what is left, so no cue trigger slips into the next trial.
+#
+# The audio backend has to be chosen before psychopy.sound is imported for
+# the first time, so nothing else may import psychopy.sound before AudioCues.
+
+
+# Cue triggers waiting to be sent clear of the previous trigger. No PsychoPy:
+# clock and wait are passed in (core.getTime and core.wait in a session).
+class CueTriggers(object):
+    # sendTrigger: function(bitmask)
+    # eventLog: the delay of every trigger after its cue is logged to it
+    # triggerGap: seconds a trigger keeps clear of the previous one
+    def __init__(self, sendTrigger, eventLog, triggerGap, clock, wait):
+        self.sendTrigger = sendTrigger
+        self.eventLog = eventLog
+        self.triggerGap = triggerGap
+        self._clock = clock
+        self._wait = wait
+        # (trigger code, time the cue was locked to) of triggers not sent yet
+        self._queue = []
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, code, target):
+        self._queue.append((code, target))
+
+    # After a flip at flipTime: send the first trigger if its cue has started by
+    # this flip and the last trigger (lastTrigger, same clock) is at least
+    # triggerGap old. One trigger per flip at most.
+    def flipped(self, flipTime, lastTrigger=None, framePeriod=0.0):
+        if not self._queue:
+            return
+        now = self._clock()
+        if lastTrigger is not None and now - lastTrigger < self.triggerGap:
+            return
+        code, target = self._queue[0]
+        if target > flipTime + framePeriod / 2:
+            # locked to a later flip
+            return
+        del self._queue[0]
+        self._send(code, target, now)
+
+    # Send every trigger left, each once its cue has started and triggerGap
+    # after the one before. Returns the time of the last trigger sent.
+    def flush(self, lastTrigger=None):
+        while self._queue:
+            code, target = self._queue.pop(0)
+            due = target
+            if lastTrigger is not None:
+                due = max(due, lastTrigger + self.triggerGap)
+            now = self._clock()
+            if due > now:
+                self._wait(due - now)
+                now = self._clock()
+            self._send(code, target, now)
+            lastTrigger = now
+        return lastTrigger
+
+    def _send(self, code, target, now):
+        self.sendTrigger(code)
+        self.eventLog.log("audioTrigger", code, now - target)
+
+
+class AudioCues(object):
+    # win: the window, used to predict the time of the next flip
+    # cues: {name: {"value": tone in Hz, note name or file, "secs": duration,
+    #   "volume": 0-1, "trigger": trigger code or None}}
+    # eventLog: EventLog (or WorkerEventLog) the onsets are logged to
+    # sendTrigger: function(bitmask), sends the trigger of a cue
+    # latencyMode: psychtoolbox latency class, 3 = aggressive low latency,
+    #   4 = critical (fails when exclusive access to the device is not possible)
+    # triggerGap: seconds a cue trigger keeps clear of the previous trigger,
+    #   at least the pulse duration of the StimTracker
+    def __init__(self, win, cues, eventLog, sendTrigger=None, latencyMode=3, triggerGap=0.02):
+        from psychopy import prefs
+
+        prefs.hardware["audioLib"] = ["PTB"]
+        prefs.hardware["audioLatencyMode"] = latencyMode
+        from psychopy import core, sound
+
+        self.win = win
+        self.eventLog = eventLog
+        self.triggers = {}
+        self.sounds = {}
+        for name, cue in cues.items():
+            self.sounds[name] = sound.Sound(
+                cue["value"],
+                secs=cue.get("secs", -1),
+                volume=cue.get("volume", 1.0),
+                stereo=True,
+                hamming=True,
+                preBuffer=-1,  # decode the whole sound into the buffer now
+            )
+            self.triggers[name] = cue.get("trigger")
+        if sound.Sound.__name__ != "SoundPTB":
+            print("WARNING: audio cues are not using the psychtoolbox backend, onsets may lag")
+
+        # Offset of the audio clock against core.getTime (usually 0, both are GetSecs)
+        try:
+            import psychtoolbox
+
+            self.ptbOffset = psychtoolbox.GetSecs() - core.getTime()
+        except ImportError:
+            self.ptbOffset = 0.0
+        self._clock = core.getTime
+        # (name, time the cue was locked to) of cues played and not collected yet
+        self._pending = []
+        self.cueTriggers = None
+        if sendTrigger is not None:
+            self.cueTriggers = CueTriggers(
+                sendTrigger, eventLog, triggerGap, core.getTime, core.wait
+            )
+
+    # Start a cue. atFlip: schedule the onset to the next flip instead of
+    # playing right away. Only starts the stream, never waits for it; the
+    # trigger goes out with flipped() or flush().
+    def play(self, name, atFlip=False):
+        snd = self.sounds[name]
+        if atFlip:
+            when = self.win.getFutureFlipTime(clock="ptb")
+            snd.play(when=when)
+            target = when - self.ptbOffset
+        else:
+            snd.play()
+            target = self._clock()
+        if self.cueTriggers is not None and self.triggers[name] is not None:
+            self.cueTriggers.add(self.triggers[name], target)
+        self._pending.append((name, target))
+
+    # Call after every flip: sends a trigger of a cue that has started by this
+    # flip, when the last trigger (lastTrigger, core.getTime clock) is at least
+    # triggerGap old (see CueTriggers)
+    def flipped(self, flipTime, lastTrigger=None, framePeriod=0.0):
+        if self.cueTriggers is not None:
+            self.cueTriggers.flipped(flipTime, lastTrigger, framePeriod)
+
+    # Call before a pause without flips: sends the cue triggers left, waiting
+    # out triggerGap before each
+    def flush(self, lastTrigger=None):
+        if self.cueTriggers is not None:
+            self.cueTriggers.flush(lastTrigger)
+
+    # Read back the onsets of the cues named in flipTimes and log them; other
+    # cues stay pending for a later call.
+    # flipTimes: {cue name: time of the flip the cue belongs to, or None for
+    #   the scheduled (or requested) time}
+    # Returns {cue name: onset minus reference, seconds}
+    def collect(self, flipTimes):
+        latencies = {}
+        pending = []
+        for name, target in self._pending:
+            if name not in flipTimes:
+                pending.append((name, target))
+                continue
+            reference = flipTimes[name]
+            if reference is None:
+                reference = target
+            onset = self._onset(name)
+            if onset is None:
+                continue
+            latencies[name] = onset - reference
+            self.eventLog.log("audio", self.triggers[name] or 0, onset - reference, t=onset)
+        self._pending = pending
+        return latencies
+
+    # Onset reported by the audio driver (core.getTime clock), None if unknown
+    def _onset(self, name):
+        try:
+            status = self.sounds[name].statusDetailed
+            start = status["StartTime"]
+        except (AttributeError, KeyError, TypeError):
+            return None
+        if not start:
+            return None
+        return start - self.ptbOffset
+
+    def close(self):
+        for snd in self.sounds.values():
+            snd.stop()
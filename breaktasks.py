@@ -0,0 +1,148 @@
+# ------------- BREAK TASKS ---------------
+# ----------------------------------------
+# Housekeeping that must never run during trials is done in the mandatory
+# break between blocks, while the break screen is up: checking and
+# compacting the data of the block that just finished, checking the
+# triggers against the event log, rotating the event log and collecting
+# garbage. Tasks run one after another in the main process (nothing else
+# is happening) and the break only ends after the last one; a report says
+# how long each task took and whether they all fit in the break.
+import csv
+import gc
+import time
+import traceback
+
+from numpy import diff
+
+from eventlog import eventTypes, keyCodes
+
+
+class BreakTasks(object):
+    def __init__(self):
+        self.tasks = []
+
+    # A task returns a list of problems (empty or None when all is well)
+    def add(self, name, function, *args):
+        self.tasks.append((name, function, args))
+
+    # Run every task. budget: length of the break (seconds).
+    # Returns the report: one dict per task (name, seconds, problems) and
+    # the time left of the break (negative when the tasks overran it)
+    def run(self, budget):
+        start = time.perf_counter()
+        report = []
+        for name, function, args in self.tasks:
+            taskStart = time.perf_counter()
+            try:
+                problems = list(function(*args) or [])
+            except Exception as error:
+                traceback.print_exc()
+                problems = ["failed: {!r}".format(error)]
+            report.append(
+                {"name": name, "seconds": time.perf_counter() - taskStart, "problems": problems}
+            )
+        return report, budget - (time.perf_counter() - start)
+
+
+def formatReport(report, left):
+    lines = []
+    for task in report:
+        lines.append(
+            "  {:<20} {:8.1f} ms  {}".format(
+                task["name"], task["seconds"] * 1000, "; ".join(task["problems"]) or "ok"
+            )
+        )
+    if left >= 0:
+        lines.append("  all tasks done {:.1f} s before the end of the break".format(left))
+    else:
+        lines.append("  WARNING: tasks overran the break by {:.1f} s".format(-left))
+    return "\n".join(lines)
+
+
+# ------------- TASKS ---------------
+
+
+# Check a block's CSV file: header, number of rows, numbers where numbers
+# belong, angles on the circle and no repeated trial numbers
+def validateBlockCsv(path, dataCategories, expectedRows):
+    problems = []
+    with open(path, newline="") as f:
+        rows = list(csv.reader(f))
+    if not rows or rows[0] != list(dataCategories):
+        return ["{}: unexpected header".format(path)]
+    rows = rows[1:]
+    if len(rows) != expectedRows:
+        problems.append("{} rows, expected {}".format(len(rows), expectedRows))
+    columns = dict((name, index) for index, name in enumerate(dataCategories))
+    seen = set()
+    for rowNo, row in enumerate(rows, 1):
+        if len(row) != len(dataCategories):
+            problems.append("row {}: {} columns".format(rowNo, len(row)))
+            continue
+        for name in ("pressAngle", "ansAngle"):
+            if name in columns:
+                try:
+                    angle = float(row[columns[name]])
+                except ValueError:
+                    problems.append("row {}: {} is not a number".format(rowNo, name))
+                    continue
+                if not 0 <= angle <= 360:
+                    problems.append("row {}: {} {} off the circle".format(rowNo, name, angle))
+        if "no" in columns:
+            if row[columns["no"]] in seen:
+                problems.append("row {}: trial {} repeated".format(rowNo, row[columns["no"]]))
+            seen.add(row[columns["no"]])
+    return problems
+
+
+# Add a block's CSV file to the trial database (see trialdb.py)
+def compactToDatabase(path, databasePath):
+    import trialdb
+
+    db = trialdb.connect(databasePath)
+    try:
+        rows, duplicateOf = trialdb.ingestFile(db, path, trialdb.loadParadigms())
+    finally:
+        db.close()
+    if duplicateOf is not None:
+        return ["same content as {}, no trials added".format(duplicateOf)]
+
+
+# Check the triggers of a (closed) event log segment against its trials:
+# every trial needs its trialstart trigger and every press its eegLine
+# trigger, flips must move forward. conditionTriggers: {trialstart: eegLine}
+def checkTriggers(records, conditionTriggers):
+    problems = []
+    types, codes = records["type"], records["code"]
+    flips = records["time"][types == eventTypes["flip"]]
+    if len(flips) > 1 and (diff(flips) < 0).any():
+        problems.append("flip times go backwards")
+    triggers = types == eventTypes["trigger"]
+    if triggers.any() and not records["value"][triggers].any():
+        problems.append("no trigger device, triggers were only logged")
+    # Split the segment at its "block" events and count per block
+    blockStarts = (types == eventTypes["block"]).nonzero()[0].tolist()
+    for n, first in enumerate(blockStarts):
+        last = blockStarts[n + 1] if n + 1 < len(blockStarts) else len(records)
+        trialstart = int(codes[first])
+        blockTypes, blockCodes = types[first:last], codes[first:last]
+        trials = int((blockTypes == eventTypes["trial"]).sum())
+        presses = int(((blockTypes == eventTypes["key"]) & (blockCodes == keyCodes["press"])).sum())
+        blockTriggers = blockTypes == eventTypes["trigger"]
+        startTriggers = int((blockTriggers & (blockCodes == trialstart)).sum())
+        pressTriggers = int(
+            (blockTriggers & (blockCodes == conditionTriggers.get(trialstart, -1))).sum()
+        )
+        if startTriggers != trials:
+            problems.append(
+                "block {}: {} trials, {} trialstart triggers".format(trialstart, trials, startTriggers)
+            )
+        if pressTriggers != presses:
+            problems.append(
+                "block {}: {} presses, {} eegLine triggers".format(trialstart, presses, pressTriggers)
+            )
+    return problems
+
+
+def collectGarbage():
+    gc.collect()
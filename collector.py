@@ -0,0 +1,526 @@
+# -------------- COLLECTOR ----------------
+# ----------------------------------------
+# Gathers the data of every lab PC in one archive. Stations stream their
+# completed trial rows as they are written and whole files when they are
+# final: the session plan, each block's CSV file and every closed event log
+# segment. The collector stores them under archive/<station>/ and keeps an
+# index (archive/collector.sqlite) that makes every item unique, so nothing
+# is stored twice however often a station retries.
+#
+# On the station, CollectorClient only puts items on a queue. A background
+# thread journals them to a local outbox, sends them in batches over TCP and
+# retries with a growing delay while the collector is unreachable; the
+# outbox survives restarts. A file is copied into the outbox when it is
+# handed over, so what is archived is the file as it was then, however late
+# it is sent. The session never waits for the network and
+# runs the same whether the collector is up or not.
+#
+#     python collector.py serve archive                   # loopback: 127.0.0.1
+#     python collector.py serve archive --host 0.0.0.0    # for the lab network
+#     python collector.py send data/*_plan.json data/*.csv --station lab2
+#     python collector.py status archive
+#
+# Protocol, per batch: 4-byte length, JSON header ({"station", "items"}),
+# then the bytes of the items' payloads back to back; the reply is a 4-byte
+# length and JSON ({"stored", "duplicates"}). A batch is stored as a whole.
+import argparse
+import hashlib
+import json
+import os
+import queue
+import socket
+import socketserver
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import uuid
+
+defaultHost = "127.0.0.1"
+defaultPort = 50008
+lengthFormat = ">I"
+lengthSize = struct.calcsize(lengthFormat)
+
+
+def sendMessage(sock, header, payload=b""):
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(struct.pack(lengthFormat, len(data)) + data + payload)
+
+
+def receiveExactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def receiveHeader(sock):
+    (size,) = struct.unpack(lengthFormat, receiveExactly(sock, lengthSize))
+    return json.loads(receiveExactly(sock, size).decode("utf-8"))
+
+
+# ------------- STATION ---------------
+
+
+class CollectorClient(object):
+    # station: name of this PC in the archive (default: the host name)
+    # outbox: folder of the journal of items not yet acknowledged
+    # batchSize: items per batch at most, batchBytes: file bytes per batch at most
+    # interval: seconds between batches, maxDelay: longest wait between retries
+    # enabled: when off every call is a no-op
+    def __init__(
+        self,
+        outbox,
+        host=defaultHost,
+        port=defaultPort,
+        station=None,
+        batchSize=200,
+        batchBytes=32 << 20,
+        interval=2.0,
+        maxDelay=60.0,
+        timeout=5.0,
+        enabled=True,
+    ):
+        self.address = (host, port)
+        self.station = station or socket.gethostname()
+        self.outbox = outbox
+        self.batchSize = batchSize
+        self.batchBytes = batchBytes
+        self.interval = interval
+        self.maxDelay = maxDelay
+        self.timeout = timeout
+        self.enabled = enabled
+        self.sent = 0  # items acknowledged by the collector
+        self.failures = 0  # failed batches since the last success
+        self._queue = queue.Queue()
+        self._pending = []  # journaled items not yet acknowledged, in order
+        # rows are unique per session: a rerun of a subject writes the same file names.
+        # The id stays unique when the station restarts within a second
+        self.session = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:12])
+        self._stop = threading.Event()
+        self._closing = None  # end of the final attempts, set by close()
+        self._thread = None
+        if enabled:
+            if not os.path.isdir(outbox):
+                os.makedirs(outbox)
+            self._journalPath = os.path.join(outbox, "outbox.jsonl")
+            self._positionPath = os.path.join(outbox, "outbox.pos")
+            # copies of the files handed over, one per sendFile()
+            self._filesFolder = os.path.abspath(os.path.join(outbox, "files"))
+            if not os.path.isdir(self._filesFolder):
+                os.makedirs(self._filesFolder)
+            self._loadOutbox()
+            self._thread = threading.Thread(target=self._run, name="collector", daemon=True)
+            self._thread.start()
+
+    # A trial row of a CSV file. seq: the row's number in its file (1 = first trial)
+    def sendRow(self, path, seq, row):
+        if self.enabled:
+            self._queue.put(
+                {
+                    "kind": "row",
+                    "session": self.session,
+                    "name": os.path.basename(path),
+                    "seq": seq,
+                    "row": row,
+                }
+            )
+
+    # A file in its final state. It is copied to the outbox right away (call it
+    # between trials, not during one); returns False when it cannot be read
+    def sendFile(self, path):
+        if not self.enabled:
+            return False
+        try:
+            snapshot, sha256, size = self._snapshot(path)
+        except OSError as error:
+            print("WARNING: collector skips {}: {}".format(path, error))
+            return False
+        self._queue.put(
+            {
+                "kind": "file",
+                "name": os.path.basename(path),
+                "path": snapshot,
+                "sha256": sha256,
+                "size": size,
+            }
+        )
+        return True
+
+    # Copy a file to the outbox, hashing it on the way. Returns (copy, sha256, size)
+    def _snapshot(self, path):
+        digest = hashlib.sha256()
+        size = 0
+        snapshot = os.path.join(self._filesFolder, uuid.uuid4().hex)
+        with open(path, "rb") as source, open(snapshot + ".part", "wb") as copy:
+            while True:
+                chunk = source.read(1 << 20)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                copy.write(chunk)
+                size += len(chunk)
+        os.replace(snapshot + ".part", snapshot)
+        return snapshot, digest.hexdigest(), size
+
+    def backlog(self):
+        return len(self._pending) + self._queue.qsize()
+
+    # Stop the thread after trying to send what is left for at most timeout seconds.
+    # Unsent items stay in the outbox for the next session (or python collector.py send)
+    def close(self, timeout=5.0):
+        if self._thread is None:
+            return
+        self._closing = time.time() + timeout
+        self._stop.set()
+        self._thread.join(timeout + self.timeout)
+        self._thread = None
+
+    # -------- background thread --------
+
+    def _loadOutbox(self):
+        position = 0
+        if os.path.exists(self._positionPath):
+            with open(self._positionPath) as f:
+                position = int(f.read().strip() or 0)
+        self._journaled = 0  # items in the journal
+        if os.path.exists(self._journalPath):
+            with open(self._journalPath, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        # torn last line of a crashed session
+                        continue
+                    if self._journaled >= position:
+                        self._pending.append(item)
+                    self._journaled += 1
+        self._position = position
+        if not self._pending and self._journaled:
+            # everything was sent, start a new journal
+            self._resetJournal()
+
+    def _resetJournal(self):
+        open(self._journalPath, "w").close()
+        self._writePosition(0)
+        self._journaled = self._position = 0
+
+    def _writePosition(self, position):
+        with open(self._positionPath + ".tmp", "w") as f:
+            f.write(str(position))
+        os.replace(self._positionPath + ".tmp", self._positionPath)
+
+    # Move queued items to the journal and the pending list
+    def _drainQueue(self):
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if items:
+            with open(self._journalPath, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(item) + "\n" for item in items))
+            self._pending.extend(items)
+            self._journaled += len(items)
+
+    def _batch(self):
+        items, payloads, size = [], [], 0
+        for item in self._pending[: self.batchSize]:
+            header = dict((key, value) for key, value in item.items() if key != "path")
+            if item["kind"] == "file":
+                try:
+                    with open(item["path"], "rb") as f:
+                        data = f.read()
+                except OSError as error:
+                    print("WARNING: collector skips {}: {}".format(item["path"], error))
+                    data = None
+                if data is not None and items and size + len(data) > self.batchBytes:
+                    break
+                if data is None:
+                    header["missing"] = True
+                    data = b""
+                sha256 = hashlib.sha256(data).hexdigest()
+                if data and item.get("sha256", sha256) != sha256:
+                    print(
+                        "WARNING: collector copy of {} changed in the outbox".format(item["name"])
+                    )
+                header["sha256"] = sha256
+                header["size"] = len(data)
+                payloads.append(data)
+                size += len(data)
+            items.append(header)
+        return items, b"".join(payloads)
+
+    def _sendBatch(self):
+        # files are only read once the collector is reachable
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        try:
+            items, payload = self._batch()
+            sendMessage(sock, {"station": self.station, "items": items}, payload)
+            reply = receiveHeader(sock)
+        finally:
+            sock.close()
+        if "error" in reply:
+            raise IOError(reply["error"])
+        # acknowledged: advance the journal position
+        acknowledged = self._pending[: len(items)]
+        del self._pending[: len(items)]
+        self._position += len(items)
+        if self._pending or self._queue.qsize():
+            self._writePosition(self._position)
+        else:
+            self._resetJournal()
+        self._removeSnapshots(acknowledged)
+        self.sent += len(items)
+
+    # Delete the outbox copies of acknowledged files
+    def _removeSnapshots(self, acknowledged):
+        for item in acknowledged:
+            path = item.get("path")
+            if (
+                item["kind"] == "file"
+                and os.path.dirname(path) == self._filesFolder
+                and os.path.exists(path)
+            ):
+                os.remove(path)
+
+    def _run(self):
+        delay = self.interval
+        while True:
+            stopping = self._stop.wait(delay)
+            self._drainQueue()
+            delay = self.interval
+            while self._pending:
+                if stopping and time.time() > self._closing:
+                    return
+                try:
+                    self._sendBatch()
+                    self.failures = 0
+                except Exception:
+                    # collector down, unreachable or refusing the batch: back off, everything
+                    # stays in the outbox
+                    self.failures += 1
+                    delay = min(self.maxDelay, self.interval * 2**self.failures)
+                    if stopping:
+                        return
+                    break
+            if stopping:
+                return
+
+
+# ------------- COLLECTOR ---------------
+
+schema = """
+CREATE TABLE IF NOT EXISTS rows (
+    station TEXT NOT NULL,
+    session TEXT NOT NULL,
+    name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    received REAL NOT NULL,
+    UNIQUE (station, session, name, seq)
+);
+CREATE TABLE IF NOT EXISTS files (
+    station TEXT NOT NULL,
+    name TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    received REAL NOT NULL,
+    UNIQUE (station, name, sha256)
+);
+"""
+
+
+class Archive(object):
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.db = sqlite3.connect(os.path.join(folder, "collector.sqlite"), check_same_thread=False)
+        self.db.executescript(schema)
+        self.lock = threading.Lock()
+
+    # Store a batch, returns (stored, duplicates)
+    def store(self, station, items, payload):
+        station = os.path.basename(station) or "unknown"
+        stationFolder = os.path.join(self.folder, station)
+        # split and check the payload before anything is stored
+        data = {}
+        offset = 0
+        for index, item in enumerate(items):
+            if item["kind"] == "file":
+                data[index] = payload[offset : offset + item["size"]]
+                offset += item["size"]
+                if hashlib.sha256(data[index]).hexdigest() != item["sha256"]:
+                    raise ValueError("{}: corrupt payload".format(item["name"]))
+        stored = duplicates = 0
+        now = time.time()
+        with self.lock, self.db:
+            for index, item in enumerate(items):
+                name = os.path.basename(item["name"])
+                if item["kind"] == "row":
+                    cursor = self.db.execute(
+                        "INSERT OR IGNORE INTO rows VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            station,
+                            item["session"],
+                            name,
+                            int(item["seq"]),
+                            json.dumps(item["row"]),
+                            now,
+                        ),
+                    )
+                else:
+                    if item.get("missing"):
+                        continue
+                    known = self.db.execute(
+                        "SELECT 1 FROM files WHERE station = ? AND name = ? AND sha256 = ?",
+                        (station, name, item["sha256"]),
+                    ).fetchone()
+                    if known:
+                        duplicates += 1
+                        continue
+                    path = os.path.join(stationFolder, name)
+                    if os.path.exists(path):
+                        # another version of the file: keep both
+                        path = "{}.{}".format(path, item["sha256"][:12])
+                    if not os.path.isdir(stationFolder):
+                        os.makedirs(stationFolder)
+                    with open(path + ".part", "wb") as f:
+                        f.write(data[index])
+                    os.replace(path + ".part", path)
+                    cursor = self.db.execute(
+                        "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            station,
+                            name,
+                            item["sha256"],
+                            item["size"],
+                            os.path.relpath(path, self.folder),
+                            now,
+                        ),
+                    )
+                if cursor.rowcount:
+                    stored += 1
+                else:
+                    duplicates += 1
+        return stored, duplicates
+
+    def status(self):
+        return (
+            self.db.execute(
+                "SELECT station, COUNT(DISTINCT name), COUNT(*), MAX(received) FROM rows GROUP BY station"
+            ).fetchall(),
+            self.db.execute(
+                "SELECT station, COUNT(*), SUM(size), MAX(received) FROM files GROUP BY station"
+            ).fetchall(),
+        )
+
+    def close(self):
+        self.db.close()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        archive = self.server.archive
+        self.request.settimeout(60)
+        try:
+            header = receiveHeader(self.request)
+            size = sum(item.get("size", 0) for item in header["items"] if item["kind"] == "file")
+            payload = receiveExactly(self.request, size)
+            stored, duplicates = archive.store(header["station"], header["items"], payload)
+            sendMessage(self.request, {"stored": stored, "duplicates": duplicates})
+            print(
+                "{} {}: {} stored, {} duplicates".format(
+                    time.strftime("%H:%M:%S"), header["station"], stored, duplicates
+                )
+            )
+        except (OSError, ValueError, KeyError, ConnectionError) as error:
+            try:
+                sendMessage(self.request, {"error": repr(error)})
+            except OSError:
+                pass
+
+
+class CollectorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, archiveFolder, host=defaultHost, port=defaultPort):
+        self.archive = Archive(archiveFolder)
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), _Handler)
+
+    def server_close(self):
+        socketserver.ThreadingTCPServer.server_close(self)
+        self.archive.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Central archive of the lab stations' data")
+    commands = parser.add_subparsers(dest="command")
+    serveParser = commands.add_parser("serve", help="run the collector")
+    serveParser.add_argument("archive")
+    serveParser.add_argument("--host", default=defaultHost)
+    serveParser.add_argument("--port", type=int, default=defaultPort)
+    sendParser = commands.add_parser("send", help="send files (and whatever an outbox still holds)")
+    sendParser.add_argument("files", nargs="*")
+    sendParser.add_argument("--outbox", default=os.path.join("data", "outbox"))
+    sendParser.add_argument("--station")
+    sendParser.add_argument("--host", default=defaultHost)
+    sendParser.add_argument("--port", type=int, default=defaultPort)
+    sendParser.add_argument("--timeout", type=float, default=60.0)
+    statusParser = commands.add_parser("status", help="what the archive holds per station")
+    statusParser.add_argument("archive")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = CollectorServer(args.archive, args.host, args.port)
+        print(
+            "Collecting into {} on {}:{} (Ctrl+C to stop)".format(
+                args.archive, args.host, args.port
+            )
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    elif args.command == "send":
+        client = CollectorClient(
+            args.outbox, args.host, args.port, station=args.station, interval=0.1
+        )
+        for path in args.files:
+            client.sendFile(path)
+        client.close(args.timeout)
+        print("{} items sent, {} left in {}".format(client.sent, client.backlog(), args.outbox))
+        sys.exit(1 if client.backlog() else 0)
+    elif args.command == "status":
+        archive = Archive(args.archive)
+        rows, files = archive.status()
+        for station, names, count, received in rows:
+            print(
+                "{}: {} rows of {} files, last {}".format(
+                    station, count, names, time.ctime(received)
+                )
+            )
+        for station, count, size, received in files:
+            print(
+                "{}: {} files, {:.1f} MB, last {}".format(
+                    station, count, size / 1e6, time.ctime(received)
+                )
+            )
+        archive.close()
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
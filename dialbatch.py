@@ -0,0 +1,163 @@
+# ----------- BATCHED DIAL LAYER ------------
+# ------------------------------------------
+# Optional renderer for everything that changes on the clock face during
+# the rotation: the dot, the two marker lines and the fixation cross. All
+# of it lives in one vertex/colour array, built once, with the dot disc and
+# the marker quads precomputed at every position of an angle table, and
+# uploaded to the GPU once (vertex buffer objects, GL_STATIC_DRAW). A frame
+# copies the dot's indices for the current angle into the small element
+# array and issues a single glDrawElements call; no trigonometry, no vertex
+# data sent and no per-stimulus state changes in the render loop.
+#
+# The static clock face (circle and tics) stays the BufferImageStim texture.
+from numpy import arange, array, concatenate, cos, empty, float32, radians, sin, uint32, zeros
+from psychopy import colors
+from psychopy.tools.monitorunittools import deg2pix
+
+try:
+    from pyglet import gl as GL
+except ImportError:
+    GL = None
+
+
+class DialLayer(object):
+    # radius: radius of the dot's path (degrees)
+    # dotSize: diameter of the dot (degrees)
+    # fixationSize: height of the fixation cross (degrees)
+    # markers: draw the two marker lines (start and end of the lockout)
+    # steps: positions in the angle table, 3600 = 0.1 degree
+    def __init__(
+        self,
+        win,
+        radius,
+        dotSize,
+        dotColor="red",
+        fixationSize=0.7,
+        markers=False,
+        markerColor=(0, 0, 0, 0.5),
+        steps=3600,
+        dotSegments=32,
+    ):
+        if GL is None:
+            raise ImportError("the batched dial layer needs pyglet")
+        self.win = win
+        self.steps = steps
+        self._perDeg = steps / 360.0
+
+        def toPix(value):
+            return deg2pix(value, win.monitor)
+
+        tableAngles = radians(arange(steps) * (360.0 / steps))
+        sinA, cosA = sin(tableAngles), cos(tableAngles)
+        vertices = []
+        vertexColors = []
+
+        # Fixation cross: two bars, proportions of a "+" glyph
+        arm = toPix(fixationSize) * 0.3
+        bar = max(1.0, toPix(fixationSize) * 0.04)
+        fixation = array(
+            [
+                [-arm, -bar], [arm, -bar], [arm, bar], [-arm, bar],
+                [-bar, -arm], [bar, -arm], [bar, arm], [-bar, arm],
+            ]
+        )
+        vertices.append(fixation)
+        vertexColors.append(_rgba("black", len(fixation)))
+        fixationIndices = array([0, 1, 2, 0, 2, 3, 4, 5, 6, 4, 6, 7])
+        base = len(fixation)
+
+        # Dot: a triangle fan (as triangles) around the centre, at every table angle
+        dotRadius = toPix(dotSize) / 2.0
+        ring = radians(arange(dotSegments) * (360.0 / dotSegments))
+        disc = concatenate([[[0, 0]], dotRadius * array([cos(ring), sin(ring)]).T])
+        centres = toPix(radius) * array([sinA, cosA]).T
+        dotVertices = (centres[:, None, :] + disc[None, :, :]).reshape(-1, 2)
+        vertices.append(dotVertices)
+        vertexColors.append(_rgba(dotColor, len(dotVertices)))
+        fan = array(
+            [[0, 1 + k, 1 + (k + 1) % dotSegments] for k in range(dotSegments)]
+        ).ravel()
+        self._dotIndices = (base + arange(steps)[:, None] * len(disc) + fan[None, :]).astype(uint32)
+        base += len(dotVertices)
+
+        # Marker lines from the centre to just outside the circle, 2 pixels wide
+        self._markerIndices = None
+        if markers:
+            length = toPix(radius) * 1.08
+            normal = array([cosA, -sinA]).T  # perpendicular to the line
+            tip = length * array([sinA, cosA]).T
+            quads = array([-normal, normal, tip + normal, tip - normal]).transpose(1, 0, 2)
+            markerVertices = quads.reshape(-1, 2)
+            vertices.append(markerVertices)
+            vertexColors.append(_rgba(markerColor, len(markerVertices)))
+            quad = array([0, 1, 2, 0, 2, 3])
+            self._markerIndices = (base + arange(steps)[:, None] * 4 + quad[None, :]).astype(uint32)
+
+        # The whole table goes to the GPU once; a frame only sends its indices
+        vertices = concatenate(vertices).astype(float32)
+        vertexColors = concatenate(vertexColors).astype(float32)
+        self._buffers = (GL.GLuint * 2)()
+        GL.glGenBuffers(2, self._buffers)
+        for buffer, data in zip(self._buffers, [vertices, vertexColors]):
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, data.nbytes, data.ctypes, GL.GL_STATIC_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        # Element array of a frame, in drawing order: the fixation cross, the markers
+        # (rewritten every trial) and the dot on top (rewritten every frame)
+        self._dotCount = self._dotIndices.shape[1]
+        self._markerStart = len(fixationIndices)
+        nMarkers = 0 if self._markerIndices is None else 2 * self._markerIndices.shape[1]
+        self._indices = zeros(len(fixationIndices) + nMarkers + self._dotCount, dtype=uint32)
+        self._indices[: len(fixationIndices)] = fixationIndices
+        self._dotSlice = self._indices[len(self._indices) - self._dotCount :]
+        if self._markerIndices is not None:
+            self.setMarkers([0, 0])
+
+    def index(self, angleDeg):
+        return int(angleDeg * self._perDeg + 0.5) % self.steps
+
+    # Move the marker lines (angles in degrees), once per trial
+    def setMarkers(self, anglesDeg):
+        if self._markerIndices is None:
+            return
+        size = self._markerIndices.shape[1]
+        for n, angleDeg in enumerate(anglesDeg[:2]):
+            start = self._markerStart + n * size
+            self._indices[start : start + size] = self._markerIndices[self.index(angleDeg)]
+
+    # Draw the dot at angleDeg together with the fixation cross and markers
+    def draw(self, angleDeg=0.0):
+        self._dotSlice[:] = self._dotIndices[self.index(angleDeg)]
+        GL.glPushMatrix()
+        self.win.setScale("pix")
+        GL.glUseProgram(0)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glEnableClientState(GL.GL_COLOR_ARRAY)
+        # pointers are offsets into the bound buffers
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._buffers[0])
+        GL.glVertexPointer(2, GL.GL_FLOAT, 0, 0)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._buffers[1])
+        GL.glColorPointer(4, GL.GL_FLOAT, 0, 0)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        GL.glDrawElements(GL.GL_TRIANGLES, len(self._indices), GL.GL_UNSIGNED_INT, self._indices.ctypes)
+        GL.glDisableClientState(GL.GL_COLOR_ARRAY)
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glPopMatrix()
+
+    # Free the buffers on the GPU (the window's context must still be current)
+    def close(self):
+        if self._buffers is not None:
+            GL.glDeleteBuffers(2, self._buffers)
+            self._buffers = None
+
+
+# n copies of a colour (name, hex or psychopy rgb/rgba in -1..1) as GL RGBA in 0..1
+def _rgba(color, n):
+    if isinstance(color, str):
+        rgba = list((colors.Color(color).rgb + 1) / 2.0) + [1.0]
+    else:
+        rgba = [(value + 1) / 2.0 for value in color[:3]] + list(color[3:4] or [1.0])
+    out = empty((n, 4))
+    out[:] = rgba
+    return out
@@ -0,0 +1,1149 @@
+# ------------ LIBET CLOCK ENGINE ------------
+# -------------------------------------------
+# Shared engine for the Libet clock paradigms. Everything that differs
+# between paradigms (conditions, timing, texts, display options) is
+# described in a JSON config (see configs/ and the defaults below), so a
+# new paradigm needs a config file and no code:
+#
+#     python engine.py configs/random_finger.json
+#
+# Before the first screen the config is compiled into a session plan:
+# block order, trial lists, ISIs, starting angles and dot delays are all
+# drawn up front (and saved next to the data), so the trial loops only
+# execute the plan.
+from __future__ import division
+from psychopy import core, visual, event, gui, monitors
+from math import sin, cos, radians, sqrt
+from numpy import average
+import random
+
+import pyxid2  # for Stimtracker to send the trigger signal
+import copy
+import csv
+import json
+import os
+import sys
+import time
+
+from realtime import RealtimeGuard
+from eventlog import EventLog, screenCodes, keyCodes, eventLogSegment, readEventLog
+from textcache import TextCache
+from warmup import warmUp, drawOffscreen
+from workers import SessionWorkers
+from adaptive import StoppingRule, circularDifference
+from livemonitor import LivePublisher
+from audiocues import AudioCues
+from triallogic import Rotation, wTime, msScale, degScale
+from dialbatch import DialLayer
+from profiler import SamplingProfiler, blockLabel
+from memtrack import MemoryTracker, formatBlock, formatLeaks
+from collector import CollectorClient
+from breaktasks import (
+    BreakTasks,
+    checkTriggers,
+    collectGarbage,
+    compactToDatabase,
+    formatReport,
+    validateBlockCsv,
+)
+
+# ---------------- CONFIG -----------------
+# -----------------------------------------
+# Every config key with its default. The keys in requiredKeys (conditions,
+# texts, file names) have no sensible default and must be given by the config.
+defaults = {
+    # Name of the paradigm, only used for printing and the plan file
+    "paradigm": None,
+    # Prefix of every data file: <saveFolder>/<filePrefix><subjectID>_<condition>.csv
+    "filePrefix": None,
+    "saveFolder": "data",
+    # Keys to identify what block condition to run (keys of conditionTypes)
+    "condition_keys": None,
+    # Number of times each block will occur
+    "blockRepetitions": 1,
+    # Keys to identify what block condition to run in training
+    "trainingCondition_keys": None,
+    # Number of times each block will run in training
+    "trainingBlockRepetitions": 1,
+    # Number of training-trials per condition
+    "trainingTrials": 3,
+    # Number of trials per block condition
+    "BlockTrials": 25,
+    # [earliest, latest] duration of dot, after last event (in frames)
+    "dotDelay": [0, 0],
+    # Blank clock face between press and report (seconds)
+    "holdtime": 4,
+    # Mandatory break between blocks (seconds)
+    "blockbreak": 60,
+    # Interstimulus Interval (seconds, [min, max])
+    "interstim": [4, 8],
+    # Rotation time of the dot (seconds per cycle)
+    "libetTime": 2.56,
+    # Presses are ignored until the dot has rotated this far (degrees) since the
+    # trial (re)started, 0 to accept presses right away
+    "lockoutAngle": 0,
+    # Show the "missed" screen and restart the rotation when there was no press
+    # after this many degrees, None to rotate until the press
+    "missAfterAngle": None,
+    # Draw lines marking the starting point and the end of the lockout
+    "markers": False,
+    # Adaptive trial counts (see adaptive.py): a condition ends once the confidence
+    # interval of its circular mean report error is narrower than ciHalfWidthMs,
+    # but not before minTrials and always at maxTrials (None = the planned blocks).
+    # Blocks of a condition that has ended are skipped.
+    "adaptive": {
+        "enabled": False,
+        "ciHalfWidthMs": 50,
+        "confidence": 0.95,
+        "minTrials": 15,
+        "maxTrials": None,
+    },
+    # Real-time mode: raise priority, give the main thread a CPU of its own and pause the
+    # garbage collector during the rotation and report loops (see realtime.py)
+    "realtimeMode": True,
+    # Run CSV/event logging, triggers and acquisition in worker processes (see workers.py)
+    "useWorkers": False,
+    # Serial port of the respiration belt (worker mode only), None = no acquisition
+    "respirationPort": None,
+    # Stream trial summaries and health metrics to a viewer (python livemonitor.py)
+    "liveMonitor": {"enabled": True, "host": "127.0.0.1", "port": 50007},
+    # Sound cues (see audiocues.py): tone in Hz, note or file, duration, volume and the
+    # trigger code sent with the cue. trialOnset starts with the first rotation frame,
+    # press confirms an accepted press, missed comes with the "missed" screen. A cue's
+    # trigger follows at the first flip triggerGapMs clear of the previous trigger.
+    "audioCues": {
+        "enabled": False,
+        "latencyMode": 3,
+        "triggerGapMs": 20,
+        "cues": {
+            "trialOnset": {"value": 880, "secs": 0.05, "volume": 0.5, "trigger": 50},
+            "press": {"value": 1320, "secs": 0.03, "volume": 0.5, "trigger": 51},
+            "missed": {"value": 220, "secs": 0.3, "volume": 0.7, "trigger": 52},
+        },
+    },
+    # Sampling profiler (see profiler.py): stacks of the main thread per phase and block,
+    # written next to the data at the end of the session as flame graph input
+    "profiler": {"enabled": False, "intervalMs": 5, "maxOverhead": 0.01},
+    # Memory snapshots at every block boundary (see memtrack.py): allocations, objects per
+    # type and GL textures, growth flagged after leakBlocks blocks in a row. Slows down
+    # allocations, for test sessions only.
+    "memoryTracking": {"enabled": False, "tracebackFrames": 1, "leakBlocks": 3},
+    # Send trial rows, the plan, block CSV files and event log segments to the lab's
+    # collector (python collector.py serve), station None = the host name
+    "collector": {"enabled": False, "host": "127.0.0.1", "port": 50008, "station": None},
+    # Display options
+    "monDistance": 60,  # Distance from subject eyes to monitor (in cm)
+    "monWidth": 30,  # Width of monitor display (in cm)
+    "windowSize": None,  # [width, height] in pixels, None = size of the monitor
+    "fullscr": False,
+    "allowGUI": False,
+    "textSize": 0.85,  # Size of text in degrees
+    "circleRadius": 2,  # Radius of circle (in degrees)
+    "tics": 12,  # Number of tics on circle
+    "stics": 60,  # Number of small tics on circle
+    "dotColor": "red",
+    "dotColorTimeOut": "#FF0000",
+    # Draw the dot, markers and fixation cross of the rotation as one batched draw call
+    # from a precomputed angle table (see dialbatch.py). Dot positions are then
+    # quantized to 1/degScale degrees, the precision the angles are saved with.
+    "batchedDial": False,
+    "instructionPos": [0, 4.0],  # position of the instruction text (degrees)
+    "instructionImage": {"pos": [0, -150], "size": [688, 322]},  # pixels
+    "instructionVideo": {"pos": [0, -160], "size": [700, 493]},  # pixels
+    # Screen texts. breakText is formatted with (blocks done, blocks to go)
+    "breakText": None,
+    "readyText": None,
+    "readyTextStyle": {},  # extra TextStim options for the ready screen
+    "missedText": "",
+    "trainingOverText": None,
+    "thankYouText": None,
+    # Questions, responses, triggers and instructions per condition
+    "conditionTypes": None,
+    # Keys that move the dot in the report (degrees per press)
+    "moveKeys": None,
+    "selectKey": ["space"],
+    "quitKeys": ["esc", "escape"],
+    # Columns written to the CSV file, in order
+    "dataCategories": None,
+}
+
+requiredKeys = [
+    "paradigm",
+    "filePrefix",
+    "condition_keys",
+    "trainingCondition_keys",
+    "breakText",
+    "readyText",
+    "trainingOverText",
+    "thankYouText",
+    "conditionTypes",
+    "moveKeys",
+    "dataCategories",
+]
+
+# Every field a trial carries (the CSV columns are picked from these)
+trialFields = [
+    "id",
+    "condition",
+    "no",
+    "dotDelay",
+    "holdTime",
+    "pressOnset",
+    "pressAngle",
+    "ansAngle",
+    "wTime",
+    "ansTime",
+    "ISI",
+    "timeOut",
+    "timeOutOnset",
+    "timeOutQuestion",
+    "stopCharacter",
+    "samplesToLastIdenticalCharacter",
+    "userError",
+    "response",
+    "rtGuard",
+    "gcTime",
+    "frameDrops",
+    "frames",
+]
+
+videoExtensions = (".mp4", ".avi", ".mov", ".mkv")
+
+
+# Load a paradigm config, fill in defaults and check it
+def loadConfig(path):
+    with open(path, encoding="utf-8") as f:
+        userConfig = json.load(f)
+    unknown = [key for key in userConfig if key not in defaults]
+    if unknown:
+        raise ValueError("{}: unknown config keys {}".format(path, unknown))
+    config = copy.deepcopy(defaults)
+    for key, value in userConfig.items():
+        if isinstance(defaults[key], dict) and isinstance(value, dict):
+            # nested options: keep the defaults of whatever the config leaves out
+            config[key].update(value)
+        else:
+            config[key] = value
+    missing = [key for key in requiredKeys if config[key] is None]
+    if missing:
+        raise ValueError("{}: missing config keys {}".format(path, missing))
+    for conid in set(config["condition_keys"] + config["trainingCondition_keys"]):
+        if conid not in config["conditionTypes"]:
+            raise ValueError("{}: no conditionTypes entry for {}".format(path, conid))
+    for category in config["dataCategories"]:
+        if category not in trialFields:
+            raise ValueError("{}: unknown data category {}".format(path, category))
+    return config
+
+
+# Monitor with the viewing distance and width of the config, for the "deg" units
+def makeMonitor(config):
+    myMon = monitors.Monitor("testMonitor")
+    myMon.setDistance(config["monDistance"])
+    myMon.setWidth(config["monWidth"])
+    return myMon
+
+
+# Make complex figure: circle + tics. Render and save as single stimulus
+def makeClockFace(win, config):
+    circleRadius = config["circleRadius"]
+    visual.Circle(win, radius=circleRadius, edges=512, lineWidth=3, lineColor="none").draw()
+    for angleDeg in range(0, 360, int(360 / config["tics"])):
+        angleRad = radians(angleDeg)
+        begin = [circleRadius * sin(angleRad), circleRadius * cos(angleRad)]
+        end = [begin[0] * 1.2, begin[1] * 1.2]
+        visual.Line(
+            win,
+            start=(begin[0], begin[1]),
+            end=(end[0], end[1]),
+            lineColor="black",
+            lineWidth=2.4,
+        ).draw()
+
+    for angleDeg in range(0, 360, int(360 / config["stics"])):
+        angleRad = radians(angleDeg)
+        begin = [circleRadius * 1.08 * sin(angleRad), circleRadius * 1.08 * cos(angleRad)]
+        end = [begin[0] * 1.1, begin[1] * 1.1]
+        visual.Line(
+            win,
+            start=(begin[0], begin[1]),
+            end=(end[0], end[1]),
+            lineColor="black",
+            lineWidth=1,
+        ).draw()
+
+    # Buffer it all in a single stimulus
+    circle = visual.BufferImageStim(win)
+    win.clearBuffer()
+    return circle
+
+
+def isVideo(filename):
+    return filename.lower().endswith(videoExtensions)
+
+
+# --------------- SESSION PLAN ----------------
+
+
+def makeBlock(config, subjectID, condition, training, rng=random):
+    if training == True:
+        # Set number of training repetitions
+        conditionRep = config["trainingTrials"]
+    else:
+        # Set number of repetitions
+        conditionRep = config["BlockTrials"]
+
+    # Update every trial with trial-specific info
+    trialList = []
+    for trialNo in range(conditionRep):
+        trial = dict((category, "") for category in trialFields)
+        trial["no"] = trialNo + 1
+        trial["id"] = subjectID
+        trial["condition"] = condition
+        trial["dotDelay"] = rng.randint(config["dotDelay"][0], config["dotDelay"][1])
+        trial["ISI"] = rng.randint(config["interstim"][0], config["interstim"][1])
+        # Angle of dot in degrees when the rotation starts (not written to the CSV)
+        trial["startAngle"] = rng.uniform(0, 360)
+        trialList.append(trial)
+    return trialList
+
+
+# Compile a config into the plan of a whole session. Every random draw of the
+# session happens here. seed: make the plan reproducible (None = random)
+def compilePlan(config, subjectID, seed=None):
+    rng = random.Random(seed)
+    # (condition, conid) pairs, conid is the key of conditionTypes
+    conditions = [
+        (x + str(y + 1), x)
+        for x in config["condition_keys"]
+        for y in range(config["blockRepetitions"])
+    ]
+    rng.shuffle(conditions)
+    conditionsT = [
+        (x + str(y + 1), x)
+        for x in config["trainingCondition_keys"]
+        for y in range(config["trainingBlockRepetitions"])
+    ]
+
+    def block(condition, conid, training):
+        return {
+            "condition": condition,
+            "conid": conid,
+            "training": training,
+            "trials": makeBlock(config, subjectID, condition, training, rng),
+        }
+
+    training = [block(condition, conid, True) for condition, conid in conditionsT]
+    main = []
+    for counter, (condition, conid) in enumerate(conditions):
+        if counter:
+            # "-" marks a break between blocks
+            main.append({"condition": "-", "counter": counter})
+        main.append(block(condition, conid, False))
+    return {
+        "paradigm": config["paradigm"],
+        "subjectID": subjectID,
+        "seed": seed,
+        "conditions": [condition for condition, conid in conditions],
+        "training": training,
+        "main": main,
+    }
+
+
+def savePlan(plan, path):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=1)
+
+
+# Intro dialogue
+def askSubjectID():
+    dialogue = gui.Dlg()
+    dialogue.addField("subjectID")
+    dialogue.show()
+    if dialogue.OK:
+        if dialogue.data[0].isdigit():
+            return dialogue.data[0]
+        print("SUBJECT ID SHOULD BE A DIGIT")
+    core.quit()
+
+
+# ---------------- SESSION -----------------
+
+
+class LibetSession(object):
+    def __init__(self, config, subjectID):
+        self.config = config
+        self.subjectID = subjectID
+        self.counter = 0  # Keep track of experiment progress
+        self.nBlocks = len(config["condition_keys"]) * config["blockRepetitions"]
+        self.useWorkers = config["useWorkers"]
+
+        # --------get the first attached XID device------
+        self.dev = None
+        if not self.useWorkers:
+            devices = pyxid2.get_xid_devices()
+            if devices:
+                print(devices)
+                self.dev = devices[0]
+                self.dev.reset_base_timer()
+                self.dev.reset_rt_timer()
+            else:
+                print("No XID devices detected")
+
+        # Make folder for data
+        self.saveFolder = config["saveFolder"]
+        if not os.path.isdir(self.saveFolder):
+            os.makedirs(self.saveFolder)
+        self.filePrefix = self.saveFolder + "/" + config["filePrefix"] + str(subjectID)
+        # Uploads to the collector, journaled in the outbox until acknowledged (see collector.py)
+        self.collector = CollectorClient(
+            os.path.join(self.saveFolder, "outbox"),
+            config["collector"]["host"],
+            config["collector"]["port"],
+            station=config["collector"]["station"],
+            enabled=config["collector"]["enabled"],
+        )
+
+        # Binary log of every flip, key, trigger and screen of the session (see eventlog.py),
+        # rotated into a new segment at every block break
+        self.eventLogPath = self.filePrefix + "_events.bin"
+        self.eventLogSegment = 0
+        if self.useWorkers:
+            self.workers = SessionWorkers(
+                self.eventLogPath,
+                clock=core.getTime,
+                respirationPort=config["respirationPort"],
+            )
+            self.eventLog = self.workers.eventLog
+        else:
+            self.workers = None
+            self.eventLog = EventLog(self.eventLogPath, clock=core.getTime)
+        # (CSV file, rows written) of the last finished main block, checked in the break
+        self.lastBlock = None
+
+        self.profiler = SamplingProfiler(
+            enabled=config["profiler"]["enabled"],
+            interval=config["profiler"]["intervalMs"] / msScale,
+            maxOverhead=config["profiler"]["maxOverhead"],
+        )
+        self.profiler.start()
+
+        liveMonitor = config["liveMonitor"]
+        self.monitor = LivePublisher(
+            liveMonitor["host"], liveMonitor["port"], enabled=liveMonitor["enabled"]
+        )
+        # Duration of the last trigger call (non-worker mode)
+        self.triggerLatency = None
+        # When the last trigger was requested (core.getTime), keeps cue triggers clear of it
+        self.lastTrigger = None
+
+        # Clocks
+        self.trialClock = core.Clock()
+        self.TimeOutClock = core.Clock()
+
+        # Online report error estimate and stopping rule per condition
+        adaptive = config["adaptive"]
+        self.stoppingRule = StoppingRule(
+            enabled=adaptive["enabled"],
+            ciHalfWidth=adaptive["ciHalfWidthMs"] / msScale * 360 / config["libetTime"],
+            confidence=adaptive["confidence"],
+            minTrials=adaptive["minTrials"],
+            maxTrials=adaptive["maxTrials"],
+        )
+
+        memoryTracking = config["memoryTracking"]
+        self.memory = MemoryTracker(
+            enabled=memoryTracking["enabled"],
+            tracebackFrames=memoryTracking["tracebackFrames"],
+            leakBlocks=memoryTracking["leakBlocks"],
+        )
+        self.memory.start()
+
+        self._makeStimuli()
+        self.rtGuard = RealtimeGuard(enabled=config["realtimeMode"])
+
+        # Preloaded sound cues, None when off
+        self.audioCues = None
+        if config["audioCues"]["enabled"]:
+            self.audioCues = AudioCues(
+                self.win,
+                config["audioCues"]["cues"],
+                self.eventLog,
+                sendTrigger=self.sendTrigger,
+                latencyMode=config["audioCues"]["latencyMode"],
+                triggerGap=config["audioCues"]["triggerGapMs"] / msScale,
+            )
+
+        # Draw everything the session uses offscreen (including the first frame of every
+        # instruction video) so the first trial does not pay for texture uploads and shader
+        # compilation, then wait for steady flip timing
+        instruVideo = config["instructionVideo"]
+        warmupMovies = [
+            visual.MovieStim3(
+                self.win, videoFile, pos=instruVideo["pos"], size=instruVideo["size"], noAudio=True
+            )
+            for videoFile in sorted(set(self.instruVideos.values()))
+        ]
+        warmUp(
+            self.win,
+            self.rotationStims
+            + [self.cross_ISI, self.clockDotTimeOut]
+            + list(self.instruImages.values())
+            + self.texts.values(),
+            movies=warmupMovies,
+        )
+        self.memory.snapshot("setup")
+
+    # -------------- STIMULI ----------------
+    def _makeStimuli(self):
+        config = self.config
+        circleRadius = config["circleRadius"]
+        textSize = config["textSize"]
+        fixationSize = sqrt(circleRadius) * 0.5  # size of fixation point "+"
+        dotSize = circleRadius / 5  # Size of dot (in degrees)
+        self.circleRadius = circleRadius
+
+        myMon = makeMonitor(config)
+        self.win = win = visual.Window(
+            monitor=myMon,
+            size=config["windowSize"] or myMon.getSizePix(),
+            fullscr=config["fullscr"],
+            allowGUI=config["allowGUI"],
+            color="white",
+            units="deg",
+        )
+        self.clockDot = visual.PatchStim(
+            win=win, mask="circle", color=config["dotColor"], tex=None, size=dotSize
+        )
+        self.clockDotTimeOut = visual.PatchStim(
+            win=win, mask="circle", color=config["dotColorTimeOut"], tex=None, size=dotSize
+        )
+        # Lines marking the starting point and the end of the lockout, moved every trial
+        self.markerLines = []
+        if config["markers"]:
+            for i in range(2):
+                self.markerLines.append(
+                    visual.Line(
+                        win,
+                        start=(0, 0),
+                        end=(0, circleRadius * 1.08),
+                        lineColor=(0, 0, 0, 0.5),
+                        lineWidth=2,
+                    )
+                )
+
+        # Instruction images (loaded once) and videos (loaded per block)
+        self.instruImages = {}
+        self.instruVideos = {}
+        for conid in set(config["condition_keys"] + config["trainingCondition_keys"]):
+            instruFile = config["conditionTypes"][conid]["instru_img"]
+            if isVideo(instruFile):
+                self.instruVideos[conid] = instruFile
+            else:
+                self.instruImages[conid] = visual.ImageStim(
+                    win=win,
+                    image=instruFile,
+                    pos=config["instructionImage"]["pos"],
+                    size=config["instructionImage"]["size"],
+                    units="pix",
+                )
+
+        # get actual frame rate to ensure smooth rotation.
+        frameDur = []
+        for frameN in range(100):
+            frameDur.append(win.monitorFramePeriod)
+        self.actual_frame_rate = 1.0 / average(frameDur)
+        # A flip interval longer than this counts as a dropped frame
+        self.dropLimit = 1.5 / self.actual_frame_rate
+        # Degrees shift per monitor-frame: 360/LibetTime/framerate
+        self.dotStep = 360 / config["libetTime"] / self.actual_frame_rate
+
+        self.circle = makeClockFace(win, config)
+
+        # interstimulus interval
+        self.cross_ISI = visual.TextStim(
+            win=win,
+            name="cross_ISI",
+            text="+",
+            font="Arial",
+            pos=(0, 0),
+            height=2,
+            wrapWidth=None,
+            ori=0.0,
+            color="black",
+            colorSpace="rgb",
+            opacity=None,
+            languageStyle="LTR",
+            depth=-1.0,
+        )
+
+        # Lay out and rasterize every string the session shows, once, before the first trial
+        self.texts = texts = TextCache(win, color="black")
+        texts.add("fixation", "+", height=fixationSize, antialias=False)
+        for conid in set(config["condition_keys"] + config["trainingCondition_keys"]):
+            conditionType = config["conditionTypes"][conid]
+            texts.add(
+                ("instruction", conid),
+                conditionType["instruction"],
+                height=textSize,
+                pos=config["instructionPos"],
+                wrapWidth=50,
+            )
+            texts.add(
+                ("question", conid),
+                conditionType["question"],
+                height=textSize,
+                pos=(0, circleRadius * 4),
+                wrapWidth=50,
+            )
+            for name, preparation in conditionType.get("preparation", {}).items():
+                texts.add(
+                    ("preparation", conid, name),
+                    preparation["text"],
+                    color=preparation["color"],
+                    height=2,
+                    font="Arial",
+                    pos=(0, 0),
+                    wrapWidth=None,
+                )
+        if config["adaptive"]["enabled"]:
+            # Skipped blocks change how many are left, any split can be shown
+            breakCounts = [
+                (n, toGo)
+                for n in range(1, self.nBlocks + 1)
+                for toGo in range(0, self.nBlocks - n + 1)
+            ]
+        else:
+            breakCounts = [(n, self.nBlocks - n) for n in range(1, self.nBlocks + 1)]
+        texts.addFormatted(
+            "break", config["breakText"], breakCounts, height=fixationSize, antialias=False
+        )
+        readyStyle = {"height": fixationSize, "antialias": False}
+        readyStyle.update(config["readyTextStyle"])
+        texts.add("ready", config["readyText"], **readyStyle)
+        if config["missAfterAngle"] is not None:
+            texts.add("missed", config["missedText"], height=fixationSize, antialias=False)
+        for key in ["trainingOver", "thankYou"]:
+            texts.add(
+                key,
+                config[key + "Text"],
+                height=textSize,
+                pos=(0, circleRadius * 4),
+                wrapWidth=50,
+            )
+        texts.prepare()
+
+        # Everything drawn during the rotation
+        self.rotationStims = [self.circle, texts["fixation"]] + self.markerLines + [self.clockDot]
+        self.dialLayer = None
+        if config["batchedDial"]:
+            self.dialLayer = DialLayer(
+                win,
+                circleRadius,
+                dotSize,
+                dotColor=config["dotColor"],
+                fixationSize=fixationSize,
+                markers=config["markers"],
+                steps=360 * degScale,
+            )
+            self.rotationStims = [self.circle, self.dialLayer]
+
+    # ------------- FUNCTIONS ---------------
+
+    # Send a trigger to the StimTracker (if there is one) and log it
+    def sendTrigger(self, bitmask):
+        self.lastTrigger = core.getTime()
+        if self.useWorkers:
+            # sent and logged by the trigger worker
+            self.workers.trigger(bitmask)
+            return
+        sent = 0
+        if self.dev is not None:
+            requestTime = core.getTime()
+            self.dev.activate_line(bitmask=bitmask)
+            self.triggerLatency = core.getTime() - requestTime
+            sent = 1
+        self.eventLog.log("trigger", bitmask, sent)
+
+    # Draw a dot on the circle, given an angle
+    def drawDot(self, angleDeg, timeOut):
+        angleRad = radians(angleDeg)
+        x = self.circleRadius * sin(angleRad)
+        y = self.circleRadius * cos(angleRad)
+        if timeOut == False:
+            self.clockDot.setPos([x, y])
+            self.clockDot.draw()
+        else:
+            self.clockDotTimeOut.setPos([x, y])
+            self.clockDotTimeOut.draw()
+
+    def quit(self):
+        self.eventLog.log("key", keyCodes["quit"])
+        core.quit()
+
+    # Interval break between blocks
+    # toGo: number of blocks still to run
+    def runBreak(self, toGo):
+        config = self.config
+        win, eventLog = self.win, self.eventLog
+        self.monitor.publish("break", done=self.counter, toGo=toGo)
+        self.profiler.tag("break")
+        self.texts.draw(("break", self.counter, toGo))
+        eventLog.log("screen", screenCodes["break"], self.counter, win.flip())
+
+        # Housekeeping while the break screen is up (see breaktasks.py), the rest of
+        # the break is slept
+        tasks = BreakTasks()
+        closedSegment = []
+        tasks.add("rotate event log", self.rotateEventLog, closedSegment)
+        if self.lastBlock is not None:
+            saveFile, rows = self.lastBlock
+            tasks.add("validate data", validateBlockCsv, saveFile, config["dataCategories"], rows)
+            tasks.add(
+                "compact data",
+                compactToDatabase,
+                saveFile,
+                os.path.join(self.saveFolder, "trials.sqlite"),
+            )
+        tasks.add("check triggers", self.checkTriggers, closedSegment)
+        tasks.add("garbage collection", collectGarbage)
+        report, left = tasks.run(config["blockbreak"])
+        print("Break {} tasks:\n{}".format(self.counter, formatReport(report, left)))
+        for index, task in enumerate(report):
+            eventLog.log("breakTask", index, task["seconds"])
+            for problem in task["problems"]:
+                self.monitor.publish("health", text="{}: {}".format(task["name"], problem))
+        self.monitor.publish(
+            "breakTasks",
+            seconds=dict((task["name"], round(task["seconds"], 3)) for task in report),
+            leftS=round(left, 2),
+        )
+        time.sleep(max(0.0, left))
+        self.texts.draw("ready")
+        eventLog.log("screen", screenCodes["ready"], self.counter, win.flip())
+        event.waitKeys(keyList=config["selectKey"])
+        eventLog.log("key", keyCodes["select"])
+
+    # Continue the event log in the next segment, adds the closed one to closedSegment
+    def rotateEventLog(self, closedSegment):
+        self.eventLogSegment += 1
+        closedSegment.append(
+            self.eventLog.rotate(eventLogSegment(self.eventLogPath, self.eventLogSegment))
+        )
+        self.collector.sendFile(closedSegment[0])
+
+    def checkTriggers(self, closedSegment):
+        if not closedSegment:
+            return ["event log was not rotated, nothing to check"]
+        conditionTriggers = dict(
+            (conditionType["trialstart"], conditionType["eegLine"])
+            for conditionType in self.config["conditionTypes"].values()
+        )
+        return checkTriggers(readEventLog(closedSegment[0]), conditionTriggers)
+
+    # block: name the profiler counts the instruction under
+    def showInstruction(self, conid, block=None):
+        config = self.config
+        conditionType = config["conditionTypes"][conid]
+        win, eventLog, texts = self.win, self.eventLog, self.texts
+        self.profiler.tag("instruction", block or conid)
+        if conid in self.instruImages:
+            self.instruImages[conid].draw()
+            texts.draw(("instruction", conid))
+            eventLog.log("screen", screenCodes["instruction"], 0, win.flip())
+            event.waitKeys(keyList=conditionType["ansKey"])
+            return
+        video_stim = visual.MovieStim3(
+            win,
+            self.instruVideos[conid],
+            pos=config["instructionVideo"]["pos"],
+            size=config["instructionVideo"]["size"],
+            flipVert=False,
+            flipHoriz=False,
+            loop=True,
+        )
+        texts.draw(("instruction", conid))
+        video_stim.play()
+        eventLog.log("screen", screenCodes["instruction"], 1, win.flip())
+        # Start loop to continuously update video frames
+        while video_stim.status != visual.FINISHED:
+            texts.draw(("instruction", conid))
+            video_stim.draw()
+            win.flip()
+            # check for response and exit loop if ansKey is pressed
+            if event.getKeys(keyList=conditionType["ansKey"]):
+                break
+        video_stim.stop()
+        video_stim.seek(0.0)
+        # The video teardown can evict the dial's textures, draw them again
+        # (without flipping) before the ISI so the first rotation frames don't drop
+        drawOffscreen(win, self.rotationStims, flip=False)
+
+    # Run a block of trials and save results
+    def runBlock(self, block):
+        config = self.config
+        win, eventLog, texts, rtGuard = self.win, self.eventLog, self.texts, self.rtGuard
+        audioCues, dialLayer, profiler = self.audioCues, self.dialLayer, self.profiler
+        condition, conid, training = block["condition"], block["conid"], block["training"]
+        profileBlock = blockLabel(condition, training)
+        conditionType = config["conditionTypes"][conid]
+        ansKey = conditionType["ansKey"]
+        quitKeys = config["quitKeys"]
+        dotStep = self.dotStep
+        lockoutAngle = config["lockoutAngle"]
+        missAfterAngle = config["missAfterAngle"]
+        timeOutLogic = False
+        framePeriod = 1.0 / self.actual_frame_rate
+
+        # Set up .csv save function
+        if not training:
+            saveFile = self.filePrefix + "_" + condition + ".csv"  # Filename for save-data
+            # The writer function to csv
+            if self.useWorkers:
+                csvWriter = self.workers.csvWriter(saveFile)
+            else:
+                csvFile = open(saveFile, "w", newline="")
+                csvWriter = csv.writer(csvFile, delimiter=",").writerow
+            # Writes title-row in csv
+            csvWriter(config["dataCategories"])
+            rowsWritten = 0
+
+        eventLog.log("block", conditionType["trialstart"], int(training))
+        self.monitor.publish("block", condition=condition, training=training)
+        self.showInstruction(conid, profileBlock)
+
+        # Loop through trials
+        for trial in block["trials"]:
+            profiler.tag("isi", profileBlock, trial["no"])
+            self.cross_ISI.draw()
+            eventLog.log("screen", screenCodes["isi"], trial["ISI"], win.flip())
+            rtGuard.idle(trial["ISI"])  # garbage collection runs here, not during the rotation
+
+            # Show the preparation screens
+            for name, preparation in conditionType.get("preparation", {}).items():
+                texts.draw(("preparation", conid, name))
+                eventLog.log("screen", screenCodes["preparation"], 0, win.flip())
+                core.wait(preparation["duration"])
+
+            dotAngle = initAngle = trial["startAngle"]
+            rotation = Rotation(
+                initAngle,
+                dotStep,
+                lockoutAngle=lockoutAngle,
+                missAfterAngle=missAfterAngle,
+                dotDelay=trial["dotDelay"],
+            )
+            if self.dialLayer is not None:
+                self.dialLayer.setMarkers([initAngle, initAngle + lockoutAngle])
+            for markerLine, offset in zip(self.markerLines, [0, lockoutAngle]):
+                markerLine.setEnd(
+                    [
+                        self.circleRadius * 1.08 * sin(radians(initAngle + offset)),
+                        self.circleRadius * 1.08 * cos(radians(initAngle + offset)),
+                    ]
+                )
+            frameDrops = 0
+            lastFlip = previousFlip = None
+            self.triggerLatency = None
+            if self.useWorkers:
+                triggersSent = self.workers.triggerStats()[0]
+
+            # Show rotating dot and handle events
+            event.clearEvents()
+            self.trialClock.reset()
+            trialStart = core.getTime()  # zero of the trial clock, on the flip clock
+            self.TimeOutClock.reset()
+            rtGuard.enter()
+            trial["rtGuard"] = int(rtGuard.active)
+            eventLog.log("trial", trial["no"], initAngle, trialStart)
+            profiler.tag("rotation", profileBlock, trial["no"])
+            eventLog.log("screen", screenCodes["rotation"])
+            self.sendTrigger(conditionType["trialstart"])
+            if audioCues is not None:
+                audioCues.play("trialOnset", atFlip=True)
+            frameN = 0
+            rotationOnset = None  # first flip of the rotation
+            pressFlip = None  # flip after which the press was detected
+            cpuStart = time.process_time()
+            while True:
+                if rotation.missed():
+                    # No press within the allowed rotation: tell the subject and redo the trial
+                    profiler.tag("missed", profileBlock, trial["no"])
+                    texts.draw("missed")
+                    if audioCues is not None:
+                        audioCues.play("missed", atFlip=True)
+                    missedOnset = win.flip()
+                    if audioCues is not None:
+                        audioCues.flush(self.lastTrigger)
+                    eventLog.log("missed", trial["no"], dotAngle, missedOnset)
+                    eventLog.log("screen", screenCodes["missed"], 0, missedOnset)
+                    self.monitor.publish("missed", condition=condition, no=trial["no"])
+                    event.waitKeys(keyList=config["selectKey"])
+                    if audioCues is not None:
+                        # only the missed cue: the others are read back with the hold screen
+                        audioCues.collect({"missed": missedOnset})
+                    eventLog.log("key", keyCodes["select"])
+                    eventLog.log("screen", screenCodes["rotation"])
+                    profiler.tag("rotation", profileBlock, trial["no"])
+                    rotation.restart()
+                    lastFlip = None
+                    continue
+
+                dotAngle = rotation.advance()
+                if dialLayer is not None:
+                    self.circle.draw()
+                    dialLayer.draw(dotAngle)
+                else:
+                    for stim in self.rotationStims[:-1]:
+                        stim.draw()
+                    self.drawDot(dotAngle, timeOutLogic)
+                frameN += 1
+                flipTime = win.flip()
+                eventLog.log("flip", frameN, dotAngle, flipTime)
+                if audioCues is not None:
+                    audioCues.flipped(flipTime, self.lastTrigger, framePeriod)
+                if lastFlip is not None and flipTime - lastFlip > self.dropLimit:
+                    frameDrops += 1
+                if rotationOnset is None:
+                    rotationOnset = flipTime
+                previousFlip, lastFlip = lastFlip, flipTime
+
+                if not rotation.accepting():
+                    # Too early: presses don't count
+                    event.clearEvents()
+                    continue
+
+                # Record press
+                response = event.getKeys(keyList=ansKey + quitKeys, timeStamped=self.trialClock)
+                # Only react on first response to this trial
+                if len(response) and not trial["pressOnset"]:
+                    if response[-1][0] in quitKeys:
+                        self.quit()
+                    if response[-1][0] in ansKey:
+                        self.sendTrigger(conditionType["eegLine"])
+                        if audioCues is not None:
+                            audioCues.play("press")
+                            pressFlip = flipTime
+                    trial["pressOnset"] = int((response[-1][1]) * msScale) / msScale
+                    eventLog.log("key", keyCodes["press"], response[-1][1])
+                    # the frame on screen nearest to the press
+                    trial["pressAngle"] = rotation.press(
+                        trialStart + response[-1][1], flipTime, previousFlip
+                    )
+                    trial["holdTime"] = int(config["holdtime"])
+
+                # The little time after last event, where the dot keeps rotating.
+                if rotation.delayFrames:
+                    self.TimeOutClock.reset()
+                if rotation.finished():
+                    break
+            # CPU time per rotation frame (all threads of the process)
+            eventLog.log("cpu", trial["no"], (time.process_time() - cpuStart) / max(1, frameN))
+
+            # draws a blank clock face to cover the location for the rotating clock dot briefly.
+            profiler.tag("hold", profileBlock, trial["no"])
+            self.circle.draw()
+            texts.draw("fixation")
+            holdFlip = win.flip()
+            eventLog.log("screen", screenCodes["hold"], 0, holdFlip)
+            audioLatency = {}
+            if audioCues is not None:
+                # the press cue's trigger can still be waiting out the gap after the
+                # eegLine trigger, and no flip follows until the next trial
+                audioCues.flush(self.lastTrigger)
+                # onset of the cue against the flip it belongs to (the press: the
+                # flip after which it was detected)
+                audioLatency = audioCues.collect(
+                    {"trialOnset": rotationOnset, "press": pressFlip}
+                )
+            time.sleep(config["holdtime"])
+            self.trialClock.reset()
+            eventLog.log("screen", screenCodes["report"])
+            profiler.tag("report", profileBlock, trial["no"])
+
+            # Subjects selects location of target event
+            moveKeys = config["moveKeys"]
+            while True:
+                self.circle.draw()
+                texts.draw(("question", conid))
+                texts.draw("fixation")
+                self.drawDot(dotAngle, trial["timeOut"] == "yes")
+                win.flip()
+
+                # Handle responses: quit, move or answer
+                response = event.waitKeys(
+                    keyList=list(moveKeys.keys()) + config["selectKey"] + quitKeys
+                )
+                if response[-1] in quitKeys:
+                    self.quit()
+
+                if response[-1] in moveKeys:
+                    dotAngle += moveKeys[response[-1]]
+                    if dotAngle > 360:
+                        dotAngle = dotAngle - 360
+                    if dotAngle < 0:
+                        dotAngle = 360 + dotAngle
+                    eventLog.log("key", keyCodes["move"], dotAngle)
+                if response[-1] in config["selectKey"]:
+                    eventLog.log("key", keyCodes["select"], dotAngle)
+                    trial["ansTime"] = int((self.trialClock.getTime()) * msScale) / msScale
+                    trial["ansAngle"] = int((dotAngle) * degScale) / degScale
+                    trial["wTime"] = wTime(
+                        trial["pressAngle"], trial["ansAngle"], config["libetTime"]
+                    )
+                    break
+            rtGuard.exit()
+            # GC work since the previous trial (ms)
+            trial["gcTime"] = int(rtGuard.takeGcTime() * msScale * msScale) / msScale
+            trial["frameDrops"] = frameDrops
+            trial["frames"] = frameN
+
+            # Trial summary for the experimenter
+            if self.useWorkers:
+                # the trigger worker has sent the trial's triggers by now
+                sent, latency = self.workers.triggerStats()
+                if sent > triggersSent:
+                    self.triggerLatency = latency
+            toMs = config["libetTime"] / 360 * msScale
+            self.monitor.publish(
+                "trial",
+                condition=condition,
+                training=training,
+                no=trial["no"],
+                pressOnset=trial["pressOnset"],
+                reportErrorMs=circularDifference(trial["ansAngle"], trial["pressAngle"]) * toMs,
+                frameDrops=frameDrops,
+                frames=frameN,
+                triggerLatencyMs=None
+                if self.triggerLatency is None
+                else self.triggerLatency * msScale,
+                gcTime=trial["gcTime"],
+                audioLatencyMs=dict(
+                    (name, round(latency * msScale, 2)) for name, latency in audioLatency.items()
+                ),
+            )
+
+            # End of trial: save by appending data to csv. If training: stop after training trials
+            if self.useWorkers:
+                for problem in self.workers.checkHealth():
+                    self.monitor.publish("health", text=problem)
+            if not training:
+                row = [trial[category] for category in config["dataCategories"]]
+                csvWriter(row)
+                rowsWritten += 1
+                self.collector.sendRow(saveFile, rowsWritten, row)
+                error = circularDifference(trial["ansAngle"], trial["pressAngle"])
+                if self.stoppingRule.update(conid, error):
+                    n, mean, ciHalfWidth = self.stoppingRule.summary(conid)
+                    print(
+                        "{} done after {} trials: report error {:.0f} ms +/- {:.0f} ms".format(
+                            conid, n, mean * toMs, ciHalfWidth * toMs
+                        )
+                    )
+                    eventLog.log("conditionStop", conditionType["trialstart"], n)
+                    self.monitor.publish(
+                        "conditionStop",
+                        condition=conid,
+                        trials=n,
+                        meanMs=round(mean * toMs, 1),
+                        ciMs=round(ciHalfWidth * toMs, 1),
+                    )
+                    break
+            else:
+                if trial["no"] >= config["trainingTrials"]:
+                    break
+        if not training:
+            if self.useWorkers:
+                self.workers.csvClose(saveFile)
+            else:
+                csvFile.close()
+            self.lastBlock = (saveFile, rowsWritten)
+            self.collector.sendFile(saveFile)
+        memory = self.memory.snapshot(("training " if training else "") + condition)
+        if memory is not None:
+            print("Memory:\n" + formatBlock(memory))
+
+    def showMessage(self, key, screenCode=None):
+        self.texts.draw(key)
+        flipTime = self.win.flip()
+        if screenCode is not None:
+            self.eventLog.log("screen", screenCode, 0, flipTime)
+        event.waitKeys()
+
+    # ---------- RUN EXPERIMENT -------------
+    def run(self, plan):
+        print(plan["conditions"])
+        print([block["condition"] for block in plan["training"]])
+        for block in plan["training"]:
+            self.runBlock(block)
+        self.showMessage("trainingOver")
+        ranSinceBreak = False
+        for index, block in enumerate(plan["main"]):
+            if block["condition"] != "-":
+                # Blocks of conditions the stopping rule has ended are skipped
+                if not self.stoppingRule.stopped(block["conid"]):
+                    self.runBlock(block)
+                    self.counter += 1
+                    ranSinceBreak = True
+                continue
+            toGo = len(
+                [
+                    later
+                    for later in plan["main"][index + 1 :]
+                    if later["condition"] != "-"
+                    and not self.stoppingRule.stopped(later["conid"])
+                ]
+            )
+            # "-": break, unless nothing ran since the last one or nothing is left
+            if ranSinceBreak and toGo:
+                self.runBreak(toGo)
+                ranSinceBreak = False
+        self.monitor.publish("end", blocks=self.counter)
+        self.showMessage("thankYou", screenCodes["end"])
+        self.close()
+
+    def close(self):
+        self.profiler.tag("end")
+        summary = self.profiler.write(self.filePrefix)
+        if summary is not None:
+            print(
+                "Profiler: {} samples, overhead {:.2%} (python profiler.py {}_profile.json)".format(
+                    summary["samples"], summary["overhead"], self.filePrefix
+                )
+            )
+        if self.memory.report(self.filePrefix) is not None:
+            print(
+                "Memory report {}_memory.json:\n{}".format(
+                    self.filePrefix, formatLeaks(self.memory.leaks())
+                )
+            )
+        self.eventLog.close()
+        if self.useWorkers:
+            self.workers.stop()
+        self.collector.sendFile(eventLogSegment(self.eventLogPath, self.eventLogSegment))
+        self.collector.close()
+        self.rtGuard.close()
+        self.monitor.close()
+        if self.audioCues is not None:
+            self.audioCues.close()
+        if self.dialLayer is not None:
+            self.dialLayer.close()
+
+
+# Run a whole session from a config file
+def runExperiment(configPath, seed=None):
+    config = loadConfig(configPath)
+    subjectID = askSubjectID()
+    plan = compilePlan(config, subjectID, seed)
+    session = LibetSession(config, subjectID)
+    savePlan(plan, session.filePrefix + "_plan.json")
+    session.collector.sendFile(session.filePrefix + "_plan.json")
+    session.run(plan)
+    core.quit()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python engine.py <config.json>")
+        sys.exit(1)
+    runExperiment(sys.argv[1])
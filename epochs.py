@@ -0,0 +1,439 @@
+# --------------- EEG EPOCHS ----------------
+# ------------------------------------------
+# Cuts readiness-potential epochs out of BDF/EDF recordings, keyed on the
+# trigger codes the experiment sends: trialstart (10/20/30/40) at the
+# start of every rotation and eegLine (11/21/31/41) at the press. Trials
+# are matched to the rows of the session's CSV files by condition and
+# trial number, in the block order of the session plan.
+#
+# Recordings are memory-mapped and read in chunks of data records, so a
+# multi-GB file is never loaded as a whole. Every condition's epochs are
+# written into one contiguous float32 array (epochs x channels x samples)
+# in a .npy file, next to a CSV listing the trial of each epoch.
+#
+#     python epochs.py extract recording.bdf data/libetrandom_12 configs/random_finger.json out/
+#     python epochs.py synthetic out/               # a small made-up session to try it on
+import argparse
+import csv
+import json
+import os
+
+from numpy import (
+    arange,
+    array,
+    concatenate,
+    exp,
+    flatnonzero,
+    float32,
+    frombuffer,
+    int16,
+    int32,
+    memmap,
+    random,
+    sin,
+    uint8,
+    zeros,
+)
+from numpy.lib.format import open_memmap
+
+# Bytes of data records read at a time when scanning for triggers
+chunkBytes = 16 * 1024 * 1024
+
+
+# ------------- READER ---------------
+
+
+class Recording(object):
+    # A BDF (24 bit) or EDF (16 bit) file, data records memory-mapped
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            fixed = f.read(256)
+            self.bdf = fixed[:1] == b"\xff"
+            self.sampleBytes = 3 if self.bdf else 2
+            self.headerBytes = int(fixed[184:192])
+            self.nRecords = int(fixed[236:244])
+            self.recordDuration = float(fixed[244:252])
+            nSignals = int(fixed[252:256])
+            signalHeader = f.read(256 * nSignals)
+
+        def field(offset, width):
+            start = offset * nSignals
+            return [
+                signalHeader[start + i * width : start + (i + 1) * width].decode("latin-1").strip()
+                for i in range(nSignals)
+            ]
+
+        self.labels = field(0, 16)
+        physicalMin = [float(x) for x in field(104, 8)]
+        physicalMax = [float(x) for x in field(112, 8)]
+        digitalMin = [float(x) for x in field(120, 8)]
+        digitalMax = [float(x) for x in field(128, 8)]
+        self.samplesPerRecord = [int(x) for x in field(216, 8)]
+        self.gain = [
+            (pMax - pMin) / (dMax - dMin)
+            for pMin, pMax, dMin, dMax in zip(physicalMin, physicalMax, digitalMin, digitalMax)
+        ]
+        self.offset = [pMin - dMin * g for pMin, dMin, g in zip(physicalMin, digitalMin, self.gain)]
+        # byte offset of every signal inside a data record
+        self.signalOffsets = [0]
+        for n in self.samplesPerRecord:
+            self.signalOffsets.append(self.signalOffsets[-1] + n * self.sampleBytes)
+        self.recordBytes = self.signalOffsets[-1]
+        if self.nRecords < 0:  # -1 while a recording was still being written
+            self.nRecords = (os.path.getsize(path) - self.headerBytes) // self.recordBytes
+        self.data = memmap(
+            path,
+            dtype=uint8,
+            mode="r",
+            offset=self.headerBytes,
+            shape=(self.nRecords, self.recordBytes),
+        )
+
+    def rate(self, signal):
+        return self.samplesPerRecord[signal] / self.recordDuration
+
+    def signal(self, label):
+        if label not in self.labels:
+            raise ValueError("{}: no signal {}, has {}".format(self.path, label, self.labels))
+        return self.labels.index(label)
+
+    # Digital samples of a signal in records [first, last), as int32
+    def digital(self, signal, first, last):
+        raw = self.data[first:last, self.signalOffsets[signal] : self.signalOffsets[signal + 1]]
+        raw = raw.reshape(-1)
+        if not self.bdf:
+            return frombuffer(raw.tobytes(), dtype="<i2").astype(int32)
+        triplets = raw.reshape(-1, 3).astype(int32)
+        values = triplets[:, 0] | (triplets[:, 1] << 8) | (triplets[:, 2] << 16)
+        return values - ((values & 0x800000) << 1)  # sign extend 24 bits
+
+    # Physical samples (e.g. microvolt) of a signal in records [first, last)
+    def physical(self, signal, first, last):
+        return self.digital(signal, first, last) * self.gain[signal] + self.offset[signal]
+
+
+# Trigger onsets (sample index, code) in a trigger channel, read chunk by chunk.
+# mask: bits carrying the codes (BioSemi Status: the lower 16)
+def findTriggers(recording, label="Status", mask=0xFFFF):
+    signal = recording.signal(label)
+    perRecord = recording.samplesPerRecord[signal]
+    step = max(1, chunkBytes // recording.recordBytes)
+    samples = []
+    codes = []
+    previous = 0
+    for first in range(0, recording.nRecords, step):
+        last = min(recording.nRecords, first + step)
+        values = recording.digital(signal, first, last) & mask
+        # an onset is every change to a non-zero code
+        before = concatenate([[previous], values[:-1]])
+        onsets = flatnonzero((values != before) & (values != 0))
+        samples.append(onsets + first * perRecord)
+        codes.append(values[onsets])
+        previous = values[-1]
+    return concatenate(samples), concatenate(codes)
+
+
+# ------------- MATCHING ---------------
+
+
+# Match the triggers to the session's trials. Every trialstart code starts a
+# trial of its condition, the first eegLine code after it is the press.
+# Training trials (not saved) are skipped, the rest are matched, per condition,
+# to the CSV rows in the block order of the session plan.
+# Returns one dict per matched trial: conid, condition, no, trialstart and
+# press sample; and a list of problems.
+def matchTrials(samples, codes, plan, config, csvPrefix):
+    conditionTypes = config["conditionTypes"]
+    byTrialstart = dict((ct["trialstart"], conid) for conid, ct in conditionTypes.items())
+    # trials in the recording, per condition: [trialstart sample, press sample or None]
+    recorded = dict((conid, []) for conid in conditionTypes)
+    current = currentConid = None
+    for sample, code in zip(samples.tolist(), codes.tolist()):
+        if code in byTrialstart:
+            currentConid = byTrialstart[code]
+            current = [sample, None]
+            recorded[currentConid].append(current)
+        elif (
+            current is not None
+            and current[1] is None
+            and code == conditionTypes[currentConid]["eegLine"]
+        ):
+            current[1] = sample
+    # trials in the data files, per condition, in session order
+    training = dict((conid, 0) for conid in conditionTypes)
+    for block in plan["training"]:
+        training[block["conid"]] += min(len(block["trials"]), config.get("trainingTrials", 3))
+    saved = dict((conid, []) for conid in conditionTypes)
+    for block in plan["main"]:
+        if block["condition"] == "-":
+            continue
+        path = "{}_{}.csv".format(csvPrefix, block["condition"])
+        if not os.path.exists(path):
+            continue  # skipped by the adaptive stopping rule
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                saved[block["conid"]].append((block["condition"], int(row["no"])))
+
+    trials = []
+    problems = []
+    for conid in conditionTypes:
+        inRecording = recorded[conid][training[conid] :]
+        if len(inRecording) != len(saved[conid]):
+            problems.append(
+                "{}: {} trials in the recording (after {} training), {} in the data".format(
+                    conid, len(inRecording), training[conid], len(saved[conid])
+                )
+            )
+        for (start, press), (condition, no) in zip(inRecording, saved[conid]):
+            if press is None:
+                problems.append("{} trial {}: no press trigger".format(condition, no))
+                continue
+            trials.append(
+                {"conid": conid, "condition": condition, "no": no, "trialstart": start, "press": press}
+            )
+    return trials, problems
+
+
+# ------------- EXTRACTION ---------------
+
+
+# Cut epochs around the presses (window in seconds relative to the press) of the
+# given channels (None = every channel but the trigger channel) into one .npy per
+# condition in outFolder. Only the records an epoch covers are read; the output
+# arrays are memory-mapped too. Returns {conid: path of the .npy}
+def extractEpochs(recording, trials, outFolder, channels=None, window=(-2.0, 0.5), triggerLabel="Status"):
+    if channels is None:
+        channels = [label for label in recording.labels if label not in (triggerLabel, "EDF Annotations")]
+    signals = [recording.signal(label) for label in channels]
+    rate = recording.rate(signals[0])
+    if any(recording.rate(signal) != rate for signal in signals):
+        raise ValueError("channels with different sampling rates")
+    triggerRate = recording.rate(recording.signal(triggerLabel))
+    perRecord = recording.samplesPerRecord[signals[0]]
+    before = int(round(-window[0] * rate))
+    length = before + int(round(window[1] * rate))
+    if not os.path.isdir(outFolder):
+        os.makedirs(outFolder)
+
+    outputs = {}
+    byCondition = {}
+    for trial in trials:
+        byCondition.setdefault(trial["conid"], []).append(trial)
+    for conid, conditionTrials in byCondition.items():
+        # epochs running off either end of the recording are left out
+        kept = []
+        for trial in conditionTrials:
+            first = int(round(trial["press"] / triggerRate * rate)) - before
+            if first >= 0 and first + length <= recording.nRecords * perRecord:
+                kept.append((first, trial))
+        path = os.path.join(outFolder, conid + ".npy")
+        epochs = open_memmap(path, mode="w+", dtype=float32, shape=(len(kept), len(signals), length))
+        for index, (first, trial) in enumerate(kept):
+            firstRecord = first // perRecord
+            lastRecord = (first + length - 1) // perRecord + 1
+            skip = first - firstRecord * perRecord
+            for channel, signal in enumerate(signals):
+                values = recording.physical(signal, firstRecord, lastRecord)
+                epochs[index, channel] = values[skip : skip + length]
+        epochs.flush()
+        del epochs
+        with open(os.path.join(outFolder, conid + "_trials.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["epoch", "condition", "no", "pressSample", "trialstartSample"])
+            for index, (first, trial) in enumerate(kept):
+                writer.writerow([index, trial["condition"], trial["no"], trial["press"], trial["trialstart"]])
+        outputs[conid] = path
+    with open(os.path.join(outFolder, "epochs.json"), "w") as f:
+        json.dump(
+            {"recording": recording.path, "channels": channels, "rate": rate, "window": list(window)},
+            f,
+            indent=1,
+        )
+    return outputs
+
+
+# ------------- SYNTHETIC RECORDING ---------------
+
+
+# Write a BDF (or EDF) file. signals: {label: samples (physical units)}, all at
+# rate, plus a "Status" trigger channel from events [(sample, code)], each
+# code held for pulse samples
+def writeRecording(path, signals, rate, events=(), bdf=True, recordDuration=1.0, pulse=8, physicalRange=8000.0):
+    labels = list(signals) + ["Status"]
+    length = len(next(iter(signals.values())))
+    perRecord = int(rate * recordDuration)
+    nRecords = -(-length // perRecord)
+    digitalMax = 8388607 if bdf else 32767
+    digitalMin = -8388608 if bdf else -32768
+    status = zeros(nRecords * perRecord, dtype=int32)
+    for sample, code in events:
+        status[sample : sample + pulse] = code
+
+    def pad(text, width):
+        return str(text)[:width].ljust(width).encode("latin-1")
+
+    header = (
+        (b"\xffBIOSEMI" if bdf else pad(0, 8))
+        + pad("synthetic", 80)
+        + pad("synthetic Libet session", 80)
+        + pad("01.01.26", 8)
+        + pad("00.00.00", 8)
+        + pad(256 * (len(labels) + 1), 8)
+        + pad("24BIT" if bdf else "", 44)
+        + pad(nRecords, 8)
+        + pad(recordDuration, 8)
+        + pad(len(labels), 4)
+    )
+    columns = [
+        (16, labels),
+        (80, [""] * len(labels)),
+        (8, ["uV"] * (len(labels) - 1) + ["Boolean"]),
+        (8, [-physicalRange] * (len(labels) - 1) + [digitalMin]),
+        (8, [physicalRange] * (len(labels) - 1) + [digitalMax]),
+        (8, [digitalMin] * len(labels)),
+        (8, [digitalMax] * len(labels)),
+        (80, [""] * len(labels)),
+        (8, [perRecord] * len(labels)),
+        (32, [""] * len(labels)),
+    ]
+    for width, values in columns:
+        header += b"".join(pad(value, width) for value in values)
+
+    gain = 2 * physicalRange / (digitalMax - digitalMin)
+    digital = []
+    for label in labels[:-1]:
+        values = zeros(nRecords * perRecord)
+        values[:length] = signals[label]
+        scaled = ((values + physicalRange) / gain + digitalMin).round()
+        digital.append(scaled.clip(digitalMin, digitalMax).astype(int32))
+    digital.append(status)
+    with open(path, "wb") as f:
+        f.write(header)
+        for record in range(nRecords):
+            for values in digital:
+                chunk = values[record * perRecord : (record + 1) * perRecord]
+                if bdf:
+                    f.write(chunk.astype("<i4").view(uint8).reshape(-1, 4)[:, :3].tobytes())
+                else:
+                    f.write(chunk.astype(int16).astype("<i2").tobytes())
+
+
+# A made-up session: plan, CSV files and a recording with a readiness-potential
+# like ramp before every press. Returns (recording path, CSV prefix, config)
+def syntheticSession(folder, subjectID=1, rate=512, trialsPerBlock=5, trainingTrials=2, seed=0, bdf=True):
+    rng = random.default_rng(seed)
+    config = {
+        "trainingTrials": trainingTrials,
+        "conditionTypes": {
+            "Finger_press": {"trialstart": 10, "eegLine": 11},
+            "Palm_lift": {"trialstart": 20, "eegLine": 21},
+        },
+    }
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    prefix = os.path.join(folder, "synthetic_{}".format(subjectID))
+    conditions = [(conid + str(rep), conid) for conid in config["conditionTypes"] for rep in (1, 2)]
+    rng.shuffle(conditions)
+
+    def block(condition, conid, n):
+        return {"condition": condition, "conid": conid, "trials": [{"no": no + 1} for no in range(n)]}
+
+    plan = {
+        "paradigm": "synthetic",
+        "training": [block(conid + "1", conid, trainingTrials) for conid in config["conditionTypes"]],
+        "main": [],
+    }
+    for counter, (condition, conid) in enumerate(conditions):
+        if counter:
+            plan["main"].append({"condition": "-", "counter": counter})
+        plan["main"].append(block(condition, conid, trialsPerBlock))
+    with open(prefix + "_plan.json", "w") as f:
+        json.dump(plan, f, indent=1)
+
+    events = []
+    t = 5.0
+    blocks = [(block, True) for block in plan["training"]] + [
+        (block, False) for block in plan["main"] if block["condition"] != "-"
+    ]
+    for block, training in blocks:
+        codes = config["conditionTypes"][block["conid"]]
+        if not training:
+            f = open("{}_{}.csv".format(prefix, block["condition"]), "w", newline="")
+            writer = csv.writer(f)
+            writer.writerow(["id", "condition", "no", "pressOnset"])
+        for trial in block["trials"]:
+            pressOnset = rng.uniform(1.0, 3.0)
+            events.append((int(t * rate), codes["trialstart"]))
+            events.append((int((t + pressOnset) * rate), codes["eegLine"]))
+            if not training:
+                writer.writerow([subjectID, block["condition"], trial["no"], round(pressOnset, 3)])
+            t += pressOnset + 6.0
+        if not training:
+            f.close()
+        t += 10.0
+
+    n = int((t + 5) * rate)
+    times = arange(n) / float(rate)
+    presses = array([sample for sample, code in events if code % 10 == 1]) / float(rate)
+    readiness = zeros(n)
+    for press in presses:
+        # slow negative ramp over the last 1.5 s before the press
+        span = (times > press - 1.5) & (times <= press)
+        readiness[span] -= 8.0 * exp(3 * (times[span] - press))
+    signals = {
+        "Cz": 10 * sin(2 * 3.14159 * 10 * times) + readiness + rng.normal(0, 2, n),
+        "FCz": 5 * sin(2 * 3.14159 * 7 * times) + 0.8 * readiness + rng.normal(0, 2, n),
+    }
+    path = prefix + (".bdf" if bdf else ".edf")
+    writeRecording(path, signals, rate, events, bdf=bdf)
+    return path, prefix, config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Libet EEG epochs")
+    commands = parser.add_subparsers(dest="command")
+    extract = commands.add_parser("extract", help="cut epochs around the presses")
+    extract.add_argument("recording", help="BDF/EDF file")
+    extract.add_argument("prefix", help="data file prefix, e.g. data/libetrandom_12")
+    extract.add_argument("config", help="paradigm config (trigger codes)")
+    extract.add_argument("out", help="output folder")
+    extract.add_argument("--channels", help="comma separated, default all")
+    extract.add_argument("--window", type=float, nargs=2, default=[-2.0, 0.5], help="seconds around the press")
+    extract.add_argument("--trigger-channel", default="Status")
+    synthetic = commands.add_parser("synthetic", help="write a synthetic session")
+    synthetic.add_argument("out")
+    synthetic.add_argument("--edf", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "synthetic":
+        path, prefix, config = syntheticSession(args.out, bdf=not args.edf)
+        with open(os.path.join(args.out, "synthetic_config.json"), "w") as f:
+            json.dump(config, f, indent=1)
+        print("Wrote {} (data prefix {}, config {})".format(path, prefix, f.name))
+    elif args.command == "extract":
+        with open(args.config, encoding="utf-8") as f:
+            config = json.load(f)
+        with open(args.prefix + "_plan.json") as f:
+            plan = json.load(f)
+        recording = Recording(args.recording)
+        samples, codes = findTriggers(recording, args.trigger_channel)
+        trials, problems = matchTrials(samples, codes, plan, config, args.prefix)
+        for problem in problems:
+            print("WARNING: " + problem)
+        outputs = extractEpochs(
+            recording,
+            trials,
+            args.out,
+            channels=args.channels.split(",") if args.channels else None,
+            window=args.window,
+            triggerLabel=args.trigger_channel,
+        )
+        for conid, path in sorted(outputs.items()):
+            print("{}: {}".format(conid, path))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
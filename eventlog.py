@@ -0,0 +1,206 @@
+# -------------- EVENT LOG ----------------
+# -----------------------------------------
+# Append-only binary log of everything that happens during a session: flips,
+# key events, triggers, screen transitions and "YOU MISSED" restarts.
+# Every record has the same width (timestamp, event type, code, value) so the
+# file can be memory-mapped and read back as NumPy views without copying.
+# Records are packed and written from a background thread, the render loop
+# only puts a tuple on a queue.
+from numpy import concatenate, dtype, memmap, zeros
+import atexit
+import os
+import queue
+import struct
+import threading
+import time
+
+# File layout: header, then fixed-width records
+magic = b"LIBETEV1"
+headerFormat = "<8sIId"  # magic, record size, reserved, session start (wall clock)
+headerSize = struct.calcsize(headerFormat)
+recordFormat = "<dIid"  # time, type, code, value
+recordSize = struct.calcsize(recordFormat)
+recordDtype = dtype(
+    [("time", "<f8"), ("type", "<u4"), ("code", "<i4"), ("value", "<f8")]
+)
+
+# Event types
+eventTypes = {
+    "flip": 1,  # code: frame number in the trial, value: dot angle
+    "key": 2,  # code: see keyCodes, value: trial clock time or new dot angle
+    "trigger": 3,  # code: bitmask, value: 1 if a device was present
+    "screen": 4,  # code: see screenCodes
+    "missed": 5,  # "YOU MISSED" restart, code: trial number
+    "trial": 6,  # at the trial clock's zero, code: trial number, value: starting dot angle
+    "block": 7,  # code: trialstart code of the condition, value: 1 if training
+    "triggerLatency": 8,  # code: bitmask, value: request to sent (s), worker mode only
+    "respiration": 9,  # code: channel, value: sample, worker mode only
+    "conditionStop": 10,  # adaptive stop, code: trialstart code, value: trials run
+    "audio": 11,  # audio cue onset, code: trigger code of the cue, value: onset minus its flip (s)
+    "breakTask": 12,  # block-break task finished, code: task number, value: duration (s)
+    "cpu": 13,  # end of a rotation, code: trial number, value: CPU time per frame (s)
+    "audioTrigger": 14,  # code: trigger code of an audio cue, value: sent after the cue (s)
+}
+eventNames = dict((v, k) for k, v in eventTypes.items())
+
+# Codes for "screen" events
+screenCodes = {
+    "instruction": 1,
+    "isi": 2,
+    "rotation": 3,
+    "hold": 4,
+    "report": 5,
+    "break": 6,
+    "ready": 7,
+    "preparation": 8,
+    "missed": 9,
+    "end": 10,
+}
+
+# Codes for "key" events
+keyCodes = {"press": 1, "move": 2, "select": 3, "quit": 4}
+
+
+# Create an event log file and write its header
+def openEventLogFile(path):
+    f = open(path, "wb")
+    f.write(struct.pack(headerFormat, magic, recordSize, 0, time.time()))
+    f.flush()
+    return f
+
+
+# A session's log can be rotated into segments: the first segment is the path
+# itself (session_events.bin), later ones are numbered (session_events.1.bin, ...)
+def eventLogSegment(path, n):
+    if n == 0:
+        return path
+    base, ext = os.path.splitext(path)
+    return "{}.{}{}".format(base, n, ext)
+
+
+# Paths of every existing segment of a log, in order
+def eventLogSegments(path):
+    segments = []
+    while os.path.exists(eventLogSegment(path, len(segments))):
+        segments.append(eventLogSegment(path, len(segments)))
+    return segments
+
+
+# Queue marker asking the writer thread to continue in a new file
+_rotate = object()
+
+
+class EventLog(object):
+    # path: binary file to create (an existing file is overwritten)
+    # clock: function returning the current time, use core.getTime so that
+    #   timestamps share the time base of win.flip()
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._queue = queue.Queue()
+        self._file = openEventLogFile(path)
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, name="EventLog")
+        self._thread.daemon = True
+        self._thread.start()
+        # psychopy's core.quit() ends in sys.exit(), so this also runs on escape
+        atexit.register(self.close)
+
+    # Log an event. Cheap enough to call every frame.
+    # t: timestamp, e.g. the return value of win.flip(); now if not given
+    def log(self, eventType, code=0, value=0.0, t=None):
+        if t is None:
+            t = self.clock()
+        self._queue.put((t, eventTypes[eventType], int(code), float(value)))
+
+    def _writer(self):
+        pack = struct.Struct(recordFormat).pack
+        while True:
+            items = [self._queue.get()]
+            # Drain whatever else is queued and write it in one go
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            chunk = []
+            stop = False
+            for item in items:
+                if item is None:
+                    stop = True
+                    break
+                if item[0] is _rotate:
+                    # everything queued before the rotation goes to the old file
+                    self._file.write(b"".join(chunk))
+                    self._file.close()
+                    self._file = openEventLogFile(item[1])
+                    chunk = []
+                    item[2].set()
+                    continue
+                chunk.append(pack(*item))
+            self._file.write(b"".join(chunk))
+            self._file.flush()
+            if stop:
+                break
+
+    # Continue the log in a new file. Returns once everything logged before
+    # has been written and the old file is closed, with the old file's path.
+    def rotate(self, path, timeout=5.0):
+        done = threading.Event()
+        self._queue.put((_rotate, path, done))
+        if not done.wait(timeout):
+            raise RuntimeError("event log writer did not rotate to {}".format(path))
+        oldPath, self.path = self.path, path
+        return oldPath
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+# ------------- READER ---------------
+# Memory-map an event log. Returns a read-only structured array backed by the
+# file: records["time"], records["type"], records["code"] and records["value"]
+# are views, nothing is copied until they are indexed with a mask.
+# A partially written last record (crash, power loss) is ignored.
+def readEventLog(path):
+    with open(path, "rb") as f:
+        header = f.read(headerSize)
+    if len(header) < headerSize or header[:8] != magic:
+        raise ValueError("{} is not an event log".format(path))
+    fileMagic, size, reserved, sessionStart = struct.unpack(headerFormat, header)
+    if size != recordSize:
+        raise ValueError(
+            "{}: record size {} does not match {}".format(path, size, recordSize)
+        )
+    nRecords = (os.path.getsize(path) - headerSize) // recordSize
+    if nRecords == 0:
+        # an empty file cannot be mapped
+        return zeros(0, dtype=recordDtype)
+    return memmap(path, dtype=recordDtype, mode="r", offset=headerSize, shape=(nRecords,))
+
+
+# Every segment of a rotated log as one array (copied, unlike readEventLog)
+def readEventLogs(path):
+    segments = [readEventLog(segment) for segment in eventLogSegments(path)]
+    if not segments:
+        raise ValueError("{}: no event log".format(path))
+    return concatenate(segments)
+
+
+# Session start (wall clock, seconds since the epoch) stored in the header
+def eventLogStart(path):
+    with open(path, "rb") as f:
+        return struct.unpack(headerFormat, f.read(headerSize))[3]
+
+
+# Records of one event type (and optionally one code)
+def selectEvents(records, eventType, code=None):
+    mask = records["type"] == eventTypes[eventType]
+    if code is not None:
+        mask &= records["code"] == code
+    return records[mask]
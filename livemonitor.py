@@ -0,0 +1,119 @@
+# -------------- LIVE MONITOR ---------------
+# ------------------------------------------
+# Streams trial summaries and health metrics of a running session to the
+# experimenter over a local UDP socket, one JSON datagram per message.
+# Sending is non-blocking and fire-and-forget: if no viewer is listening,
+# or the socket buffer is full, the message is dropped and the session goes
+# on as if nothing happened.
+#
+# Terminal viewer, run it in a second console next to the experiment:
+#
+#     python livemonitor.py [port]
+import json
+import socket
+import sys
+import time
+
+defaultHost = "127.0.0.1"
+defaultPort = 50007
+
+
+class LivePublisher(object):
+    def __init__(self, host=defaultHost, port=defaultPort, enabled=True):
+        self.address = (host, port)
+        self.enabled = enabled
+        self.failed = 0  # messages that could not be sent
+        self._sock = None
+        if enabled:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+
+    # Send a message of the given kind, never blocks and never raises
+    def publish(self, kind, **fields):
+        if not self.enabled:
+            return
+        fields["kind"] = kind
+        fields["time"] = time.time()
+        try:
+            self._sock.sendto(json.dumps(fields).encode("utf-8"), self.address)
+        except (OSError, ValueError, TypeError):
+            # no viewer (connection refused), buffer full or a value json can't encode
+            self.failed += 1
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+# ------------- VIEWER ---------------
+
+
+def formatMessage(message, totals):
+    kind = message.get("kind")
+    stamp = time.strftime("%H:%M:%S", time.localtime(message.get("time", time.time())))
+    if kind == "trial":
+        totals["trials"] += 1
+        totals["drops"] += message.get("frameDrops", 0) or 0
+        totals["frames"] += message.get("frames", 0) or 0
+
+        def ms(key):
+            value = message.get(key)
+            return "   -  " if value is None or value == "" else "{:6.1f}".format(value)
+
+        return (
+            "{} [{}] trial {:>3}  press {} s  error {} ms  drops {:>2}/{:<4}"
+            "  trigger {} ms  gc {} ms  (total drops {:.2%})".format(
+                stamp,
+                message.get("condition"),
+                message.get("no"),
+                message.get("pressOnset"),
+                ms("reportErrorMs"),
+                message.get("frameDrops"),
+                message.get("frames"),
+                ms("triggerLatencyMs"),
+                ms("gcTime"),
+                totals["drops"] / float(totals["frames"] or 1),
+            )
+        )
+    if kind == "missed":
+        totals["missed"] += 1
+        return "{} [{}] trial {:>3}  MISSED (restart, {} missed this session)".format(
+            stamp, message.get("condition"), message.get("no"), totals["missed"]
+        )
+    if kind == "health":
+        return "{} HEALTH {}".format(stamp, message.get("text"))
+    details = ", ".join(
+        "{}={}".format(key, value)
+        for key, value in sorted(message.items())
+        if key not in ("kind", "time")
+    )
+    return "{} {} {}".format(stamp, (kind or "?").upper(), details)
+
+
+def view(host=defaultHost, port=defaultPort):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    print("Listening on {}:{} (Ctrl+C to stop)".format(host, port))
+    totals = {"trials": 0, "missed": 0, "drops": 0, "frames": 0}
+    try:
+        while True:
+            data, sender = sock.recvfrom(65536)
+            try:
+                message = json.loads(data.decode("utf-8"))
+            except ValueError:
+                continue
+            print(formatMessage(message, totals))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print(
+            "\n{} trials, {} missed, {} dropped frames".format(
+                totals["trials"], totals["missed"], totals["drops"]
+            )
+        )
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    view(port=int(sys.argv[1]) if len(sys.argv) > 1 else defaultPort)
@@ -0,0 +1,183 @@
+# ------------- MEMORY TRACKING --------------
+# -------------------------------------------
+# Diagnostic mode for memory that keeps growing over a long session. At
+# every block boundary a snapshot is taken: Python allocations per source
+# line (tracemalloc), live objects per type (gc), the resident set size and
+# the number of live OpenGL textures. Each snapshot is compared with the one
+# before, and object types and allocation sites that grew at every one of the
+# last leakBlocks boundaries are flagged as leaks. The per-block table and
+# the flagged leaks go to <prefix>_memory.json at the end of the session.
+#
+# tracemalloc slows down every allocation, so frame timing suffers while it
+# runs: this is for test sessions, not for data collection.
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from pyglet import gl
+except ImportError:
+    gl = None
+
+# tracemalloc's, the tracker's own and import machinery allocations are not of interest
+ignoredFiles = ("<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>")
+
+
+def residentBytes():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Live textures of the current GL context: texture names are handed out in
+# increasing order, so every name below a freshly generated one is probed
+def liveTextures():
+    if gl is None:
+        return None
+    try:
+        probe = gl.GLuint()
+        gl.glGenTextures(1, probe)
+        count = sum(1 for name in range(1, probe.value) if gl.glIsTexture(name))
+        gl.glDeleteTextures(1, probe)
+        return count
+    except Exception:
+        # no current context
+        return None
+
+
+def objectCounts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+class MemoryTracker(object):
+    # enabled: when off every call is a no-op
+    # tracebackFrames: frames tracemalloc keeps per allocation (1 = the line only, cheapest)
+    # leakBlocks: a type or site is flagged when it grew at this many boundaries in a row
+    # topSites: allocation sites kept per snapshot
+    # minObjects, minBytes: growth per boundary below which a type or site is not counted
+    def __init__(
+        self, enabled=True, tracebackFrames=1, leakBlocks=3, topSites=20, minObjects=10, minBytes=10240
+    ):
+        self.enabled = enabled
+        self.tracebackFrames = tracebackFrames
+        self.leakBlocks = leakBlocks
+        self.topSites = topSites
+        self.minObjects = minObjects
+        self.minBytes = minBytes
+        self.blocks = []  # one summary per snapshot
+        self._previous = None  # (tracemalloc snapshot, object counts)
+
+    def start(self):
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracebackFrames)
+
+    # Take a snapshot at a block boundary, returns its summary (None when off)
+    def snapshot(self, label):
+        if not self.enabled:
+            return None
+        start = time.perf_counter()
+        gc.collect()  # only what is really still referenced
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+            + [tracemalloc.Filter(False, name) for name in ignoredFiles]
+        )
+        counts = objectCounts()
+        traced, peak = tracemalloc.get_traced_memory()
+        block = {
+            "label": label,
+            "time": time.time(),
+            "rss": residentBytes(),
+            "traced": traced,
+            "peak": peak,
+            "textures": liveTextures(),
+            "objects": sum(counts.values()),
+            "typeGrowth": {},
+            "siteGrowth": {},
+        }
+        if self._previous is not None:
+            previousSnapshot, previousCounts = self._previous
+            block["typeGrowth"] = dict(
+                (name, count - previousCounts.get(name, 0))
+                for name, count in counts.items()
+                if abs(count - previousCounts.get(name, 0)) >= self.minObjects
+            )
+            for stat in snapshot.compare_to(previousSnapshot, "lineno")[: self.topSites]:
+                if stat.size_diff >= self.minBytes:
+                    frame = stat.traceback[0]
+                    site = "{}:{}".format(frame.filename, frame.lineno)
+                    block["siteGrowth"][site] = stat.size_diff
+        self._previous = (snapshot, counts)
+        if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+
+            tracemalloc.reset_peak()
+        block["seconds"] = time.perf_counter() - start
+        self.blocks.append(block)
+        return block
+
+    # Types and allocation sites that grew at each of the last leakBlocks boundaries
+    def leaks(self):
+        recent = self.blocks[1:][-self.leakBlocks :]
+        if len(recent) < self.leakBlocks:
+            return {"types": {}, "sites": {}}
+        result = {}
+        for key in ("typeGrowth", "siteGrowth"):
+            names = set(recent[0][key])
+            for block in recent[1:]:
+                names &= set(block[key])
+            result[key] = dict(
+                (name, [block[key][name] for block in recent])
+                for name in names
+                if all(block[key][name] > 0 for block in recent)
+            )
+        return {"types": result["typeGrowth"], "sites": result["siteGrowth"]}
+
+    def report(self, prefix):
+        if not self.enabled:
+            return None
+        report = {"leakBlocks": self.leakBlocks, "blocks": self.blocks, "leaks": self.leaks()}
+        with open(prefix + "_memory.json", "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+        tracemalloc.stop()
+        return report
+
+
+def formatBlock(block):
+    def mb(value):
+        return "   -  " if value is None else "{:6.1f}".format(value / 1e6)
+
+    grown = sorted(block["typeGrowth"].items(), key=lambda item: -item[1])[:3]
+    return "  {:<20} rss {} MB  traced {} MB  objects {:>8}  textures {:>4}  {}".format(
+        block["label"],
+        mb(block["rss"]),
+        mb(block["traced"]),
+        block["objects"],
+        "-" if block["textures"] is None else block["textures"],
+        ", ".join("{} {:+d}".format(name, n) for name, n in grown if n > 0),
+    )
+
+
+def formatLeaks(leaks):
+    lines = []
+    for name, growth in sorted(leaks["types"].items(), key=lambda item: -sum(item[1])):
+        lines.append("  WARNING: {} objects keep growing: {}".format(name, growth))
+    for site, growth in sorted(leaks["sites"].items(), key=lambda item: -sum(item[1])):
+        lines.append(
+            "  WARNING: allocations at {} keep growing: {} kB".format(
+                site, [int(size / 1024) for size in growth]
+            )
+        )
+    return "\n".join(lines) or "  no steady growth"
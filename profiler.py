@@ -0,0 +1,175 @@
+# ------------ SAMPLING PROFILER ------------
+# ------------------------------------------
+# Where the time goes during a real session on the lab PC. A background
+# thread wakes every few milliseconds, takes the stack of the main thread
+# and counts it under the current phase (instruction, isi, rotation, hold,
+# report, break, ...) and block, as tagged by the engine. Nothing is
+# formatted while sampling: a sample is a tuple of code objects counted in
+# a dict. The thread measures its own cost and samples less often whenever
+# it would take more than maxOverhead of the wall time.
+#
+# At the end of the session the counts are written as folded stacks, one
+# file per phase (<prefix>_profile_<phase>.folded, "block X;outer;...;inner
+# count" per line), the input of flamegraph.pl, speedscope or inferno, and a
+# summary with the samples per phase and per trial (<prefix>_profile.json):
+#
+#     flamegraph.pl data/libetrandom_12_profile_rotation.folded > rotation.svg
+#     python profiler.py data/libetrandom_12_profile.json
+import json
+import os
+import sys
+import threading
+import time
+
+
+# Block name samples are counted under: the block's condition (repeated blocks
+# of one condition type have their own), training blocks marked apart
+def blockLabel(condition, training=False):
+    return condition + "_training" if training else condition
+
+
+class SamplingProfiler(object):
+    # enabled: when off every call is a no-op
+    # interval: seconds between samples (grows when sampling is too costly)
+    # maxOverhead: share of the wall time the sampling may take
+    # maxDepth: innermost frames kept per sample
+    def __init__(self, enabled=True, interval=0.005, maxOverhead=0.01, maxDepth=64):
+        self.enabled = enabled
+        self.interval = interval
+        self.maxOverhead = maxOverhead
+        self.maxDepth = maxDepth
+        self.phase, self.block, self.trial = "setup", None, None
+        self.counts = {}  # (phase, block, code objects outer to inner) -> samples
+        self.trials = {}  # (block, trial, phase) -> samples
+        self.samples = 0
+        self.cost = 0.0  # seconds spent sampling
+        self.elapsed = 0.0  # seconds between start() and stop()
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Set the phase the following samples are counted under
+    def tag(self, phase, block=None, trial=None):
+        self.phase, self.block, self.trial = phase, block, trial
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        start = checked = time.perf_counter()
+        checkedCost = 0.0
+        counts, trials, maxDepth = self.counts, self.trials, self.maxDepth
+        while not self._stop.wait(self.interval):
+            sampleStart = time.perf_counter()
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                # the main thread is gone
+                break
+            phase, block, trial = self.phase, self.block, self.trial
+            codes = []
+            while frame is not None and len(codes) < maxDepth:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            frame = None
+            key = (phase, block, tuple(reversed(codes)))
+            counts[key] = counts.get(key, 0) + 1
+            if trial is not None:
+                key = (block, trial, phase)
+                trials[key] = trials.get(key, 0) + 1
+            self.samples += 1
+            now = time.perf_counter()
+            self.cost += now - sampleStart
+            # Back off when the last second of sampling cost too much
+            if now - checked > 1.0:
+                if (self.cost - checkedCost) / (now - checked) > self.maxOverhead:
+                    self.interval *= 1.5
+                checked, checkedCost = now, self.cost
+        self.elapsed = time.perf_counter() - start
+
+    # Write the folded stacks per phase and the summary, returns the summary
+    def write(self, prefix):
+        if not self.enabled:
+            return None
+        self.stop()
+        folded = {}
+        for (phase, block, codes), count in self.counts.items():
+            frames = ["block {}".format(block) if block is not None else "session"]
+            frames.extend(
+                "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                for code in codes
+            )
+            stack = ";".join(frame.replace(";", ":") for frame in frames)
+            stacks = folded.setdefault(phase, {})
+            stacks[stack] = stacks.get(stack, 0) + count
+        for phase, stacks in folded.items():
+            with open("{}_profile_{}.folded".format(prefix, phase), "w", encoding="utf-8") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write("{} {}\n".format(stack, count))
+        summary = {
+            "samples": self.samples,
+            "interval": self.interval,
+            "seconds": self.elapsed,
+            "overhead": self.cost / self.elapsed if self.elapsed else 0.0,
+            "phases": dict(
+                (phase, sum(stacks.values())) for phase, stacks in sorted(folded.items())
+            ),
+            "trials": [
+                {"block": block, "trial": trial, "phase": phase, "samples": count}
+                for (block, trial, phase), count in sorted(self.trials.items(), key=str)
+            ],
+        }
+        with open(prefix + "_profile.json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=1)
+        return summary
+
+
+# ------------- REPORT ---------------
+
+
+# Functions with the most samples of their own (innermost frame) per phase
+def topFunctions(foldedPath, n=10):
+    own = {}
+    total = 0
+    with open(foldedPath, encoding="utf-8") as f:
+        for line in f:
+            stack, count = line.rstrip("\n").rsplit(" ", 1)
+            leaf = stack.rsplit(";", 1)[-1]
+            own[leaf] = own.get(leaf, 0) + int(count)
+            total += int(count)
+    return total, sorted(own.items(), key=lambda item: -item[1])[:n]
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python profiler.py <prefix>_profile.json [functions per phase]")
+        sys.exit(1)
+    summaryPath = sys.argv[1]
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with open(summaryPath, encoding="utf-8") as f:
+        summary = json.load(f)
+    print(
+        "{samples} samples over {seconds:.0f} s, final interval {ms:.1f} ms, overhead {overhead:.2%}".format(
+            ms=summary["interval"] * 1000, **summary
+        )
+    )
+    prefix = summaryPath[: -len("_profile.json")]
+    for phase, samples in sorted(summary["phases"].items(), key=lambda item: -item[1]):
+        print("\n{} ({:.1%} of the samples)".format(phase, samples / float(summary["samples"] or 1)))
+        total, top = topFunctions("{}_profile_{}.folded".format(prefix, phase), n)
+        for leaf, count in top:
+            print("  {:6.1%}  {}".format(count / float(total), leaf))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# ---------- ANGULAR QUANTIZATION ----------
+# -----------------------------------------
+# How finely the clock measures time, per display setting. The dot advances
+# 360 / libetTime / frameRate degrees per frame, the report dot moves in
+# steps of the moveKeys (1 and 3 degrees: reachable report angles lie on a
+# 1 degree grid starting at wherever the dot stopped) and both angles are saved
+# truncated to 1/degScale degrees. This simulates presses of an ideal subject
+# (true W-time 0, reports exactly where the dot was at the press) over a grid
+# of refresh rates and libetTime values and tabulates what the measurement
+# alone adds:
+#
+#   press       pressAngle (nearest frame, truncated) minus the true angle at
+#               the press time, in ms
+#   on screen   the same against the angle that was on screen at the press
+#               (the last frame flipped before it)
+#   report      ansAngle (grid, truncated) minus the true angle, in ms
+#   W-time      the recorded W-time: its mean is the bias, its SD the
+#               resolution of a single trial
+#
+# keyTiming "exact": key presses carry their true time (e.g. a keyboard
+# timestamping on its own clock); "flip": presses are only timestamped when
+# polled after the next flip, as with PsychoPy's event module.
+# Presses are simulated in chunks of vectorized arrays, seeded:
+#
+#     python quantization.py --presses 2000000 --frame-rates 60 120 144 --seed 1
+#     python quantization.py --libet-times 2.56 5.12 10.24 --csv quantization.csv
+import argparse
+import csv
+import glob
+import json
+import os
+from functools import reduce
+from math import gcd
+
+from numpy import abs as npabs
+from numpy import floor, percentile, random, round as npround, trunc, where
+
+from adaptive import circularDifference
+from triallogic import degScale, msScale, wTime
+
+defaultConfigs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
+defaultFrameRates = [60, 75, 85, 100, 120, 144, 165, 240]
+defaultChunk = 1000000
+keyTimings = ("exact", "flip")
+columns = [
+    "frameRate",
+    "libetTime",
+    "keyTiming",
+    "reportGrid",
+    "degPerFrame",
+    "msPerFrame",
+    "pressBiasMs",
+    "pressSdMs",
+    "onScreenBiasMs",
+    "reportBiasMs",
+    "reportSdMs",
+    "wTimeBiasMs",
+    "wTimeSdMs",
+    "wTime95Ms",
+]
+
+
+# libetTime and report grid (degrees, gcd of the moveKeys steps) per paradigm config
+def loadParadigms(configFolder=defaultConfigs):
+    paradigms = {}
+    for path in sorted(glob.glob(os.path.join(configFolder, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        steps = [abs(int(step)) for step in (config.get("moveKeys") or {}).values()]
+        paradigms[config.get("paradigm", os.path.basename(path))] = (
+            config.get("libetTime", 2.56),
+            reduce(gcd, steps) if steps else 1,
+        )
+    return paradigms
+
+
+def truncate(angles):
+    return trunc(angles * degScale) / degScale
+
+
+# Simulate n presses, returns the errors (ms) as arrays
+def simulate(rng, n, frameRate, libetTime, reportGrid=1, keyTiming="exact"):
+    interval = 1.0 / frameRate
+    dotStep = 360 / libetTime / frameRate
+    startAngle = rng.uniform(0, 360, n)
+    # Press time since the first flip of the rotation, past the first frame
+    pressTime = rng.uniform(interval, libetTime, n)
+    trueAngle = (startAngle + pressTime * 360 / libetTime) % 360
+    shown = floor(pressTime / interval)  # frame on screen at the press
+    if keyTiming == "flip":
+        recorded = (shown + 1) * interval
+    else:
+        recorded = pressTime
+    # Detected after flip shown + 1; the nearest of it and the one before (Rotation.press)
+    nearest = where(recorded - shown * interval < interval / 2, shown, shown + 1)
+    pressAngle = truncate((startAngle + nearest * dotStep) % 360)
+    onScreen = (startAngle + shown * dotStep) % 360
+    # Report: the dot starts where it stopped, reachable angles lie on the grid from there
+    reportStart = rng.uniform(0, 360, n)
+    ansAngle = truncate(
+        (reportStart + npround(circularDifference(trueAngle, reportStart) / reportGrid) * reportGrid) % 360
+    )
+    toMs = libetTime / 360 * msScale
+    return {
+        "press": circularDifference(pressAngle, trueAngle) * toMs,
+        "onScreen": circularDifference(pressAngle, onScreen) * toMs,
+        "report": circularDifference(ansAngle, trueAngle) * toMs,
+        "wTime": wTime(pressAngle, ansAngle, libetTime) * msScale,
+    }
+
+
+# One row of the table, presses simulated in chunks of chunkSize
+def analyze(seed, presses, frameRate, libetTime, reportGrid=1, keyTiming="exact", chunkSize=defaultChunk):
+    rng = random.default_rng(seed)
+    sums = {}
+    wTimes = []
+    done = 0
+    while done < presses:
+        n = min(chunkSize, presses - done)
+        errors = simulate(rng, n, frameRate, libetTime, reportGrid, keyTiming)
+        for name, values in errors.items():
+            total, squares = sums.get(name, (0.0, 0.0))
+            sums[name] = (total + values.sum(), squares + (values**2).sum())
+        # the 95th percentile of |W-time| over a subsample bounded by the chunk size
+        wTimes.extend(npabs(errors["wTime"][: max(1, chunkSize // 10)]).tolist())
+        done += n
+
+    def mean(name):
+        return sums[name][0] / presses
+
+    def sd(name):
+        return max(0.0, sums[name][1] / presses - mean(name) ** 2) ** 0.5
+
+    return {
+        "frameRate": frameRate,
+        "libetTime": libetTime,
+        "keyTiming": keyTiming,
+        "reportGrid": reportGrid,
+        "degPerFrame": 360 / libetTime / frameRate,
+        "msPerFrame": msScale / frameRate,
+        "pressBiasMs": mean("press"),
+        "pressSdMs": sd("press"),
+        "onScreenBiasMs": mean("onScreen"),
+        "reportBiasMs": mean("report"),
+        "reportSdMs": sd("report"),
+        "wTimeBiasMs": mean("wTime"),
+        "wTimeSdMs": sd("wTime"),
+        "wTime95Ms": percentile(wTimes, 95),
+    }
+
+
+def formatRow(row):
+    return (
+        "{frameRate:>5} {libetTime:>6.2f} {keyTiming:>5} {reportGrid:>3} {degPerFrame:>7.2f} "
+        "{msPerFrame:>7.2f} {pressBiasMs:>7.2f} {pressSdMs:>6.2f} {onScreenBiasMs:>7.2f} "
+        "{reportBiasMs:>7.2f} {reportSdMs:>6.2f} {wTimeBiasMs:>7.2f} {wTimeSdMs:>6.2f} "
+        "{wTime95Ms:>6.2f}".format(**row)
+    )
+
+
+header = (
+    "   Hz libetT   key grid deg/frm ms/frm  press    (SD) screen  report   (SD) W-time   (SD)   |95%|"
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Angle/time quantization of the clock per display setting")
+    parser.add_argument("--configs", default=defaultConfigs, help="paradigm configs (libetTime, moveKeys)")
+    parser.add_argument("--frame-rates", type=float, nargs="+", default=defaultFrameRates)
+    parser.add_argument("--libet-times", type=float, nargs="+", help="instead of the configs' libetTime")
+    parser.add_argument("--report-grid", type=int, help="report step (degrees) instead of the configs'")
+    parser.add_argument("--key-timing", choices=keyTimings, nargs="+", default=list(keyTimings))
+    parser.add_argument("--presses", type=int, default=1000000, help="simulated presses per setting")
+    parser.add_argument("--chunk", type=int, default=defaultChunk)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--csv", help="also write the table to this file")
+    args = parser.parse_args()
+
+    if args.libet_times:
+        settings = [(libetTime, args.report_grid or 1) for libetTime in args.libet_times]
+    else:
+        settings = sorted(set(loadParadigms(args.configs).values()))
+        if args.report_grid:
+            settings = sorted(set((libetTime, args.report_grid) for libetTime, grid in settings))
+    seeds = random.SeedSequence(args.seed).spawn(len(settings) * len(args.frame_rates) * len(args.key_timing))
+    rows = []
+    print("W-time error (ms) added by the measurement, {} presses per setting".format(args.presses))
+    print(header)
+    for libetTime, reportGrid in settings:
+        for frameRate in args.frame_rates:
+            for keyTiming in args.key_timing:
+                row = analyze(
+                    seeds[len(rows)], args.presses, frameRate, libetTime, reportGrid, keyTiming, args.chunk
+                )
+                rows.append(row)
+                print(formatRow(row))
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+# ------------- REAL-TIME MODE ------------
+# -----------------------------------------
+# Guards the rotation and report loops of runBlock against Python GC pauses
+# and OS preemption. While a trial is running the process priority is raised,
+# the main (rendering) thread gets a CPU of its own and the cyclic garbage
+# collector is paused. The collection is run during the ISI instead, where a
+# pause costs nothing.
+#
+# CPU pinning is per thread, the same on every platform: the main thread is
+# pinned to the last allowed CPU and every other thread of the process (event
+# log writer, live monitor, profiler, collector, ...) to the remaining ones,
+# so none of them competes with the rendering for its CPU. This needs thread
+# affinity, which Linux (sched_setaffinity on thread ids) and Windows
+# (SetThreadAffinityMask, other threads listed with psutil) have; on macOS,
+# or with a single allowed CPU, nothing is pinned.
+import gc
+import glob
+import os
+import sys
+import threading
+import time
+
+try:
+    import psutil  # optional, used for battery state and listing threads on Windows
+except ImportError:
+    psutil = None
+
+try:
+    from psychopy import core
+except ImportError:
+    # tools that run the loop without a display (stresstest.py --mode offscreen):
+    # no priority raise, the rest of the guard works
+    core = None
+
+# Governors that clock the CPU down when it looks idle (e.g. while waiting for a flip)
+slowGovernors = ["powersave", "conservative"]
+
+
+def checkPowerState():
+    # Warn when the machine is on battery or in a power-saving governor
+    problems = []
+    if psutil is not None and hasattr(psutil, "sensors_battery"):
+        try:
+            battery = psutil.sensors_battery()
+        except Exception:
+            battery = None
+        if battery is not None and not battery.power_plugged:
+            problems.append("running on battery ({}%)".format(int(battery.percent)))
+    governors = set()
+    for path in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_governor"):
+        try:
+            with open(path) as f:
+                governors.add(f.read().strip())
+        except (IOError, OSError):
+            pass
+    for governor in sorted(governors):
+        if governor in slowGovernors:
+            problems.append('CPU governor is "{}"'.format(governor))
+    for problem in problems:
+        print("WARNING (real-time mode): " + problem + ", expect dropped frames")
+    return problems
+
+
+# CPUs the process may run on, None when unknown
+def _getAffinity():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    if psutil is not None:
+        try:
+            return sorted(psutil.Process().cpu_affinity())
+        except (AttributeError, psutil.Error):
+            pass
+    return None
+
+
+# Native ids of the threads of this process, None when they can't be listed
+def _threadIds():
+    if os.path.isdir("/proc/self/task"):
+        return [int(tid) for tid in os.listdir("/proc/self/task")]
+    if psutil is not None:
+        try:
+            return [thread.id for thread in psutil.Process().threads()]
+        except psutil.Error:
+            pass
+    return None
+
+
+# Pin one thread, returns its previous CPUs (None when it could not be pinned)
+def _setThreadAffinity(tid, cpus):
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            previous = sorted(os.sched_getaffinity(tid))
+            os.sched_setaffinity(tid, set(cpus))
+            return previous
+        if sys.platform == "win32":
+            import ctypes
+
+            kernel32 = ctypes.windll.kernel32
+            kernel32.OpenThread.restype = ctypes.c_void_p
+            kernel32.SetThreadAffinityMask.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            kernel32.SetThreadAffinityMask.restype = ctypes.c_size_t
+            kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+            # THREAD_SET_INFORMATION | THREAD_QUERY_INFORMATION
+            handle = kernel32.OpenThread(0x0060, False, tid)
+            if not handle:
+                return None
+            try:
+                mask = kernel32.SetThreadAffinityMask(handle, sum(1 << cpu for cpu in cpus))
+            finally:
+                kernel32.CloseHandle(handle)
+            if not mask:
+                return None
+            return [cpu for cpu in range(mask.bit_length()) if mask >> cpu & 1]
+    except (OSError, ValueError, AttributeError):
+        # the thread ended meanwhile or the CPUs are not allowed: leave it
+        pass
+    return None
+
+
+# Give the calling (main) thread the last allowed CPU and move every other
+# thread to the rest. Returns {thread id: previous CPUs} of the threads pinned,
+# empty when the main thread could not be pinned.
+def _pinThreads():
+    cpus = _getAffinity()
+    threadIds = _threadIds()
+    mainId = getattr(threading, "get_native_id", lambda: None)()
+    if not cpus or len(cpus) < 2 or threadIds is None or mainId is None:
+        return {}
+    previous = {}
+    old = _setThreadAffinity(mainId, cpus[-1:])
+    if old is None:
+        return {}
+    previous[mainId] = old
+    for tid in threadIds:
+        if tid != mainId:
+            old = _setThreadAffinity(tid, cpus[:-1])
+            if old is not None:
+                previous[tid] = old
+    return previous
+
+
+def _unpinThreads(previous):
+    for tid, cpus in previous.items():
+        _setThreadAffinity(tid, cpus)
+
+
+class RealtimeGuard(object):
+    # enabled: switch the whole mode on/off (when off every call is a no-op,
+    #   so runBlock does not need to branch)
+    # pinCpu: give the main thread a CPU of its own while a trial is running,
+    #   the last allowed one (CPU 0 usually services most interrupts); every
+    #   other thread is kept off it. Call enter() from the main thread.
+    def __init__(self, enabled=True, pinCpu=True):
+        self.enabled = enabled
+        self.pinCpu = pinCpu
+        self.active = False
+        self.priorityRaised = False
+        self.cpuPinned = False
+        self._oldAffinity = {}  # thread id: CPUs before enter()
+        self._gcTime = 0.0
+        self._gcStart = None
+        if enabled:
+            # Time every collection, wherever it happens
+            gc.callbacks.append(self._onGc)
+            checkPowerState()
+
+    def _onGc(self, phase, info):
+        if phase == "start":
+            self._gcStart = time.perf_counter()
+        elif self._gcStart is not None:
+            self._gcTime += time.perf_counter() - self._gcStart
+            self._gcStart = None
+
+    # Enter real-time mode, call right before the rotation loop
+    def enter(self):
+        if not self.enabled or self.active:
+            return
+        self.priorityRaised = core is not None and bool(core.rush(True))
+        if self.pinCpu:
+            self._oldAffinity = _pinThreads()
+            self.cpuPinned = bool(self._oldAffinity)
+        gc.disable()
+        self.active = True
+
+    # Leave real-time mode, call once the report has been given
+    def exit(self):
+        if not self.active:
+            return
+        gc.enable()
+        if self.cpuPinned:
+            _unpinThreads(self._oldAffinity)
+            self._oldAffinity = {}
+            self.cpuPinned = False
+        if self.priorityRaised:
+            core.rush(False)
+            self.priorityRaised = False
+        self.active = False
+
+    # Interstimulus interval: run the garbage collection first and sleep
+    # for whatever is left of the interval
+    def idle(self, seconds):
+        start = time.time()
+        if self.enabled:
+            gc.collect()
+        remaining = seconds - (time.time() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    # GC time (in seconds) since the last call, logged once per trial
+    def takeGcTime(self):
+        gcTime = self._gcTime
+        self._gcTime = 0.0
+        return gcTime
+
+    def close(self):
+        self.exit()
+        if self._onGc in gc.callbacks:
+            gc.callbacks.remove(self._onGc)
@@ -0,0 +1,242 @@
+# ---------- RESAMPLING STATISTICS -----------
+# -------------------------------------------
+# Bootstrap confidence intervals and permutation tests for the group
+# analyses: report error and W-time between the conditions of a paradigm,
+# across subjects. Angles (report error in degrees) use circular statistics.
+#
+# Resamples are never drawn one at a time: a chunk of them is a matrix
+# (resamples x subjects) of indices, signs or permutation keys, and the
+# statistic of the whole chunk is a handful of NumPy operations. Chunks bound
+# the memory and are spread over a process pool. Every chunk draws from its
+# own generator, derived from the seed, the test and the chunk's number (not
+# spawned in call order), so a test's result depends only on the seed, its
+# data and the chunk size: not on the number of processes nor on the tests
+# run before it.
+#
+#     python resampling.py data/trials.sqlite Random_Finger reportErrorDeg --seed 1
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from numpy import (
+    abs as npabs,
+    arctan2,
+    argsort,
+    array,
+    concatenate,
+    cos,
+    degrees,
+    isnan,
+    nan,
+    percentile,
+    radians,
+    random,
+    sin,
+    take_along_axis,
+)
+
+import trialdb
+
+defaultResamples = 10000
+defaultChunk = 2000
+
+# Random streams of the tests, part of the chunks' seeds
+streams = {"bootstrap": 0, "pairedTest": 1, "omnibusTest": 2}
+
+
+# ------------- STATISTICS ---------------
+
+
+# Circular mean (degrees) along an axis, in [-180, 180)
+def circularMean(angles, axis=-1):
+    rad = radians(angles)
+    return wrap(degrees(arctan2(sin(rad).mean(axis), cos(rad).mean(axis))))
+
+
+def wrap(angles):
+    return (angles + 180) % 360 - 180
+
+
+def _mean(values, circular, axis=-1):
+    return circularMean(values, axis) if circular else values.mean(axis)
+
+
+# ------------- CHUNKS (run in the pool) ---------------
+
+
+def _bootstrapChunk(values, circular, size, seed):
+    rng = random.default_rng(seed)
+    indices = rng.integers(0, len(values), (size, len(values)))
+    return _mean(values[indices], circular)
+
+
+def _pairedChunk(differences, circular, size, seed):
+    # Under H0 each subject's difference is as likely to have the other sign
+    rng = random.default_rng(seed)
+    signs = rng.choice(array([-1.0, 1.0]), (size, len(differences)))
+    return npabs(_mean(differences * signs, circular))
+
+
+def _omnibusChunk(values, circular, size, seed):
+    # Under H0 the condition labels are exchangeable within each subject
+    rng = random.default_rng(seed)
+    keys = rng.random((size,) + values.shape)
+    shuffled = take_along_axis(values[None], argsort(keys, axis=-1), axis=-1)
+    return _spread(shuffled, circular)
+
+
+# Spread of the condition means (subjects x conditions on the last two axes):
+# sum of squared deviations from the grand mean, on the circle 2 * (1 - cos)
+def _spread(values, circular):
+    means = _mean(values, circular, axis=-2)
+    grand = _mean(means, circular)[..., None]
+    if circular:
+        return (2 * (1 - cos(radians(means - grand)))).sum(-1)
+    return ((means - grand) ** 2).sum(-1)
+
+
+class Resampler(object):
+    # nResamples: resamples per test
+    # seed: the same seed gives the same results
+    # chunkSize: resamples computed at once (memory: chunkSize x subjects doubles)
+    # processes: pool size, 1 = run in this process
+    def __init__(self, nResamples=defaultResamples, seed=None, chunkSize=defaultChunk, processes=1):
+        self.nResamples = nResamples
+        self.seed = random.SeedSequence(seed)
+        self.chunkSize = chunkSize
+        self.processes = processes
+        self._pool = None
+
+    # Seeds of the chunks of a test: children of the seed keyed by the test's stream
+    # and the chunk number, the same at every call
+    def _seeds(self, stream, n):
+        return [
+            random.SeedSequence(
+                self.seed.entropy, spawn_key=self.seed.spawn_key + (streams[stream], chunk)
+            )
+            for chunk in range(n)
+        ]
+
+    # Run a chunk function over all resamples, returns the concatenated statistics
+    def _run(self, stream, function, *args):
+        sizes = [self.chunkSize] * (self.nResamples // self.chunkSize)
+        if self.nResamples % self.chunkSize:
+            sizes.append(self.nResamples % self.chunkSize)
+        seeds = self._seeds(stream, len(sizes))
+        jobs = [args + (size, seed) for size, seed in zip(sizes, seeds)]
+        if self.processes <= 1:
+            return concatenate([function(*job) for job in jobs])
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context("spawn")
+            )
+        return concatenate(list(self._pool.map(function, *zip(*jobs))))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    # Bootstrap CI of the mean of per-subject values. Returns (mean, low, high);
+    # for angles the interval is taken on the deviations from the mean
+    def bootstrap(self, values, circular=False, confidence=0.95):
+        values = array(values, dtype=float)
+        observed = _mean(values, circular)
+        means = self._run("bootstrap", _bootstrapChunk, values, circular)
+        tails = [50 * (1 - confidence), 50 * (1 + confidence)]
+        if circular:
+            low, high = percentile(wrap(means - observed), tails)
+            return observed, wrap(observed + low), wrap(observed + high)
+        low, high = percentile(means, tails)
+        return observed, low, high
+
+    # Paired permutation (sign flip) test of a - b, per-subject values.
+    # Returns (mean difference, two-sided p)
+    def pairedTest(self, a, b, circular=False):
+        a, b = array(a, dtype=float), array(b, dtype=float)
+        differences = wrap(a - b) if circular else a - b
+        observed = _mean(differences, circular)
+        null = self._run("pairedTest", _pairedChunk, differences, circular)
+        return observed, ((null >= abs(observed) - 1e-12).sum() + 1) / (len(null) + 1.0)
+
+    # Omnibus within-subject permutation test over conditions.
+    # values: subjects x conditions. Returns (spread of the condition means, p)
+    def omnibusTest(self, values, circular=False):
+        values = array(values, dtype=float)
+        observed = _spread(values, circular)
+        null = self._run("omnibusTest", _omnibusChunk, values, circular)
+        return observed, ((null >= observed - 1e-12).sum() + 1) / (len(null) + 1.0)
+
+
+# ------------- DATA ---------------
+
+
+# Per-subject means of a column per condition from the trial database (see
+# trialdb.py). Returns (subjects, conditions, subjects x conditions array with
+# nan where a subject has no trials of a condition)
+def subjectMeans(databasePath, paradigm, column, circular=False):
+    db = trialdb.connect(databasePath)
+    try:
+        rows = db.execute(
+            'SELECT subject, condition, "{}" FROM trials WHERE paradigm = ? AND "{}" IS NOT NULL'.format(
+                column, column
+            ),
+            (paradigm,),
+        ).fetchall()
+    finally:
+        db.close()
+    byCell = {}
+    for subject, condition, value in rows:
+        byCell.setdefault((subject, condition), []).append(value)
+    subjects = sorted(set(subject for subject, condition in byCell), key=str)
+    conditions = sorted(set(condition for subject, condition in byCell))
+    table = array([[nan] * len(conditions) for subject in subjects])
+    for (subject, condition), values in byCell.items():
+        table[subjects.index(subject), conditions.index(condition)] = _mean(array(values), circular)
+    return subjects, conditions, table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bootstrap and permutation statistics")
+    parser.add_argument("database", help="trial database (trialdb.py)")
+    parser.add_argument("paradigm")
+    parser.add_argument("column", help="e.g. reportErrorDeg (circular), reportErrorMs, wTime")
+    parser.add_argument("--circular", action="store_true", help="default for columns ending in Deg")
+    parser.add_argument("--resamples", type=int, default=defaultResamples)
+    parser.add_argument("--chunk", type=int, default=defaultChunk)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    circular = args.circular or args.column.endswith("Deg")
+
+    subjects, conditions, table = subjectMeans(args.database, args.paradigm, args.column, circular)
+    complete = table[~isnan(table).any(axis=1)]
+    print(
+        "{} {}: {} subjects ({} with every condition), {} resamples, seed {}".format(
+            args.paradigm, args.column, len(subjects), len(complete), args.resamples, args.seed
+        )
+    )
+    resampler = Resampler(args.resamples, args.seed, args.chunk, args.processes)
+    try:
+        for index, condition in enumerate(conditions):
+            values = table[:, index]
+            values = values[~isnan(values)]
+            if len(values) < 2:
+                continue
+            mean, low, high = resampler.bootstrap(values, circular)
+            print("  {:<16} mean {:9.3f}  95% CI [{:9.3f}, {:9.3f}]".format(condition, mean, low, high))
+        if len(complete) >= 2 and len(conditions) > 1:
+            spread, p = resampler.omnibusTest(complete, circular)
+            print("  omnibus: spread of condition means {:.4g}, p = {:.4f}".format(spread, p))
+            for i in range(len(conditions)):
+                for j in range(i + 1, len(conditions)):
+                    difference, p = resampler.pairedTest(complete[:, i], complete[:, j], circular)
+                    print(
+                        "  {} - {}: {:9.3f}, p = {:.4f}".format(conditions[i], conditions[j], difference, p)
+                    )
+    finally:
+        resampler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,541 @@
+# ----------- SESSION RENDERER -------------
+# -----------------------------------------
+# Re-renders what the participant saw, frame by frame, from a session's
+# event log and plan: the dial with its markers and the dot at every logged
+# flip angle, the hold and report screens (the report dot following every
+# move key), ISI crosses, "YOU MISSED" screens, breaks and instructions (as
+# text: videos and images are not decoded). Every frame carries an overlay
+# with the session time, block, trial and frame number, the flip interval
+# (red when the frame was dropped), a flash when a trigger went out and a
+# strip with the flips, drops and triggers of the last second, so dropped
+# frames and trigger alignment can be audited without a participant.
+#
+# Frames are drawn with Pillow (a PsychoPy dependency) in a process pool,
+# no window or GPU needed. The output is either an H.264 video at the
+# session's refresh rate (ffmpeg, one segment per chunk, joined at the end)
+# or one PNG per screen change:
+#
+#     python sessionvideo.py data/libetrandom_12 configs/random_finger.json session.mp4
+#     python sessionvideo.py data/libetrandom_12 configs/random_finger.json frames/ --images --start 60 --end 90
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from math import cos, pi, radians, sin, sqrt
+
+from numpy import arange, array, median, searchsorted
+
+from eventlog import eventTypes, keyCodes, readEventLogs, screenCodes
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+screenNames = dict((code, name) for name, code in screenCodes.items())
+
+# Config keys the renderer needs, with the engine's defaults
+settingDefaults = {
+    "paradigm": None,
+    "conditionTypes": {},
+    "lockoutAngle": 0,
+    "markers": False,
+    "monDistance": 60,
+    "monWidth": 30,
+    "windowSize": None,
+    "textSize": 0.85,
+    "circleRadius": 2,
+    "tics": 12,
+    "stics": 60,
+    "dotColor": "red",
+    "instructionPos": [0, 4.0],
+    "breakText": "",
+    "readyText": "",
+    "missedText": "",
+    "thankYouText": "",
+}
+defaultWindowSize = [1920, 1080]
+overlayColor = (0, 0, 0)
+dropColor = (220, 0, 0)
+triggerColor = (0, 90, 220)
+triggerFlash = 0.1  # seconds a trigger stays flagged
+stripSeconds = 1.0  # time span of the flip/trigger strip
+
+
+def loadSettings(path):
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    settings = dict(settingDefaults)
+    settings.update((key, config[key]) for key in settingDefaults if key in config)
+    return settings
+
+
+# ------------- TIMELINE ---------------
+
+
+# Turn the event log into the list of screen states, one per visible change.
+# plan (optional): names the blocks and checks the logged starting angles.
+# Returns the timeline: states, their times, flip and drop times, triggers
+def buildTimeline(records, settings, plan=None):
+    conids = dict(
+        (conditionType["trialstart"], conid)
+        for conid, conditionType in settings["conditionTypes"].items()
+    )
+    planBlocks = []
+    if plan is not None:
+        planBlocks = plan["training"] + [
+            block for block in plan["main"] if block["condition"] != "-"
+        ]
+    planBlock = None
+    mismatches = 0
+    state = {
+        "screen": "setup",
+        "block": None,
+        "conid": None,
+        "trial": None,
+        "angle": None,
+        "markers": None,
+        "frame": None,
+        "interval": None,
+        "value": 0,
+    }
+    states, triggers, flips = [], [], []
+    lastFlip = None  # (frame, time) of the last flip of the current rotation
+
+    def emit(t, **changes):
+        state.update(changes)
+        entry = dict(state, time=t)
+        if states and states[-1]["time"] >= t:
+            # nothing was on screen in between
+            states[-1] = entry
+        else:
+            states.append(entry)
+
+    for t, kind, code, value in zip(
+        records["time"].tolist(),
+        records["type"].tolist(),
+        records["code"].tolist(),
+        records["value"].tolist(),
+    ):
+        if kind == eventTypes["flip"]:
+            interval = None
+            if lastFlip is not None and lastFlip[0] == code - 1:
+                interval = t - lastFlip[1]
+            lastFlip = (code, t)
+            flips.append((t, -1.0 if interval is None else interval))
+            emit(t, screen="rotation", angle=value, frame=code, interval=interval)
+        elif kind == eventTypes["screen"]:
+            name = screenNames.get(code, "unknown")
+            if name == "rotation":
+                # the screen before stays up until the first flip
+                lastFlip = None
+                continue
+            emit(t, screen=name, value=value, frame=None, interval=None)
+        elif kind == eventTypes["key"] and code == keyCodes["move"]:
+            emit(t, angle=value)
+        elif kind == eventTypes["trigger"]:
+            triggers.append((t, code))
+        elif kind == eventTypes["trial"]:
+            markers = None
+            if settings["markers"]:
+                markers = [value, value + settings["lockoutAngle"]]
+            state.update(trial=code, markers=markers, angle=value)
+            if planBlock is not None and 0 < code <= len(planBlock["trials"]):
+                if abs(planBlock["trials"][code - 1]["startAngle"] - value) > 1e-6:
+                    mismatches += 1
+        elif kind == eventTypes["block"]:
+            conid = conids.get(code, str(code))
+            label = conid
+            planBlock = None
+            # blocks the adaptive stopping rule skipped are not in the log
+            while planBlocks:
+                candidate = planBlocks.pop(0)
+                if candidate["conid"] == conid and bool(candidate["training"]) == bool(value):
+                    planBlock = candidate
+                    label = candidate["condition"]
+                    break
+            state.update(block=label + (" (training)" if value else ""), conid=conid, trial=None)
+    if mismatches:
+        print("WARNING: {} trials started at another angle than planned".format(mismatches))
+    intervals = [interval for t, interval in flips if interval > 0]
+    period = median(intervals) if intervals else 1 / 60.0
+    return {
+        "states": states,
+        "times": array([entry["time"] for entry in states]),
+        "flips": array([t for t, interval in flips]),
+        "drops": array([t for t, interval in flips if interval > 1.5 * period]),
+        "triggers": array([t for t, code in triggers]),
+        "triggerCodes": [code for t, code in triggers],
+        "period": period,
+    }
+
+
+# ------------- DRAWING ---------------
+
+
+class Renderer(object):
+    def __init__(self, settings, scale=0.5):
+        self.settings = settings
+        width, height = settings["windowSize"] or defaultWindowSize
+        # even sizes for yuv420p
+        self.size = (int(width * scale) // 2 * 2, int(height * scale) // 2 * 2)
+        # PsychoPy's deg units: cm = deg * distance * pi / 180
+        self.pixPerDeg = settings["monDistance"] * pi / 180 * width / settings["monWidth"] * scale
+        self.radius = settings["circleRadius"]
+        self.fixationSize = sqrt(self.radius) * 0.5
+        self._fonts = {}
+        self.dial = self._dial()
+
+    def toPix(self, x, y):
+        return (self.size[0] / 2 + x * self.pixPerDeg, self.size[1] / 2 - y * self.pixPerDeg)
+
+    def polar(self, angleDeg, radius):
+        angle = radians(angleDeg)
+        return self.toPix(radius * sin(angle), radius * cos(angle))
+
+    def font(self, heightDeg):
+        size = max(8, int(heightDeg * self.pixPerDeg))
+        if size not in self._fonts:
+            try:
+                self._fonts[size] = ImageFont.truetype("DejaVuSans.ttf", size)
+            except OSError:
+                try:
+                    self._fonts[size] = ImageFont.load_default(size)  # Pillow 10.1+
+                except TypeError:
+                    self._fonts[size] = ImageFont.load_default()
+        return self._fonts[size]
+
+    def _dial(self):
+        image = Image.new("RGB", self.size, "white")
+        draw = ImageDraw.Draw(image)
+        settings, radius = self.settings, self.radius
+        width = max(1, int(round(self.pixPerDeg * 0.05)))
+        for angle in range(0, 360, int(360 / settings["tics"])):
+            draw.line(
+                [self.polar(angle, radius), self.polar(angle, radius * 1.2)], "black", width * 2
+            )
+        for angle in range(0, 360, int(360 / settings["stics"])):
+            draw.line(
+                [self.polar(angle, radius * 1.08), self.polar(angle, radius * 1.188)],
+                "black",
+                width,
+            )
+        return image
+
+    def text(self, draw, text, heightDeg, pos=(0, 0), color="black"):
+        if text:
+            draw.multiline_text(
+                self.toPix(*pos),
+                text,
+                fill=color,
+                font=self.font(heightDeg),
+                anchor="mm",
+                align="center",
+            )
+
+    def cross(self, draw, heightDeg):
+        half = heightDeg * 0.3
+        draw.line(
+            [self.toPix(-half, 0), self.toPix(half, 0)],
+            "black",
+            max(1, int(half * self.pixPerDeg / 4)),
+        )
+        draw.line(
+            [self.toPix(0, -half), self.toPix(0, half)],
+            "black",
+            max(1, int(half * self.pixPerDeg / 4)),
+        )
+
+    # The screen of one state, without the overlay
+    def screen(self, state):
+        settings, screen = self.settings, state["screen"]
+        conditionType = settings["conditionTypes"].get(state["conid"], {})
+        if screen in ("rotation", "hold", "report"):
+            image = self.dial.copy()
+            draw = ImageDraw.Draw(image)
+            self.cross(draw, self.fixationSize)
+            if screen == "rotation" and state["markers"]:
+                for angle in state["markers"]:
+                    draw.line(
+                        [self.toPix(0, 0), self.polar(angle, self.radius * 1.08)],
+                        (128, 128, 128),
+                        2,
+                    )
+            if screen == "report":
+                self.text(
+                    draw,
+                    conditionType.get("question", ""),
+                    settings["textSize"],
+                    (0, self.radius * 4),
+                )
+            if screen != "hold" and state["angle"] is not None:
+                x, y = self.polar(state["angle"], self.radius)
+                r = self.radius / 10 * self.pixPerDeg
+                draw.ellipse([x - r, y - r, x + r, y + r], fill=settings["dotColor"])
+            return image
+        image = Image.new("RGB", self.size, "white")
+        draw = ImageDraw.Draw(image)
+        if screen == "isi":
+            self.cross(draw, 2)
+        elif screen == "preparation":
+            self.text(draw, "preparation", 2)
+        elif screen == "instruction":
+            self.text(
+                draw,
+                conditionType.get("instruction", ""),
+                settings["textSize"],
+                settings["instructionPos"],
+            )
+            if state["value"]:
+                self.text(
+                    draw,
+                    "[video {}]".format(conditionType.get("instru_img")),
+                    settings["textSize"],
+                    (0, -3),
+                )
+        elif screen == "missed":
+            self.text(draw, settings["missedText"], self.fixationSize)
+        elif screen == "break":
+            text = settings["breakText"] or ""
+            try:
+                text = text.format(int(state["value"]), "?")
+            except (IndexError, KeyError, ValueError):
+                pass
+            self.text(draw, text, self.fixationSize)
+        elif screen == "ready":
+            self.text(draw, settings["readyText"], self.fixationSize)
+        elif screen == "end":
+            self.text(draw, settings["thankYouText"], settings["textSize"], (0, self.radius * 4))
+        return image
+
+    # Session time, block, trial, frame and flip interval; trigger flash and
+    # the strip of the last second's flips, drops and triggers
+    def overlay(self, image, state, t, timeline):
+        draw = ImageDraw.Draw(image)
+        font = self.font(0.4)
+        lines = "t {:9.3f} s  {}  block {}  trial {}".format(
+            t, state["screen"], state["block"] or "-", state["trial"] or "-"
+        )
+        color = overlayColor
+        if state["frame"] is not None:
+            lines += "\nframe {}".format(state["frame"])
+            if state["interval"] is not None:
+                lines += "  interval {:.2f} ms".format(state["interval"] * 1000)
+                if state["interval"] > 1.5 * timeline["period"]:
+                    lines += "  DROPPED"
+                    color = dropColor
+        draw.multiline_text((8, 8), lines, fill=color, font=font)
+
+        triggers = timeline["triggers"]
+        first, last = searchsorted(triggers, [t - stripSeconds, t], side="right")
+        if last > first and t - triggers[last - 1] < triggerFlash:
+            box = self.size[0] - 8 - self.size[1] // 12
+            draw.rectangle([box, 8, self.size[0] - 8, 8 + self.size[1] // 12], fill=triggerColor)
+            draw.text(
+                (box - 4, 8),
+                "trigger {}".format(timeline["triggerCodes"][last - 1]),
+                fill=triggerColor,
+                font=font,
+                anchor="ra",
+            )
+
+        # Strip: stripSeconds up to now, flips grey, drops red, triggers blue
+        top, bottom = self.size[1] - self.size[1] // 20, self.size[1] - 4
+        width = self.size[0] - 16
+
+        def x(eventTime):
+            return 8 + width * (1 - (t - eventTime) / stripSeconds)
+
+        draw.rectangle([8, top, 8 + width, bottom], outline=(200, 200, 200))
+        for name, color, height in (
+            ("flips", (160, 160, 160), 0.5),
+            ("drops", dropColor, 1.0),
+            ("triggers", triggerColor, 1.0),
+        ):
+            times = timeline[name]
+            first, last = searchsorted(times, [t - stripSeconds, t], side="right")
+            for eventTime in times[first:last].tolist():
+                draw.line(
+                    [(x(eventTime), bottom - (bottom - top) * height), (x(eventTime), bottom)],
+                    color,
+                    2,
+                )
+        return image
+
+    def frame(self, index, t, timeline):
+        return self.overlay(
+            self.screen(timeline["states"][index]), timeline["states"][index], t, timeline
+        )
+
+
+# ------------- WORKERS ---------------
+
+_worker = None
+
+
+def _initWorker(settings, scale, timeline):
+    global _worker
+    _worker = (Renderer(settings, scale), timeline)
+
+
+# Render the frames at times (seconds) into one video segment
+def _renderSegment(times, path, fps, ffmpeg, crf):
+    renderer, timeline = _worker
+    # one encoder thread per segment, the pool runs the segments in parallel
+    command = [ffmpeg] + "-loglevel error -y -f rawvideo -pix_fmt rgb24".split()
+    command += ["-s", "{}x{}".format(*renderer.size), "-r", str(fps), "-i", "-"]
+    command += "-c:v libx264 -preset veryfast -threads 1 -pix_fmt yuv420p -crf".split()
+    command += [str(crf), path]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    indices = searchsorted(timeline["times"], times, side="right") - 1
+    cached = (None, None)  # the screen is only drawn again when the state changes
+    for index, t in zip(indices.tolist(), times.tolist()):
+        index = max(index, 0)
+        if cached[0] != index:
+            cached = (index, renderer.screen(timeline["states"][index]))
+        process.stdin.write(
+            renderer.overlay(cached[1].copy(), timeline["states"][index], t, timeline).tobytes()
+        )
+    process.stdin.close()
+    if process.wait():
+        raise RuntimeError("ffmpeg failed on {}".format(path))
+    return len(times)
+
+
+# Render the states with the given indices as PNG files
+def _renderImages(indices, folder):
+    renderer, timeline = _worker
+    for index in indices:
+        t = timeline["times"][index]
+        renderer.frame(index, t, timeline).save(
+            os.path.join(folder, "{:07d}_{:010.4f}.png".format(index, t)), compress_level=1
+        )
+    return len(indices)
+
+
+def render(
+    timeline,
+    settings,
+    output,
+    images=False,
+    start=None,
+    end=None,
+    fps=None,
+    scale=0.5,
+    processes=1,
+    chunkSeconds=10.0,
+    ffmpeg="ffmpeg",
+    crf=23,
+):
+    times = timeline["times"]
+    start = times[0] if start is None else times[0] + start
+    end = times[-1] + 1.0 if end is None else times[0] + end
+    fps = fps or round(1 / timeline["period"], 3)
+    context = multiprocessing.get_context("spawn")
+    initArgs = (settings, scale, timeline)
+    if processes > 1:
+        pool = ProcessPoolExecutor(
+            processes, mp_context=context, initializer=_initWorker, initargs=initArgs
+        )
+        run = pool.map
+    else:
+        pool = None
+        _initWorker(*initArgs)
+        run = map
+    try:
+        if images:
+            if not os.path.isdir(output):
+                os.makedirs(output)
+            first, last = searchsorted(times, [start, end])
+            perChunk = max(1, min(int(chunkSeconds * fps), -(-(last - first) // processes)))
+            chunks = [list(range(i, min(i + perChunk, last))) for i in range(first, last, perChunk)]
+            return sum(run(_renderImages, chunks, [output] * len(chunks)))
+        folder = tempfile.mkdtemp(prefix="sessionvideo")
+        try:
+            frameTimes = start + arange(int((end - start) * fps)) / fps
+            # at most chunkSeconds per segment, but enough segments for every process
+            perChunk = max(1, min(int(chunkSeconds * fps), -(-len(frameTimes) // processes)))
+            chunks = [frameTimes[i : i + perChunk] for i in range(0, len(frameTimes), perChunk)]
+            paths = [os.path.join(folder, "{:05d}.mp4".format(n)) for n in range(len(chunks))]
+            n = len(chunks)
+            frames = sum(run(_renderSegment, chunks, paths, [fps] * n, [ffmpeg] * n, [crf] * n))
+            listPath = os.path.join(folder, "segments.txt")
+            with open(listPath, "w") as f:
+                f.writelines("file '{}'\n".format(path) for path in paths)
+            command = [ffmpeg] + "-loglevel error -y -f concat -safe 0 -i".split()
+            subprocess.check_call(command + [listPath, "-c", "copy", output])
+            return frames
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-render a session offscreen from its event log")
+    parser.add_argument("prefix", help="session file prefix, e.g. data/libetrandom_12")
+    parser.add_argument("config", help="the session's paradigm config")
+    parser.add_argument("output", help="video file (.mp4) or, with --images, a folder")
+    parser.add_argument("--images", action="store_true", help="one PNG per screen change")
+    parser.add_argument("--start", type=float, help="seconds after the first event")
+    parser.add_argument("--end", type=float, help="seconds after the first event")
+    parser.add_argument(
+        "--fps", type=float, help="video frame rate (default: the session's refresh rate)"
+    )
+    parser.add_argument("--scale", type=float, default=0.5, help="of the session's window size")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--crf", type=int, default=23, help="H.264 quality, lower is better")
+    args = parser.parse_args()
+    if Image is None:
+        parser.error("Pillow is needed (pip install pillow)")
+    if not args.images and shutil.which(args.ffmpeg) is None:
+        parser.error("ffmpeg not found, install it, pass --ffmpeg or use --images")
+
+    settings = loadSettings(args.config)
+    plan = None
+    if os.path.exists(args.prefix + "_plan.json"):
+        with open(args.prefix + "_plan.json") as f:
+            plan = json.load(f)
+    timeline = buildTimeline(readEventLogs(args.prefix + "_events.bin"), settings, plan)
+    if not timeline["states"]:
+        parser.error("nothing to render")
+    print(
+        "{} screen states, {} flips ({} dropped), {} triggers, refresh {:.2f} Hz".format(
+            len(timeline["states"]),
+            len(timeline["flips"]),
+            len(timeline["drops"]),
+            len(timeline["triggers"]),
+            1 / timeline["period"],
+        )
+    )
+    startTime = time.perf_counter()
+    frames = render(
+        timeline,
+        settings,
+        args.output,
+        args.images,
+        args.start,
+        args.end,
+        args.fps,
+        args.scale,
+        args.processes,
+        ffmpeg=args.ffmpeg,
+        crf=args.crf,
+    )
+    seconds = time.perf_counter() - startTime
+    print(
+        "{} frames in {:.1f} s ({:.0f} frames/s) -> {}".format(
+            frames, seconds, frames / seconds, args.output
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
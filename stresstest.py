@@ -0,0 +1,503 @@
+# ------------- STRESS TEST ---------------
+# ----------------------------------------
+# Certifies a lab PC for the rotation loop. The loop of runBlock (the trial
+# logic of triallogic.py, real-time mode, event logging of every flip, a
+# trigger at trial start and at the "press") runs for a while at every load
+# level while controlled contention is injected:
+#
+#   cpu       busy processes, the fraction of the cores given
+#   memory    a process allocating and touching this many MB over and over
+#   disk      a process writing and fsyncing this many MB/s
+#   threads   Python threads in the session's own process (GIL contention,
+#             like an extra worker or logger thread), at most one per CPU
+#             besides the one the loop runs on: the level is skipped on a
+#             single-CPU machine, where busy threads take the CPU from the
+#             loop itself and it fails however fast the machine is
+#
+# and the drop rate, the worst and 99th percentile flip interval, the
+# latest wake-up after a flip and the trigger latency are recorded per
+# level. Every level must stay within the limits, and within the machine's
+# stored baseline when there is one; the report says PASS or FAIL per check
+# and overall, and the exit code is 1 on FAIL.
+#
+# "windowed" flips a real PsychoPy window with the clock face and the dial of
+# the config, on its monitor, drawn the way the session draws it: the batched
+# dial layer with batchedDial, else the dot, fixation and marker stimuli.
+# "offscreen" needs no display and no PsychoPy: flips are slots of a software
+# refresh clock, and a frame counts as dropped when it was not ready by its
+# slot. Without PsychoPy real-time mode does not
+# raise the priority.
+#
+#     python stresstest.py --mode windowed --config configs/random_finger.json
+#     python stresstest.py --baseline stress_baseline.json --save-baseline
+#     python stresstest.py --levels idle cpu100 threads --seconds 30
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from math import ceil, cos, radians, sin, sqrt
+
+from numpy import array, diff, percentile
+
+from eventlog import EventLog
+from realtime import RealtimeGuard
+from timingcheck import Results
+from triallogic import Rotation, msScale
+
+try:
+    import pyxid2
+except ImportError:
+    pyxid2 = None
+
+# Load levels, in the order they run
+defaultLevels = [
+    ("idle", {}),
+    ("cpu50", {"cpu": 0.5}),
+    ("cpu100", {"cpu": 1.0}),
+    ("memory", {"memory": 512}),
+    ("disk", {"disk": 50}),
+    ("threads", {"threads": 2}),
+    ("combined", {"cpu": 0.5, "memory": 256, "disk": 20, "threads": 1}),
+]
+# Allowed increase over the baseline per metric, absolute
+baselineSlack = {
+    "dropRate": 0.002,
+    "worstIntervalMs": 17.0,
+    "p99IntervalMs": 2.0,
+    "triggerP99Ms": 0.5,
+}
+
+
+# ------------- LOAD ---------------
+
+
+def _cpuLoad(stopEvent):
+    x = 0
+    while not stopEvent.is_set():
+        for i in range(10000):
+            x += i * i
+
+
+def _memoryLoad(stopEvent, megabytes):
+    while not stopEvent.is_set():
+        block = bytearray(megabytes << 20)
+        for offset in range(0, len(block), 4096):
+            block[offset] = 1
+        del block
+
+
+def _diskLoad(stopEvent, megabytesPerSecond, folder):
+    chunk = os.urandom(1 << 20)
+    path = os.path.join(folder, "stress_{}.bin".format(os.getpid()))
+    written = 0
+    start = time.time()
+    with open(path, "wb") as f:
+        while not stopEvent.is_set():
+            if written >= megabytesPerSecond * (time.time() - start):
+                time.sleep(0.01)
+                continue
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+            written += 1
+            if f.tell() > 256 << 20:
+                f.seek(0)
+    os.remove(path)
+
+
+def _threadLoad(stopEvent):
+    while not stopEvent.is_set():
+        sum(i for i in range(1000))
+
+
+# Busy threads of a load, one CPU is left to the loop
+def threadCount(load):
+    return min(int(load.get("threads", 0)), multiprocessing.cpu_count() - 1)
+
+
+class Load(object):
+    # load: {"cpu": fraction of cores, "memory": MB, "disk": MB/s, "threads": n}
+    def __init__(self, load, folder):
+        self.load = load
+        self.folder = folder
+        ctx = multiprocessing.get_context("spawn")
+        self._stop = ctx.Event()
+        self._threadStop = threading.Event()
+        self._processes = []
+        self._threads = []
+        if load.get("cpu"):
+            for i in range(max(1, int(round(load["cpu"] * multiprocessing.cpu_count())))):
+                self._processes.append(
+                    ctx.Process(target=_cpuLoad, args=(self._stop,), daemon=True)
+                )
+        if load.get("memory"):
+            self._processes.append(
+                ctx.Process(target=_memoryLoad, args=(self._stop, int(load["memory"])), daemon=True)
+            )
+        if load.get("disk"):
+            self._processes.append(
+                ctx.Process(target=_diskLoad, args=(self._stop, load["disk"], folder), daemon=True)
+            )
+        for i in range(threadCount(load)):
+            self._threads.append(
+                threading.Thread(target=_threadLoad, args=(self._threadStop,), daemon=True)
+            )
+
+    def __enter__(self):
+        for worker in self._processes + self._threads:
+            worker.start()
+        time.sleep(1.0 if self._processes else 0.0)  # let the processes get going
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._threadStop.set()
+        for worker in self._processes + self._threads:
+            worker.join(5.0)
+
+
+# ------------- ROTATION LOOP ---------------
+
+
+class OffscreenDisplay(object):
+    # Flips are slots of a refresh clock: a frame is shown at the first slot
+    # after it is ready, so a frame not ready in time is a dropped frame
+    def __init__(self, frameRate):
+        self.period = 1.0 / frameRate
+        self.start = time.perf_counter()
+        self.lastSlot = 0
+        self.wakeLatency = []
+
+    def flip(self):
+        slot = max(self.lastSlot + 1, int(ceil((time.perf_counter() - self.start) / self.period)))
+        target = self.start + slot * self.period
+        # sleep most of the way, then spin, like a driver waiting for the vertical blank
+        remaining = target - time.perf_counter()
+        if remaining > 0.002:
+            time.sleep(remaining - 0.002)
+        while time.perf_counter() < target:
+            pass
+        self.wakeLatency.append(time.perf_counter() - target)
+        self.lastSlot = slot
+        return target
+
+    def draw(self, angle):
+        pass
+
+    def close(self):
+        pass
+
+
+class WindowedDisplay(object):
+    # config: engine config (engine.loadConfig), for the monitor, window and dial
+    def __init__(self, config, fullscr):
+        from psychopy import visual
+
+        from dialbatch import DialLayer
+        from engine import makeClockFace, makeMonitor
+
+        monitor = makeMonitor(config)
+        self.win = visual.Window(
+            monitor=monitor,
+            size=config["windowSize"] or monitor.getSizePix(),
+            fullscr=fullscr or config["fullscr"],
+            allowGUI=config["allowGUI"],
+            color="white",
+            units="deg",
+        )
+        self.period = self.win.monitorFramePeriod
+        # sizes and stimuli as in LibetSession._makeStimuli
+        self.radius = radius = config["circleRadius"]
+        fixationSize = sqrt(radius) * 0.5
+        dotSize = radius / 5
+        self.circle = makeClockFace(self.win, config)
+        self.dial = None
+        if config["batchedDial"]:
+            self.dial = DialLayer(
+                self.win,
+                radius,
+                dotSize,
+                dotColor=config["dotColor"],
+                fixationSize=fixationSize,
+                markers=config["markers"],
+            )
+        else:
+            self.dot = visual.PatchStim(
+                win=self.win, mask="circle", color=config["dotColor"], tex=None, size=dotSize
+            )
+            self.stims = [
+                visual.TextStim(
+                    self.win, text="+", color="black", height=fixationSize, antialias=False
+                )
+            ]
+            if config["markers"]:
+                self.stims += [
+                    visual.Line(
+                        self.win,
+                        start=(0, 0),
+                        end=(
+                            radius * 1.08 * sin(radians(offset)),
+                            radius * 1.08 * cos(radians(offset)),
+                        ),
+                        lineColor=(0, 0, 0, 0.5),
+                        lineWidth=2,
+                    )
+                    for offset in [0, config["lockoutAngle"]]
+                ]
+        self.wakeLatency = []
+
+    # as the session draws a rotation frame
+    def draw(self, angle):
+        self.circle.draw()
+        if self.dial is not None:
+            self.dial.draw(angle)
+            return
+        for stim in self.stims:
+            stim.draw()
+        self.dot.setPos([self.radius * sin(radians(angle)), self.radius * cos(radians(angle))])
+        self.dot.draw()
+
+    def flip(self):
+        return self.win.flip()
+
+    def close(self):
+        if self.dial is not None:
+            self.dial.close()
+        self.win.close()
+
+
+class Triggers(object):
+    # Times the trigger call of the first XID device, as runBlock does; without
+    # a device there is nothing to time
+    def __init__(self):
+        self.dev = None
+        if pyxid2 is not None:
+            devices = pyxid2.get_xid_devices()
+            if devices:
+                self.dev = devices[0]
+        self.latency = []
+
+    def send(self, bitmask):
+        if self.dev is None:
+            return
+        start = time.perf_counter()
+        self.dev.activate_line(bitmask=bitmask)
+        self.latency.append(time.perf_counter() - start)
+
+
+# Run rotations for the given number of seconds, returns the flip times
+def runRotations(display, eventLog, rtGuard, triggers, libetTime, seconds):
+    dotStep = 360 / libetTime * display.period
+    framesPerTrial = int(libetTime / display.period)
+    flips = []
+    end = time.perf_counter() + seconds
+    trialNo = 0
+    while time.perf_counter() < end:
+        trialNo += 1
+        rotation = Rotation(0.0, dotStep)
+        rtGuard.enter()
+        eventLog.log("trial", trialNo, 0.0)
+        triggers.send(1)
+        trialFlips = []
+        for frameN in range(1, framesPerTrial + 1):
+            angle = rotation.advance()
+            display.draw(angle)
+            flipTime = display.flip()
+            eventLog.log("flip", frameN, angle, flipTime)
+            trialFlips.append(flipTime)
+            if frameN == framesPerTrial // 2:
+                # the "press"
+                triggers.send(2)
+        rtGuard.exit()
+        flips.append(trialFlips)
+        rtGuard.idle(0.2)
+    return flips
+
+
+def measure(flips, display, triggers):
+    intervals = array([interval for trial in flips for interval in diff(trial)])
+    period = display.period
+    metrics = {
+        "frames": int(len(intervals)),
+        "dropRate": float((intervals > 1.5 * period).mean()) if len(intervals) else 0.0,
+        "worstIntervalMs": float(intervals.max() * msScale) if len(intervals) else 0.0,
+        "p99IntervalMs": float(percentile(intervals, 99) * msScale) if len(intervals) else 0.0,
+    }
+    if display.wakeLatency:
+        metrics["worstWakeMs"] = max(display.wakeLatency) * msScale
+    if triggers.latency:
+        metrics["triggerP99Ms"] = float(percentile(triggers.latency, 99) * msScale)
+        metrics["triggerWorstMs"] = max(triggers.latency) * msScale
+    display.wakeLatency = []
+    triggers.latency = []
+    return metrics
+
+
+# ------------- REPORT ---------------
+
+
+def machineInfo(display):
+    return {
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": multiprocessing.cpu_count(),
+        "python": platform.python_version(),
+        "refreshHz": 1 / display.period,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def certify(results, level, metrics, limits, baseline=None):
+    period = limits["periodMs"]
+    results.check(
+        level + " drop rate",
+        metrics["dropRate"] <= limits["maxDropRate"],
+        "{:.3%} of {} frames (limit {:.3%})".format(
+            metrics["dropRate"], metrics["frames"], limits["maxDropRate"]
+        ),
+    )
+    results.check(
+        level + " worst interval",
+        metrics["worstIntervalMs"] <= limits["maxWorstFrames"] * period * 1.1,
+        "{:.2f} ms (limit {:.0f} frames)".format(
+            metrics["worstIntervalMs"], limits["maxWorstFrames"]
+        ),
+    )
+    if "triggerP99Ms" in metrics:
+        results.check(
+            level + " trigger latency",
+            metrics["triggerP99Ms"] <= limits["maxTriggerMs"],
+            "p99 {:.2f} ms, worst {:.2f} ms (limit {} ms)".format(
+                metrics["triggerP99Ms"], metrics["triggerWorstMs"], limits["maxTriggerMs"]
+            ),
+        )
+    for name, slack in sorted(baselineSlack.items()):
+        if baseline and name in baseline and name in metrics:
+            limit = baseline[name] + slack
+            results.check(
+                "{} baseline {}".format(level, name),
+                metrics[name] <= limit,
+                "{:.4g} (baseline {:.4g}, limit {:.4g})".format(
+                    metrics[name], baseline[name], limit
+                ),
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Certify a PC for the rotation loop under load")
+    parser.add_argument("--mode", choices=["offscreen", "windowed"], default="offscreen")
+    parser.add_argument("--fullscr", action="store_true", help="windowed mode: full screen")
+    parser.add_argument("--config", help="paradigm config (libetTime, dial)")
+    parser.add_argument("--frame-rate", type=float, default=60.0, help="offscreen refresh rate")
+    parser.add_argument(
+        "--levels",
+        nargs="+",
+        help="load levels to run: " + ", ".join(name for name, load in defaultLevels),
+    )
+    parser.add_argument("--seconds", type=float, default=20.0, help="per load level")
+    parser.add_argument("--no-realtime", action="store_true", help="run without real-time mode")
+    parser.add_argument("--max-drop-rate", type=float, default=0.001)
+    parser.add_argument(
+        "--max-worst-frames", type=float, default=2.0, help="worst flip interval, frames"
+    )
+    parser.add_argument("--max-trigger-ms", type=float, default=2.0, help="99th percentile")
+    parser.add_argument("--baseline", help="JSON file of this machine's baseline metrics per level")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="store this run as the baseline"
+    )
+    parser.add_argument("--report", help="certification report (JSON), default stress_<host>.json")
+    args = parser.parse_args()
+
+    settings = {}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            settings = json.load(f)
+    libetTime = settings.get("libetTime", 2.56)
+    levels = []
+    for name, load in defaultLevels:
+        if args.levels and name not in args.levels:
+            continue
+        if load.get("threads") and not threadCount(load) and len(load) == 1:
+            print("SKIP {}: needs a second CPU for the busy threads".format(name))
+            continue
+        levels.append((name, load))
+
+    if args.mode == "windowed":
+        # the engine needs PsychoPy, only this mode imports it
+        from engine import defaults, loadConfig
+
+        config = loadConfig(args.config) if args.config else defaults
+        display = WindowedDisplay(config, args.fullscr)
+    else:
+        display = OffscreenDisplay(args.frame_rate)
+    folder = tempfile.mkdtemp(prefix="stresstest")
+    eventLog = EventLog(os.path.join(folder, "stress_events.bin"), clock=time.perf_counter)
+    rtGuard = RealtimeGuard(enabled=not args.no_realtime)
+    triggers = Triggers()
+    baseline = None
+    if args.baseline and not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    limits = {
+        "periodMs": display.period * msScale,
+        "maxDropRate": args.max_drop_rate,
+        "maxWorstFrames": args.max_worst_frames,
+        "maxTriggerMs": args.max_trigger_ms,
+    }
+    report = {"machine": machineInfo(display), "mode": args.mode, "limits": limits, "levels": {}}
+    if args.mode == "windowed":
+        # the render path certified
+        report["batchedDial"] = bool(config["batchedDial"])
+    print(
+        "{host}: {platform}, {cpus} CPUs, {refreshHz:.1f} Hz ({mode})".format(
+            mode=args.mode, **report["machine"]
+        )
+    )
+    if triggers.dev is None:
+        print("No XID device, trigger latency is not measured")
+    results = Results()
+    try:
+        for name, load in levels:
+            with Load(load, folder):
+                flips = runRotations(display, eventLog, rtGuard, triggers, libetTime, args.seconds)
+            metrics = measure(flips, display, triggers)
+            report["levels"][name] = {
+                "load": load,
+                "threads": threadCount(load),
+                "metrics": metrics,
+            }
+            certify(results, name, metrics, limits, (baseline or {}).get(name))
+    finally:
+        rtGuard.close()
+        eventLog.close()
+        display.close()
+        shutil.rmtree(folder, ignore_errors=True)
+    report["failed"] = results.failed
+    report["verdict"] = "FAIL" if results.failed else "PASS"
+    reportPath = args.report or "stress_{}.json".format(report["machine"]["host"])
+    with open(reportPath, "w") as f:
+        json.dump(report, f, indent=1)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(
+                dict((name, level["metrics"]) for name, level in report["levels"].items()),
+                f,
+                indent=1,
+            )
+        print("Baseline saved to {}".format(args.baseline))
+    print(
+        "{}: {} checks failed, report in {}".format(report["verdict"], results.failed, reportPath)
+    )
+    sys.exit(1 if results.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
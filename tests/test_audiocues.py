@@ -0,0 +1,93 @@
+# Cue triggers of audiocues.py: kept clear of the trigger before them, and
+# none left over when a pause without flips begins
+import pytest
+
+from audiocues import CueTriggers
+
+period = 1 / 60.0
+gap = 0.02
+eegLine, pressCue, missedCue = 2, 51, 53
+
+
+class FakeClock(object):
+    def __init__(self, t=0.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+    def wait(self, seconds):
+        self.t += seconds
+
+
+class FakeEventLog(object):
+    def __init__(self):
+        self.records = []
+
+    def log(self, kind, code, value):
+        self.records.append((kind, code, value))
+
+
+@pytest.fixture
+def setup():
+    clock = FakeClock(1.0)
+    sent = []
+    eventLog = FakeEventLog()
+    triggers = CueTriggers(
+        lambda code: sent.append((code, clock())), eventLog, gap, clock, clock.wait
+    )
+    return clock, sent, eventLog, triggers
+
+
+# The press with dotDelay 0: the eegLine trigger and the press cue go out
+# together, the rotation ends and only the hold flip follows, a frame later
+def test_press_trigger_within_gap_is_flushed_before_the_hold(setup):
+    clock, sent, eventLog, triggers = setup
+    lastTrigger = clock()
+    sent.append((eegLine, lastTrigger))
+    triggers.add(pressCue, clock())
+    clock.t += period
+    triggers.flipped(clock(), lastTrigger, period)
+    assert sent == [(eegLine, 1.0)]  # the hold flip is inside the gap
+    triggers.flush(lastTrigger)
+    assert len(triggers) == 0
+    assert sent[-1] == (pressCue, pytest.approx(1.0 + gap))
+    assert eventLog.records == [("audioTrigger", pressCue, pytest.approx(gap))]
+
+
+def test_flush_spaces_triggers_by_the_gap(setup):
+    clock, sent, eventLog, triggers = setup
+    triggers.add(pressCue, clock())
+    triggers.add(missedCue, clock() + 0.005)
+    last = triggers.flush(clock())
+    times = [t for code, t in sent]
+    assert [code for code, t in sent] == [pressCue, missedCue]
+    assert times == pytest.approx([1.0 + gap, 1.0 + 2 * gap])
+    assert last == pytest.approx(times[-1])
+
+
+def test_flush_waits_for_the_cue(setup):
+    clock, sent, eventLog, triggers = setup
+    triggers.add(pressCue, clock() + 0.1)
+    triggers.flush(None)
+    assert sent == [(pressCue, pytest.approx(1.1))]
+
+
+def test_flipped_sends_one_trigger_per_flip(setup):
+    clock, sent, eventLog, triggers = setup
+    triggers.add(pressCue, clock())
+    triggers.add(missedCue, clock())
+    triggers.flipped(clock(), None, period)
+    assert sent == [(pressCue, 1.0)]
+    clock.t += period
+    triggers.flipped(clock(), 1.0, period)  # inside the gap
+    clock.t += period
+    triggers.flipped(clock(), 1.0, period)
+    assert sent == [(pressCue, 1.0), (missedCue, pytest.approx(1.0 + 2 * period))]
+
+
+def test_flipped_keeps_triggers_of_later_flips(setup):
+    clock, sent, eventLog, triggers = setup
+    triggers.add(pressCue, clock() + period)
+    triggers.flipped(clock(), None, period)
+    assert sent == [] and len(triggers) == 1
@@ -0,0 +1,38 @@
+# Sampling profiler of profiler.py: samples counted per block and trial,
+# repeated blocks of one condition type kept apart
+import json
+import time
+
+from profiler import SamplingProfiler, blockLabel
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_block_label():
+    assert blockLabel("Finger_press1") == "Finger_press1"
+    assert blockLabel("Finger_press1", training=True) == "Finger_press1_training"
+
+
+# Finger_press1, Finger_press2 and the training block share the conid
+# Finger_press; each is counted under its own name
+def test_blocks_sharing_a_conid_are_counted_apart(tmp_path):
+    profiler = SamplingProfiler(interval=0.002)
+    blocks = [blockLabel("Finger_press1", True), "Finger_press1", "Finger_press2"]
+    profiler.start()
+    for block in blocks:
+        profiler.tag("rotation", block, 1)
+        busy(0.15)
+    profiler.tag("end")
+    summary = profiler.write(str(tmp_path / "session"))
+    counted = set(block for block, trial, phase in profiler.trials)
+    assert counted == set(blocks)
+    assert set(entry["block"] for entry in summary["trials"]) == set(blocks)
+    with open(str(tmp_path / "session_profile.json"), encoding="utf-8") as f:
+        assert json.load(f)["trials"] == summary["trials"]
+    with open(str(tmp_path / "session_profile_rotation.folded"), encoding="utf-8") as f:
+        roots = set(line.split(";", 1)[0] for line in f)
+    assert roots == set("block " + block for block in blocks)
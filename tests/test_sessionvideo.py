@@ -0,0 +1,113 @@
+# Session renderer of sessionvideo.py: the timeline built from a synthetic
+# event log, and rendering it (skipped without Pillow or ffmpeg)
+import os
+import shutil
+
+import pytest
+from numpy import array
+
+import sessionvideo
+from eventlog import eventTypes, keyCodes, openEventLogFile, readEventLogs, recordDtype, screenCodes
+
+config = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs", "random_finger.json"
+)
+period = 1 / 60.0
+frames = 20
+droppedFrame = 10  # flipped one period late
+
+
+# A short training block: ISI, one rotation with a dropped frame and a
+# trigger on its first flip, then hold and report
+def writeSession(path, settings):
+    conid, conditionType = sorted(settings["conditionTypes"].items())[0]
+    events = [
+        (0.0, "block", conditionType["trialstart"], 1.0),
+        (0.0, "screen", screenCodes["isi"], 0.0),
+        (0.5, "trial", 1, 90.0),
+        (0.5, "screen", screenCodes["rotation"], 0.0),
+    ]
+    t = 0.5
+    for frame in range(1, frames + 1):
+        t += 2 * period if frame == droppedFrame else period
+        events.append((t, "flip", frame, 90.0 + 2.0 * frame))
+        if frame == 1:
+            events.append((t, "trigger", conditionType["trialstart"], 1.0))
+    events += [
+        (t + 0.01, "key", keyCodes["press"], t + 0.01 - 0.5),
+        (t + 0.1, "screen", screenCodes["hold"], 0.0),
+        (t + 0.6, "screen", screenCodes["report"], 0.0),
+        (t + 0.7, "key", keyCodes["move"], 120.0),
+    ]
+    records = array(
+        [(time, eventTypes[kind], code, value) for time, kind, code, value in events],
+        dtype=recordDtype,
+    )
+    with openEventLogFile(path) as f:
+        f.write(records.tobytes())
+    return conid
+
+
+@pytest.fixture
+def session(tmp_path):
+    settings = sessionvideo.loadSettings(config)
+    path = str(tmp_path / "session_events.bin")
+    conid = writeSession(path, settings)
+    timeline = sessionvideo.buildTimeline(readEventLogs(path), settings)
+    return settings, timeline, conid
+
+
+# ------------- TIMELINE ---------------
+
+
+def test_timeline_has_a_state_per_flip(session):
+    settings, timeline, conid = session
+    screens = [state["screen"] for state in timeline["states"]]
+    assert screens == ["isi"] + ["rotation"] * frames + ["hold", "report", "report"]
+    assert len(timeline["flips"]) == frames
+    assert [state["frame"] for state in timeline["states"][1 : frames + 1]] == list(
+        range(1, frames + 1)
+    )
+    assert timeline["states"][-1]["angle"] == 120.0
+    assert timeline["states"][1]["block"] == conid + " (training)"
+    assert timeline["period"] == pytest.approx(period)
+
+
+def test_timeline_marks_the_dropped_frame(session):
+    settings, timeline, conid = session
+    dropped = timeline["states"][droppedFrame]
+    assert dropped["frame"] == droppedFrame
+    assert dropped["interval"] == pytest.approx(2 * period)
+    assert timeline["drops"].tolist() == [dropped["time"]]
+    # the first flip has no interval: the screen before stayed up until it
+    assert timeline["states"][1]["interval"] is None
+
+
+def test_timeline_keeps_triggers(session):
+    settings, timeline, conid = session
+    assert timeline["triggers"].tolist() == [timeline["flips"][0]]
+    assert timeline["triggerCodes"] == [settings["conditionTypes"][conid]["trialstart"]]
+
+
+# ------------- RENDERING ---------------
+
+
+def test_render_images(session, tmp_path):
+    pytest.importorskip("PIL")
+    settings, timeline, conid = session
+    folder = str(tmp_path / "frames")
+    count = sessionvideo.render(timeline, settings, folder, images=True, scale=0.1)
+    assert count == len(timeline["states"])
+    assert len(os.listdir(folder)) == count
+
+
+def test_render_video(session, tmp_path):
+    pytest.importorskip("PIL")
+    if shutil.which("ffmpeg") is None:
+        pytest.skip("ffmpeg not found")
+    settings, timeline, conid = session
+    output = str(tmp_path / "session.mp4")
+    count = sessionvideo.render(timeline, settings, output, scale=0.1, chunkSeconds=0.5)
+    times = timeline["times"]
+    assert count == int((times[-1] + 1.0 - times[0]) * round(1 / timeline["period"], 3))
+    assert os.path.getsize(output) > 0
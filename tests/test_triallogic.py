@@ -0,0 +1,152 @@
+# Trial rules of triallogic.py and the timing checks of timingcheck.py that
+# replay flip traces through them
+import glob
+import os
+
+import pytest
+from numpy import random
+
+import timingcheck
+from timingcheck import Results, checkTraces, checkWTime, loadSettings, syntheticTrace
+from triallogic import Rotation, wTime
+
+configs = sorted(glob.glob(os.path.join(timingcheck.defaultConfigs, "*.json")))
+
+
+# ------------- WRAP-AROUND ---------------
+
+
+def test_advance_wraps_past_360():
+    rotation = Rotation(358.0, 1.5)
+    angles = [rotation.advance() for i in range(4)]
+    assert angles == pytest.approx([359.5, 1.0, 2.5, 4.0])
+    assert rotation.accum == pytest.approx(6.0)
+
+
+def test_advance_stays_on_the_circle():
+    rotation = Rotation(0.0, 2.34375)
+    for i in range(2000):
+        assert 0.0 < rotation.advance() <= 360.0
+
+
+@pytest.mark.parametrize(
+    "pressAngle, ansAngle, degrees",
+    [
+        (359.0, 1.0, -2.0),  # reported after the press, across the wrap
+        (1.0, 359.0, 2.0),  # reported before the press, across the wrap
+        (10.0, 20.0, -10.0),
+        (20.0, 10.0, 10.0),
+        (0.0, 180.0, -180.0),  # half a turn is counted as a late report
+    ],
+)
+def test_wtime_across_the_wrap(pressAngle, ansAngle, degrees):
+    assert wTime(pressAngle, ansAngle, 2.56) == pytest.approx(degrees * 2.56 / 360)
+
+
+@pytest.mark.parametrize("path", configs)
+def test_wtime_check_passes(path):
+    results = Results()
+    checkWTime(results, loadSettings(path))
+    assert results.failed == 0
+
+
+# ------------- PRESS ANGLE ---------------
+
+
+def rotationAt(startAngle, frames, dotStep=2.0):
+    rotation = Rotation(startAngle, dotStep)
+    for i in range(frames):
+        rotation.advance()
+    return rotation
+
+
+def test_press_in_the_first_half_of_the_frame_takes_the_previous_frame():
+    rotation = rotationAt(100.0, 5)  # frames at 108 and 110
+    assert rotation.press(1.007, 1.0167, previousFlip=1.0) == 108.0
+
+
+def test_press_in_the_second_half_of_the_frame_takes_the_current_frame():
+    rotation = rotationAt(100.0, 5)
+    assert rotation.press(1.010, 1.0167, previousFlip=1.0) == 110.0
+
+
+def test_press_at_the_first_frame_takes_that_frame():
+    rotation = rotationAt(100.0, 1)
+    rotation.restart()
+    rotation.advance()
+    # the engine forgets the last flip when the rotation restarts after a miss
+    assert rotation.press(0.95, 1.0, previousFlip=None) == 104.0
+
+
+def test_press_angle_is_truncated_to_the_saved_precision():
+    rotation = rotationAt(0.0, 3, dotStep=2.34375)
+    assert rotation.press(1.015, 1.0167, previousFlip=1.0) == 7.0
+
+
+def test_press_angle_chooses_across_the_wrap():
+    rotation = rotationAt(357.0, 2)  # frames at 359 and 1
+    assert rotation.press(1.002, 1.0167, previousFlip=1.0) == 359.0
+    rotation = rotationAt(357.0, 2)
+    assert rotation.press(1.015, 1.0167, previousFlip=1.0) == 1.0
+
+
+# ------------- DROPPED FRAMES ---------------
+
+
+# The frame before a drop stays on screen for two refreshes: the nearest
+# frame is chosen on the flip times, not on the nominal frame duration
+@pytest.mark.parametrize("offset, angle", [(0.015, 108.0), (0.018, 110.0)])
+def test_press_during_a_dropped_frame(offset, angle):
+    rotation = rotationAt(100.0, 5)
+    assert rotation.press(1.0 + offset, 1.0333, previousFlip=1.0) == angle
+
+
+def test_dot_moves_one_step_per_flip_whatever_the_interval():
+    rotation = rotationAt(100.0, 5)
+    assert rotation.advance() == pytest.approx(112.0)
+    assert rotation.accum == pytest.approx(12.0)
+
+
+def test_lockout_and_dot_delay_count_flips():
+    rotation = Rotation(0.0, 2.0, lockoutAngle=5.0, dotDelay=2)
+    accepting = []
+    for i in range(4):
+        rotation.advance()
+        accepting.append(rotation.accepting())
+    assert accepting == [False, False, True, True]
+    rotation.press(1.0, 1.0)
+    assert [rotation.finished() for i in range(3)] == [False, False, True]
+
+
+@pytest.mark.parametrize("path", configs)
+@pytest.mark.parametrize("rate", [60.0, 144.0])
+@pytest.mark.parametrize("dropRate", [0.0, 0.05])
+def test_synthetic_traces_pass(path, rate, dropRate):
+    settings = loadSettings(path)
+    rng = random.default_rng(7)
+    traces = [syntheticTrace(rng, settings, rate, dropRate=dropRate) for i in range(100)]
+    results = Results()
+    checkTraces(results, "synthetic", traces, settings)
+    assert results.failed == 0
+
+
+def test_synthetic_traces_have_drops():
+    settings = loadSettings(configs[0])
+    trace = syntheticTrace(random.default_rng(7), settings, 60.0, dropRate=0.05)
+    intervals = trace["flips"][1:] - trace["flips"][:-1]
+    assert (intervals > 1.5 / 60.0).sum() > 0
+
+
+# The check has to catch a press rule that ignores the flip times
+def test_press_check_catches_the_flip_after_the_press(monkeypatch):
+    def pressAfter(self, pressTime, flipTime, previousFlip=None):
+        self.delayFrames = 1
+        return int(self.dotAngle * 10) / 10.0
+
+    monkeypatch.setattr(Rotation, "press", pressAfter)
+    settings = loadSettings(configs[0])
+    rng = random.default_rng(7)
+    traces = [syntheticTrace(rng, settings, 60.0, dropRate=0.05) for i in range(100)]
+    results = Results()
+    checkTraces(results, "synthetic", traces, settings)
+    assert results.failed == 1
@@ -0,0 +1,54 @@
+# -------------- TEXT CACHE ---------------
+# -----------------------------------------
+# Text layout is one of the most expensive things PsychoPy does: every
+# setText() or new TextStim lays the glyphs out again and the first draw
+# uploads them to a texture. The cache builds one TextStim per string at
+# startup and draws each once into the back buffer, so the trial loops only
+# ever draw stimuli that are already laid out and rasterized.
+from psychopy import visual
+
+
+class TextCache(object):
+    # win: the experiment window
+    # defaults: TextStim keyword arguments shared by every string (color, height, ...)
+    def __init__(self, win, **defaults):
+        self.win = win
+        self.defaults = defaults
+        self._stims = {}
+
+    # Cache a static string under key. Keyword arguments override the defaults.
+    def add(self, key, text, **kwargs):
+        options = dict(self.defaults)
+        options.update(kwargs)
+        self._stims[key] = visual.TextStim(self.win, text=text, **options)
+        return self._stims[key]
+
+    # Cache every variant of a string that changes between screens but only
+    # takes a known set of values (e.g. the block counter on the break screen).
+    # Each variant is stored under (key,) + values.
+    def addFormatted(self, key, template, valueList, **kwargs):
+        for values in valueList:
+            values = tuple(values)
+            self.add((key,) + values, template.format(*values), **kwargs)
+
+    # Draw every cached string once so glyph textures exist before the first
+    # trial, then wipe the back buffer
+    def prepare(self):
+        for stim in self._stims.values():
+            stim.draw()
+        self.win.clearBuffer()
+
+    def __getitem__(self, key):
+        return self._stims[key]
+
+    def __contains__(self, key):
+        return key in self._stims
+
+    def keys(self):
+        return list(self._stims.keys())
+
+    def values(self):
+        return list(self._stims.values())
+
+    def draw(self, key):
+        self._stims[key].draw()
@@ -0,0 +1,470 @@
+# ------------ TIMING CHECKS --------------
+# ----------------------------------------
+# Timing-quality regression checks. Flip/press traces, synthetic ones for
+# every paradigm config and recorded ones from session event logs, are
+# replayed through the trial logic the engine runs on (triallogic.py) and
+# checked against invariants:
+#
+#   angle vs time   the dot's angle at every flip stays within a tolerance
+#                   (default one frame) of where a perfectly timed dot would be,
+#                   between dropped frames: the dot moves a fixed step per
+#                   flip, so a drop delays it by a frame (that drift is what
+#                   the drop rate measures)
+#   press angle     pressAngle is within half a frame (plus the flip timestamp
+#                   noise) of the dot's position at the press time; for a press
+#                   during a dropped frame, it is the frame flipped nearest to it
+#   W-time          correct on both sides of the 360/0 wrap
+#   logic           replaying a recorded trace gives the recorded angles
+#
+# and against stored baselines: the drop rate and CPU time per frame of the
+# recorded sessions and the replay cost of the trial logic may not exceed
+# them by more than the tolerance. Exits with 1 when anything fails, so it
+# can run after every change of stimuli, PsychoPy version or driver:
+#
+#     python timingcheck.py                          # synthetic traces only
+#     python timingcheck.py data/libetrandom_12_events.bin --baseline timing_baseline.json
+#     python timingcheck.py data/*_events.bin --baseline timing_baseline.json --save-baseline
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from math import ceil, sqrt
+
+from numpy import abs as npabs
+from numpy import array, cumsum, diff, median, random
+
+from adaptive import circularDifference
+from eventlog import eventTypes, keyCodes, readEventLogs
+from triallogic import Rotation, degScale, msScale, wTime
+
+defaultConfigs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
+
+# Paradigm settings the trial logic needs, with the engine's defaults
+settingDefaults = {
+    "paradigm": None,
+    "libetTime": 2.56,
+    "lockoutAngle": 0,
+    "missAfterAngle": None,
+    "dotDelay": [0, 0],
+    "conditionTypes": {},
+}
+
+
+def loadSettings(path):
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    settings = dict(settingDefaults)
+    settings.update((key, config[key]) for key in settingDefaults if key in config)
+    return settings
+
+
+# ------------- TRACES ---------------
+
+
+# A synthetic trial: flips at frameRate with timestamp jitter (s, standard
+# deviation) and a fraction dropRate of dropped frames, and a press at a random time after
+# the lockout (and before the miss, if there is one). The dot moves a frame per flip,
+# so the lockout and the miss are counted in flips, drops included.
+def syntheticTrace(rng, settings, frameRate=60.0, dropRate=0.0, jitter=0.0002):
+    libetTime = settings["libetTime"]
+    frameDuration = 1.0 / frameRate
+    dotStep = 360.0 / libetTime * frameDuration
+    firstAccepting = int(settings["lockoutAngle"] / dotStep) + 1
+    lastBeforeMiss = int(ceil((settings["missAfterAngle"] or 360.0) / dotStep)) - 2
+    dotDelay = int(rng.integers(settings["dotDelay"][0], settings["dotDelay"][1] + 1))
+    nFrames = 2 * (lastBeforeMiss + dotDelay + 4)
+    # flips stay locked to the refresh, a drop delays every later flip by a frame;
+    # the jitter is timestamp noise and does not accumulate
+    refreshes = cumsum(1 + (rng.random(nFrames) < dropRate))
+    flips = 100.0 + refreshes * frameDuration + rng.normal(0, jitter, nFrames)
+    earliest = flips[firstAccepting - 1] + frameDuration / 2
+    latest = max(earliest, flips[lastBeforeMiss])
+    return {
+        "startAngle": rng.uniform(0, 360),
+        "dotStep": dotStep,
+        "dotDelay": dotDelay,
+        "flips": flips,
+        "pressTime": rng.uniform(earliest, latest),
+        "recordedAngles": None,
+    }
+
+
+# Trials of a recorded session, from its event log (all rotated segments).
+# dotDelays: {(block number, trial number): dotDelay} from the session plan, a
+# trial not in it is replayed without checking where its rotation ended
+def recordedTraces(eventLogPath, dotDelays=None):
+    records = readEventLogs(eventLogPath)
+    types, codes, values, times = records["type"], records["code"], records["value"], records["time"]
+    traces = []
+    cpu = []
+    block = -1
+    trace = None
+    for index in range(len(records)):
+        eventType = types[index]
+        if eventType == eventTypes["block"]:
+            block += 1
+        elif eventType == eventTypes["trial"]:
+            trace = {
+                "block": block,
+                "no": int(codes[index]),
+                "startAngle": float(values[index]),
+                "trialStart": float(times[index]),
+                "flips": [],
+                "recordedAngles": [],
+                "missedAt": [],
+                "pressTime": None,
+            }
+            traces.append(trace)
+        elif trace is None:
+            continue
+        elif eventType == eventTypes["flip"]:
+            trace["flips"].append(float(times[index]))
+            trace["recordedAngles"].append(float(values[index]))
+        elif eventType == eventTypes["missed"]:
+            trace["missedAt"].append(len(trace["flips"]))
+        elif eventType == eventTypes["key"] and codes[index] == keyCodes["press"]:
+            trace["pressTime"] = trace["trialStart"] + float(values[index])
+        elif eventType == eventTypes["cpu"]:
+            cpu.append(float(values[index]))
+    complete = []
+    for trace in traces:
+        if len(trace["flips"]) < 3 or trace["pressTime"] is None:
+            continue  # quit during the trial
+        trace["flips"] = array(trace["flips"])
+        trace["recordedAngles"] = array(trace["recordedAngles"])
+        # degrees per frame, from the recorded angles
+        steps = diff(trace["recordedAngles"]) % 360
+        trace["dotStep"] = float(median(steps))
+        trace["dotDelay"] = (dotDelays or {}).get((trace["block"], trace["no"]))
+        complete.append(trace)
+    return complete, cpu
+
+
+# {(block number, trial number): dotDelay} of a session plan, block numbers
+# counting the blocks in the order their "block" events appear in the log
+def planDotDelays(planPath, eventLogPath, settings):
+    with open(planPath) as f:
+        plan = json.load(f)
+    blocks = plan["training"] + [block for block in plan["main"] if block["condition"] != "-"]
+    records = readEventLogs(eventLogPath)
+    logged = records["code"][records["type"] == eventTypes["block"]]
+    trialstarts = dict(
+        (conid, conditionType["trialstart"])
+        for conid, conditionType in settings["conditionTypes"].items()
+    )
+    dotDelays = {}
+    planIndex = 0
+    # blocks skipped by the adaptive stopping rule have no "block" event
+    for blockNo, code in enumerate(logged):
+        while planIndex < len(blocks) and trialstarts.get(blocks[planIndex]["conid"]) != code:
+            planIndex += 1
+        if planIndex == len(blocks):
+            break
+        for trial in blocks[planIndex]["trials"]:
+            dotDelays[(blockNo, trial["no"])] = trial["dotDelay"]
+        planIndex += 1
+    return dotDelays
+
+
+# ------------- REPLAY ---------------
+
+
+# Run a trace through the trial logic the way the engine's rotation loop does.
+# Returns the angles shown at the flips, the segments between "missed"
+# restarts (first flip index of each), the press angle, the number of flips the
+# rotation lasted and the time the logic took
+def replayTrial(trace, settings):
+    rotation = Rotation(
+        trace["startAngle"],
+        trace["dotStep"],
+        lockoutAngle=settings["lockoutAngle"],
+        missAfterAngle=settings["missAfterAngle"],
+        dotDelay=trace["dotDelay"] or 0,
+    )
+    flips = trace["flips"]
+    pressTime = trace["pressTime"]
+    angles = []
+    segments = [0]
+    pressAngle = pressFrame = None
+    lastFlip = previousFlip = None
+    finished = False
+    start = time.perf_counter()
+    for flipTime in flips:
+        if rotation.missed():
+            rotation.restart()
+            segments.append(len(angles))
+            lastFlip = None
+        angles.append(rotation.advance())
+        previousFlip, lastFlip = lastFlip, flipTime
+        if not rotation.accepting():
+            continue
+        # the engine polls the keyboard right after each flip
+        if pressAngle is None and pressTime <= flipTime:
+            pressAngle = rotation.press(pressTime, flipTime, previousFlip)
+            pressFrame = len(angles) - 1
+        if rotation.finished():
+            finished = True
+            break
+    return {
+        "angles": array(angles),
+        "segments": segments,
+        "pressAngle": pressAngle,
+        "pressFrame": pressFrame,
+        "frames": len(angles),
+        "finished": finished,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+# ------------- CHECKS ---------------
+
+
+class Results(object):
+    def __init__(self):
+        self.failed = 0
+        self.metrics = {}
+
+    def check(self, name, ok, detail):
+        print("{} {:<34} {}".format("PASS" if ok else "FAIL", name, detail))
+        if not ok:
+            self.failed += 1
+
+
+# Error (frames) of a replayed press angle. The reference is the dot's position
+# at the press time, moving on from the flip before it at the nominal speed;
+# when that flip stayed on screen for a dropped frame or more, it is the angle of
+# the flip nearest in time to the press. noise: flip timestamp noise (frames)
+def pressAngleError(replay, flips, pressTime, frameDuration, dotStep, noise):
+    after = replay["pressFrame"]  # the press was detected after this flip
+    before = after - 1
+    if before < replay["segments"][-1]:
+        # detected at the first flip of a rotation, only that frame was shown
+        before = None
+    if before is not None and flips[after] - flips[before] > 1.5 * frameDuration:
+        nearer = after if flips[after] - pressTime < pressTime - flips[before] else before
+        reference = replay["angles"][nearer]
+        # a press around the middle of the interval may go either way
+        middle = (flips[before] + flips[after]) / 2
+        if abs(pressTime - middle) / frameDuration < 4 * noise:
+            reference = replay["pressAngle"]
+    else:
+        anchor = after if before is None else before
+        reference = replay["angles"][anchor] + (pressTime - flips[anchor]) / frameDuration * dotStep
+    error = abs(circularDifference(replay["pressAngle"], reference))
+    error = max(0.0, error - 1.0 / degScale) / dotStep  # allow the saved precision
+    # The nearest frame is picked on flip timestamps and the position is anchored
+    # on one, allow a few standard deviations of their noise
+    return max(0.0, error - 4 * noise)
+
+
+# Check replayed trials against the invariants
+def checkTraces(results, label, traces, settings, maxAngleErrorFrames=1.0):
+    libetTime = settings["libetTime"]
+    worstAngle = worstPress = 0.0  # in frames
+    badAngle = badPress = mismatched = unfinished = 0
+    for trace in traces:
+        replay = replayTrial(trace, settings)
+        dotStep = trace["dotStep"]
+        frameDuration = dotStep * libetTime / 360
+        flips = trace["flips"][: replay["frames"]]
+        angles = replay["angles"]
+        intervals = diff(flips)
+        dropped = intervals > 1.5 * frameDuration
+        # timestamp noise (frames), from the intervals without drops, each one the
+        # difference of two stamps
+        steady = intervals[~dropped]
+        noise = float(steady.std()) / sqrt(2) / frameDuration if len(steady) > 1 else 0.0
+
+        # Angle vs time, per stretch without restarts and drops: a perfectly timed dot
+        # moves dotStep per frame duration
+        trialWorst = 0.0
+        starts = set(replay["segments"]) | set((dropped.nonzero()[0] + 1).tolist())
+        bounds = sorted(starts) + [len(angles)]
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if last <= first:
+                continue
+            ideal = angles[first] + (flips[first:last] - flips[first]) / frameDuration * dotStep
+            errors = npabs(circularDifference(angles[first:last], ideal)) / dotStep
+            trialWorst = max(trialWorst, float(errors.max()))
+        worstAngle = max(worstAngle, trialWorst)
+        badAngle += trialWorst > maxAngleErrorFrames
+
+        if replay["pressAngle"] is not None:
+            pressError = pressAngleError(
+                replay, flips, trace["pressTime"], frameDuration, dotStep, noise
+            )
+            worstPress = max(worstPress, pressError)
+            badPress += pressError > 0.5
+
+        if trace["recordedAngles"] is not None:
+            recorded = trace["recordedAngles"]
+            if len(replay["segments"]) - 1 != len(trace["missedAt"]):
+                mismatched += 1
+            elif len(recorded) != len(angles) and trace["dotDelay"] is not None:
+                mismatched += 1
+            else:
+                n = min(len(recorded), len(angles))
+                if n and float(npabs(circularDifference(recorded[:n], angles[:n])).max()) > 1e-6:
+                    mismatched += 1
+        elif not replay["finished"]:
+            unfinished += 1
+
+    n = len(traces)
+    results.check(
+        label + " angle vs time",
+        badAngle == 0,
+        "{}/{} trials over {:.1f} frames, worst {:.2f} frames".format(
+            badAngle, n, maxAngleErrorFrames, worstAngle
+        ),
+    )
+    results.check(
+        label + " press angle",
+        badPress == 0,
+        "{}/{} trials over half a frame, worst {:.2f} frames".format(badPress, n, worstPress),
+    )
+    if any(trace["recordedAngles"] is not None for trace in traces):
+        results.check(
+            label + " replay matches recording",
+            mismatched == 0,
+            "{}/{} trials differ".format(mismatched, n),
+        )
+    else:
+        results.check(
+            label + " rotation ends",
+            unfinished == 0,
+            "{}/{} trials never finished".format(unfinished, n),
+        )
+
+
+# CPU cost of the trial logic per frame (s), best of several replays of the traces
+def replayCost(traces, settings, repeats=5):
+    best = None
+    for repeat in range(repeats):
+        seconds = frames = 0
+        for trace in traces:
+            replay = replayTrial(trace, settings)
+            seconds += replay["seconds"]
+            frames += replay["frames"]
+        perFrame = seconds / max(1, frames)
+        best = perFrame if best is None else min(best, perFrame)
+    return best
+
+
+def checkWTime(results, settings):
+    libetTime = settings["libetTime"]
+    worst = 0.0
+    for pressTenths in range(0, 3600, 7):
+        pressAngle = pressTenths / 10.0
+        for errorTenths in range(-1795, 1800, 5):
+            ansAngle = (pressAngle + errorTenths / 10.0) % 360
+            expected = -errorTenths / 10.0 * libetTime / 360
+            worst = max(worst, abs(wTime(pressAngle, ansAngle, libetTime) - expected))
+    results.check(
+        "{} W-time across the wrap".format(settings["paradigm"]),
+        worst < 1e-9,
+        "worst error {:.3g} ms".format(worst * msScale),
+    )
+
+
+# Compare metrics with a stored baseline: a metric may exceed it by tolerance (relative)
+def checkBaseline(results, baseline, tolerance):
+    for name, value in sorted(results.metrics.items()):
+        if name not in baseline:
+            results.check("baseline " + name, True, "{:.4g} (no baseline)".format(value))
+            continue
+        limit = baseline[name] * (1 + tolerance)
+        results.check(
+            "baseline " + name,
+            value <= limit or value <= baseline[name] + 1e-9,
+            "{:.4g} (baseline {:.4g}, limit {:.4g})".format(value, baseline[name], limit),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Timing-quality regression checks")
+    parser.add_argument("eventLogs", nargs="*", help="session event logs (first segment)")
+    parser.add_argument("--configs", default=defaultConfigs)
+    parser.add_argument("--trials", type=int, default=200, help="synthetic trials per paradigm and rate")
+    parser.add_argument("--rates", default="60,120,144", help="synthetic refresh rates (Hz)")
+    parser.add_argument(
+        "--drop-rate", type=float, default=0.02, help="dropped frames in the synthetic traces"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-angle-error", type=float, default=1.0, help="frames")
+    parser.add_argument("--baseline", help="JSON file of baseline metrics")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative increase")
+    args = parser.parse_args()
+
+    results = Results()
+    paradigms = [loadSettings(path) for path in sorted(glob.glob(os.path.join(args.configs, "*.json")))]
+
+    # Synthetic traces through the logic of every paradigm
+    rng = random.default_rng(args.seed)
+    costs = []
+    for settings in paradigms:
+        checkWTime(results, settings)
+        for rate in [float(rate) for rate in args.rates.split(",")]:
+            traces = [
+                syntheticTrace(rng, settings, frameRate=rate, dropRate=args.drop_rate)
+                for i in range(args.trials)
+            ]
+            checkTraces(
+                results,
+                "{} {:.0f} Hz".format(settings["paradigm"], rate),
+                traces,
+                settings,
+                args.max_angle_error,
+            )
+            costs.append(replayCost(traces, settings))
+    if costs:
+        results.metrics["replayUsPerFrame"] = max(costs) * 1e6
+
+    # Recorded sessions
+    drops = intervals = 0
+    cpu = []
+    for eventLogPath in args.eventLogs:
+        prefix = eventLogPath[: -len("_events.bin")] if eventLogPath.endswith("_events.bin") else None
+        planPath = prefix + "_plan.json" if prefix else None
+        settings = None
+        if planPath and os.path.exists(planPath):
+            with open(planPath) as f:
+                paradigm = json.load(f)["paradigm"]
+            settings = next((s for s in paradigms if s["paradigm"] == paradigm), None)
+        if settings is None:
+            print("SKIP {}: no plan or no config for its paradigm".format(eventLogPath))
+            continue
+        traces, sessionCpu = recordedTraces(
+            eventLogPath, planDotDelays(planPath, eventLogPath, settings)
+        )
+        cpu.extend(sessionCpu)
+        checkTraces(results, os.path.basename(prefix), traces, settings, args.max_angle_error)
+        for trace in traces:
+            frameDuration = trace["dotStep"] * settings["libetTime"] / 360
+            flipIntervals = diff(trace["flips"])
+            drops += int((flipIntervals > 1.5 * frameDuration).sum())
+            intervals += len(flipIntervals)
+    if intervals:
+        results.metrics["dropRate"] = drops / float(intervals)
+    if cpu:
+        results.metrics["cpuPerFrameMs"] = sum(cpu) / len(cpu) * msScale
+
+    if args.baseline:
+        if args.save_baseline:
+            with open(args.baseline, "w") as f:
+                json.dump(results.metrics, f, indent=1, sort_keys=True)
+            print("Baseline saved to {}".format(args.baseline))
+        elif os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                checkBaseline(results, json.load(f), args.tolerance)
+        else:
+            print("No baseline at {}, run with --save-baseline first".format(args.baseline))
+
+    print("{} checks failed".format(results.failed) if results.failed else "All checks passed")
+    sys.exit(1 if results.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
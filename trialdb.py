@@ -0,0 +1,289 @@
+# ------------- TRIAL DATABASE --------------
+# ------------------------------------------
+# Loads the per-subject, per-block CSV files of every session into one
+# local SQLite database so group analyses are a query instead of a loop
+# over files. Ingest is incremental: each file's SHA-256 is stored and
+# files that are already in the database are skipped; a file whose content
+# changed replaces its old rows. A file with the content of one already in
+# the database (a copy under another path) adds no rows: its path is
+# recorded as another path of that file and reported.
+#
+#     python trialdb.py ingest data [more folders...] [--db trials.sqlite]
+#     python trialdb.py means wTime --max-drop-rate 0.01
+#     python trialdb.py query "SELECT condition, COUNT(*) FROM trials GROUP BY condition"
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+defaultDatabase = "trials.sqlite"
+defaultConfigs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
+
+# <filePrefix><subjectID>_<condition><repetition>.csv, as written by engine.py
+fileNamePattern = re.compile(r"^(?P<prefix>.+?_)(?P<subject>\d+)_(?P<block>.+?)\.csv$")
+
+# CSV columns stored in the trials table (all numeric), missing ones are NULL
+numericColumns = [
+    "no",
+    "dotDelay",
+    "holdTime",
+    "pressOnset",
+    "pressAngle",
+    "ansAngle",
+    "wTime",
+    "ansTime",
+    "ISI",
+    "rtGuard",
+    "gcTime",
+    "frameDrops",
+    "frames",
+]
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL UNIQUE,
+    paradigm TEXT,
+    subject TEXT,
+    block TEXT,
+    rows INTEGER,
+    ingested REAL
+);
+CREATE TABLE IF NOT EXISTS file_paths (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    path TEXT NOT NULL UNIQUE,
+    seen REAL
+);
+CREATE TABLE IF NOT EXISTS trials (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    paradigm TEXT,
+    subject TEXT NOT NULL,
+    condition TEXT NOT NULL,
+    block TEXT NOT NULL,
+    repetition INTEGER,
+    trial INTEGER,
+    {columns},
+    reportErrorDeg REAL,
+    reportErrorMs REAL
+);
+CREATE INDEX IF NOT EXISTS trials_subject ON trials (paradigm, subject);
+CREATE INDEX IF NOT EXISTS trials_condition ON trials (condition);
+CREATE INDEX IF NOT EXISTS trials_block ON trials (block);
+CREATE INDEX IF NOT EXISTS trials_trial ON trials (trial);
+CREATE INDEX IF NOT EXISTS trials_subject_condition ON trials (subject, condition);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+""".format(
+    columns=",\n    ".join('"{}" REAL'.format(column) for column in numericColumns)
+)
+
+
+def connect(path=defaultDatabase):
+    db = sqlite3.connect(path)
+    db.executescript(schema)
+    return db
+
+
+# filePrefix -> (paradigm, libetTime) from the experiment configs
+def loadParadigms(configFolder=defaultConfigs):
+    paradigms = {}
+    for path in glob.glob(os.path.join(configFolder, "*.json")):
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        if "filePrefix" in config:
+            paradigms[config["filePrefix"]] = (
+                config.get("paradigm"),
+                config.get("libetTime", 2.56),
+            )
+    return paradigms
+
+
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _number(value):
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+# Forget what was ingested from a path whose content changed: another path of a
+# file is dropped; a file is dropped with its trials, unless its content is
+# still at another path, which becomes the file's path
+def _forgetPath(db, path):
+    db.execute("DELETE FROM file_paths WHERE path = ?", (path,))
+    for (oldId,) in db.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchall():
+        other = db.execute(
+            "SELECT path FROM file_paths WHERE file_id = ? ORDER BY seen LIMIT 1", (oldId,)
+        ).fetchone()
+        if other:
+            db.execute("UPDATE files SET path = ? WHERE id = ?", (other[0], oldId))
+            db.execute("DELETE FROM file_paths WHERE path = ?", (other[0],))
+        else:
+            db.execute("DELETE FROM trials WHERE file_id = ?", (oldId,))
+            db.execute("DELETE FROM files WHERE id = ?", (oldId,))
+
+
+# Add one CSV file. Returns (rows added, path of the file it duplicates): rows is 0 if
+# it was already there; the path is set the first time a file turns up with the
+# content of another one, then recorded as another path of that file.
+def ingestFile(db, path, paradigms):
+    match = fileNamePattern.match(os.path.basename(path))
+    if match is None:
+        return 0, None
+    absPath = os.path.abspath(path)
+    digest = fileHash(path)
+    known = db.execute("SELECT id, path FROM files WHERE sha256 = ?", (digest,)).fetchone()
+    if known:
+        fileId, knownPath = known
+        alias = db.execute("SELECT file_id FROM file_paths WHERE path = ?", (absPath,)).fetchone()
+        if knownPath == absPath or (alias and alias[0] == fileId):
+            return 0, None
+        with db:
+            _forgetPath(db, absPath)
+            db.execute("INSERT INTO file_paths VALUES (?, ?, ?)", (fileId, absPath, time.time()))
+        return 0, knownPath
+    paradigm, libetTime = paradigms.get(match.group("prefix"), (match.group("prefix").rstrip("_"), None))
+    block = match.group("block")
+    condition = block.rstrip("0123456789")
+    repetition = int(block[len(condition) :]) if block != condition else None
+
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    records = []
+    for row in rows:
+        values = [_number(row.get(column)) for column in numericColumns]
+        pressAngle, ansAngle = _number(row.get("pressAngle")), _number(row.get("ansAngle"))
+        errorDeg = errorMs = None
+        if pressAngle is not None and ansAngle is not None:
+            errorDeg = (ansAngle - pressAngle + 180) % 360 - 180
+            if libetTime:
+                errorMs = errorDeg * libetTime / 360 * 1000
+        trialNo = _number(row.get("no"))
+        records.append(
+            [
+                paradigm,
+                row.get("id") or match.group("subject"),
+                condition,
+                block,
+                repetition,
+                None if trialNo is None else int(trialNo),
+            ]
+            + values
+            + [errorDeg, errorMs]
+        )
+
+    with db:
+        # A changed file replaces what was ingested from the same path before
+        _forgetPath(db, absPath)
+        fileId = db.execute(
+            "INSERT INTO files (path, sha256, paradigm, subject, block, rows, ingested) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                absPath,
+                digest,
+                paradigm,
+                match.group("subject"),
+                block,
+                len(records),
+                time.time(),
+            ),
+        ).lastrowid
+        db.executemany(
+            "INSERT INTO trials VALUES ({})".format(", ".join(["?"] * (len(numericColumns) + 9))),
+            [[fileId] + record for record in records],
+        )
+    return len(records), None
+
+
+# Ingest every CSV in the given folders (not recursive).
+# Returns (files added, files skipped, rows added, [(path, path of the file with its
+# content)] for the files found to duplicate another one)
+def ingest(db, folders, configFolder=defaultConfigs):
+    paradigms = loadParadigms(configFolder)
+    added = skipped = rows = 0
+    duplicates = []
+    for folder in folders:
+        for path in sorted(glob.glob(os.path.join(folder, "*.csv"))):
+            n, duplicateOf = ingestFile(db, path, paradigms)
+            if n:
+                added += 1
+                rows += n
+            else:
+                skipped += 1
+            if duplicateOf is not None:
+                duplicates.append((path, duplicateOf))
+    return added, skipped, rows, duplicates
+
+
+# Mean of a column per paradigm and condition, only over subjects whose
+# dropped-frame rate is below maxDropRate (subjects without frame counts are
+# kept unless requireFrameCounts is set)
+def conditionMeans(db, column="wTime", maxDropRate=None, requireFrameCounts=False):
+    if column not in numericColumns + ["reportErrorDeg", "reportErrorMs"]:
+        raise ValueError("unknown column {}".format(column))
+    where = ""
+    params = []
+    if maxDropRate is not None:
+        having = "SUM(frames) > 0 AND SUM(frameDrops) * 1.0 / SUM(frames) < ?"
+        if not requireFrameCounts:
+            having = "SUM(frames) IS NULL OR ({})".format(having)
+        where = (
+            "WHERE paradigm || ':' || subject IN (SELECT paradigm || ':' || subject FROM trials "
+            "GROUP BY paradigm, subject HAVING {})".format(having)
+        )
+        params.append(maxDropRate)
+    sql = (
+        'SELECT paradigm, condition, COUNT(DISTINCT subject), COUNT("{0}"), AVG("{0}") '
+        "FROM trials {1} GROUP BY paradigm, condition ORDER BY paradigm, condition".format(column, where)
+    )
+    return db.execute(sql, params).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-subject trial database")
+    parser.add_argument("--db", default=defaultDatabase, help="SQLite file")
+    commands = parser.add_subparsers(dest="command")
+    ingestParser = commands.add_parser("ingest", help="add new CSV files")
+    ingestParser.add_argument("folders", nargs="+")
+    ingestParser.add_argument("--configs", default=defaultConfigs)
+    meansParser = commands.add_parser("means", help="mean of a column per condition")
+    meansParser.add_argument("column", nargs="?", default="wTime")
+    meansParser.add_argument("--max-drop-rate", type=float, default=None)
+    queryParser = commands.add_parser("query", help="run a SQL query")
+    queryParser.add_argument("sql")
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    if args.command == "ingest":
+        added, skipped, rows, duplicates = ingest(db, args.folders, args.configs)
+        for path, duplicateOf in duplicates:
+            print("{}: same content as {}, recorded as another path of it".format(path, duplicateOf))
+        print("{} files added ({} trials), {} already ingested or not a data file".format(added, rows, skipped))
+    elif args.command == "means":
+        print("paradigm\tcondition\tsubjects\ttrials\tmean " + args.column)
+        for row in conditionMeans(db, args.column, args.max_drop_rate):
+            print("\t".join(str(value) for value in row))
+    elif args.command == "query":
+        for row in db.execute(args.sql):
+            print("\t".join(str(value) for value in row))
+    else:
+        parser.print_help()
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# -------------- TRIAL LOGIC ---------------
+# -----------------------------------------
+# The rules of a trial that do not depend on PsychoPy: how the dot moves
+# from frame to frame, when presses count, when a trial is missed, which
+# angle a press is recorded at and how the W-time is computed. The engine's
+# rotation loop runs on these, and timingcheck.py replays recorded or
+# synthetic flip traces through the very same code.
+from adaptive import circularDifference
+
+# Approximations
+msScale = 1000
+degScale = 10
+
+
+class Rotation(object):
+    # startAngle: angle of the dot when the rotation starts (degrees)
+    # dotStep: degrees per frame
+    # lockoutAngle: presses are ignored until the dot has rotated this far
+    # missAfterAngle: the trial is missed when it rotated this far without a
+    #   press (None = never)
+    # dotDelay: frames the dot keeps rotating after the press
+    def __init__(self, startAngle, dotStep, lockoutAngle=0, missAfterAngle=None, dotDelay=0):
+        self.dotStep = dotStep
+        self.lockoutAngle = lockoutAngle
+        self.missAfterAngle = missAfterAngle
+        self.dotDelay = dotDelay
+        self.dotAngle = startAngle
+        self.previousAngle = None  # angle of the frame before, None right after a (re)start
+        self.accum = 0.0  # degrees rotated since the rotation (re)started
+        # When not 0, the press has occurred and this counts the frames since
+        self.delayFrames = 0
+
+    # True when the rotation went on too long without a press, call before advance()
+    def missed(self):
+        return self.missAfterAngle is not None and self.accum >= self.missAfterAngle
+
+    def restart(self):
+        self.accum = 0.0
+        self.previousAngle = None
+
+    # Move the dot one frame, returns the new angle
+    def advance(self):
+        self.previousAngle = self.dotAngle
+        self.dotAngle += self.dotStep
+        self.accum += self.dotStep
+        if self.dotAngle > 360:
+            self.dotAngle -= 360
+        return self.dotAngle
+
+    # Whether presses count yet
+    def accepting(self):
+        return self.accum > self.lockoutAngle
+
+    # Record a press detected after the flip at flipTime, returns the press angle:
+    # the angle of the frame that was on screen nearest to pressTime, the one
+    # flipped at previousFlip or the current one (all times on one clock)
+    def press(self, pressTime, flipTime, previousFlip=None):
+        angle = self.dotAngle
+        if (
+            previousFlip is not None
+            and self.previousAngle is not None
+            and pressTime - previousFlip < (flipTime - previousFlip) / 2
+        ):
+            angle = self.previousAngle
+        self.delayFrames = 1
+        return int(angle * degScale) / degScale
+
+    # Called every frame once presses count, True when the trial's rotation is over
+    def finished(self):
+        if not self.delayFrames:
+            return False
+        if self.delayFrames > self.dotDelay:
+            return True
+        self.delayFrames += 1
+        return False
+
+
+# W-time (seconds): press angle minus reported angle on the circle, in
+# [-libetTime / 2, libetTime / 2). Negative when the report lies after the press.
+def wTime(pressAngle, ansAngle, libetTime):
+    return circularDifference(pressAngle, ansAngle) * libetTime / 360
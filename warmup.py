@@ -0,0 +1,82 @@
+# --------------- GPU WARM-UP --------------
+# -----------------------------------------
+# Texture uploads, shader compilation and the driver's lazy initialisation
+# all happen the first time something is drawn, which used to be the first
+# rotation frames of the first trial. warmUp() draws every stimulus of the
+# session into the back buffer for a few frames (wiping it before each
+# flip, so the participant only sees the background) and then waits until
+# flip timing has settled before the first instruction screen.
+try:
+    from pyglet import gl
+except ImportError:
+    gl = None
+
+
+# Draw stimuli into the back buffer and throw the result away.
+# flip: also flip a blank frame so the driver actually executes the work;
+#   without flipping the GL pipeline is flushed with glFinish instead, which
+#   keeps whatever is currently on screen (e.g. between instruction and ISI)
+def drawOffscreen(win, stims, nFrames=1, flip=True):
+    for frameN in range(nFrames):
+        for stim in stims:
+            stim.draw()
+        win.clearBuffer()
+        if flip:
+            win.flip()
+        elif gl is not None:
+            gl.glFinish()
+
+
+# Flip blank frames until the last steadyFrames intervals are all within
+# tolerance (fraction of a frame) of the monitor frame period.
+# Returns (steady, intervals) where intervals are the last steadyFrames flips.
+def waitForSteadyFlips(win, steadyFrames=30, tolerance=0.2, maxFrames=300):
+    period = win.monitorFramePeriod
+    intervals = []
+    lastFlip = win.flip()
+    for frameN in range(maxFrames):
+        flipTime = win.flip()
+        intervals.append(flipTime - lastFlip)
+        lastFlip = flipTime
+        recent = intervals[-steadyFrames:]
+        if len(recent) == steadyFrames and max(
+            abs(interval - period) for interval in recent
+        ) <= tolerance * period:
+            return True, recent
+    return False, intervals[-steadyFrames:]
+
+
+# Close a movie's file and decoder: unload() on current PsychoPy, _unload() on
+# older versions of MovieStim3
+def unloadMovie(movie):
+    unload = getattr(movie, "unload", None) or getattr(movie, "_unload", None)
+    if unload is not None:
+        unload()
+
+
+# Warm-up pass, run once after all stimuli exist.
+# stims: every stimulus the session draws (dial buffer, dots, markers, text, images)
+# movies: MovieStim3 objects made for the warm-up, their first frames are
+#   decoded and uploaded, then they are unloaded (decoder threads and buffers
+#   freed): the instruction screens open their own
+def warmUp(win, stims, movies=(), nFrames=5, steadyFrames=30, tolerance=0.2, maxFrames=300):
+    for movie in movies:
+        movie.play()
+    drawOffscreen(win, list(stims) + list(movies), nFrames=nFrames)
+    for movie in movies:
+        movie.stop()
+        unloadMovie(movie)
+    steady, intervals = waitForSteadyFlips(win, steadyFrames, tolerance, maxFrames)
+    if intervals:
+        worst = max(intervals) * 1000
+        mean = sum(intervals) / len(intervals) * 1000
+    else:
+        worst = mean = 0.0
+    if steady:
+        print("Warm-up done: mean frame {:.2f} ms, worst {:.2f} ms".format(mean, worst))
+    else:
+        print(
+            "WARNING: flip timing not steady after warm-up "
+            "(mean frame {:.2f} ms, worst {:.2f} ms)".format(mean, worst)
+        )
+    return steady
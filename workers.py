@@ -0,0 +1,476 @@
+# ------------ WORKER PROCESSES ------------
+# -----------------------------------------
+# Optional layout that keeps only rendering and keyboard input in the main
+# process. CSV writing and the event log, StimTracker (pyxid2) triggers and
+# serial respiration acquisition each run in their own process, so a slow
+# disk or USB call can never hold the GIL while win.flip() is waiting.
+#
+# Processes talk through single-producer/single-consumer ring buffers in
+# shared memory. Pushing events never blocks: when a ring is full the event
+# is dropped and counted. CSV files and rows go through a ring of their own
+# with slots sized for them, and are never dropped: a message that does not
+# fit raises. Every worker writes a heartbeat that the main process checks
+# between trials. Workers are stopped (and their rings drained) at exit,
+# which includes psychopy's core.quit().
+#
+# The workers are spawned, so they import the script that started the
+# session again: its code has to be behind an if __name__ == "__main__":
+# guard, as in the experiment scripts.
+import atexit
+import csv
+import multiprocessing
+import pickle
+import struct
+import time
+import traceback
+
+from eventlog import eventTypes, openEventLogFile, recordFormat
+
+# Message tags (first byte of every ring payload)
+tagEvent = 1  # event log record, packed with eventlog.recordFormat
+tagTrigger = 2  # trigger request: bitmask, request time
+tagPickle = 3  # anything else (CSV files and rows)
+
+eventStruct = struct.Struct("<B" + recordFormat[1:])
+triggerStruct = struct.Struct("<BId")
+
+# Seconds without a heartbeat before a worker counts as stalled
+stallTimeout = 2.0
+# Slot size and capacity of the ring of CSV messages (a header or row pickled)
+dataSlotSize = 16384
+dataSlots = 256
+# Seconds a CSV message waits for room in a full ring before it raises
+dataTimeout = 2.0
+
+
+class RingBuffer(object):
+    # Single-producer/single-consumer ring of fixed-size slots in shared memory.
+    # nSlots: capacity in messages
+    # slotSize: largest payload in bytes (plus a 2 byte length prefix)
+    # ctx: multiprocessing context the shared arrays are created from
+    # notify: signal a semaphore when a push finds the ring empty, so the consumer
+    #   can sleep in wait() instead of polling. Only for rings whose consumer
+    #   actually waits on them.
+    # shareWith: signal the semaphore of that ring instead, for a consumer that
+    #   waits on one ring for several
+    def __init__(self, ctx, nSlots=4096, slotSize=512, notify=True, shareWith=None):
+        self.nSlots = nSlots
+        self.slotSize = slotSize
+        self._counters = ctx.RawArray("Q", 3)  # written, read, dropped
+        self._data = ctx.RawArray("B", nSlots * slotSize)
+        if shareWith is not None:
+            self._ready = shareWith._ready
+        else:
+            self._ready = ctx.Semaphore(0) if notify else None
+        self._view = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_view"] = None
+        return state
+
+    def _buffer(self):
+        if self._view is None:
+            self._view = memoryview(self._data).cast("B")
+        return self._view
+
+    # Add a message, returns False (and counts it as dropped) when the ring is full
+    # or the message too large
+    def push(self, payload):
+        written, read = self._counters[0], self._counters[1]
+        if written - read >= self.nSlots or len(payload) > self.slotSize - 2:
+            self._counters[2] += 1
+            return False
+        offset = (written % self.nSlots) * self.slotSize
+        view = self._buffer()
+        struct.pack_into("<H", view, offset, len(payload))
+        view[offset + 2 : offset + 2 + len(payload)] = payload
+        self._counters[0] = written + 1  # publish only once the slot is complete
+        # Wake the consumer once per batch: only when it had taken everything
+        # before this message. It checks the backlog before sleeping, a missed
+        # wake-up costs at most its wait timeout.
+        if self._ready is not None and self._counters[1] >= written:
+            self._ready.release()
+        return True
+
+    # Add a message that must not be lost: waits up to timeout seconds for
+    # room in a full ring, raises when the message can never fit or the ring
+    # stays full
+    def pushOrRaise(self, payload, timeout):
+        if len(payload) > self.slotSize - 2:
+            raise ValueError(
+                "message of {} bytes does not fit a ring slot ({} bytes)".format(
+                    len(payload), self.slotSize - 2
+                )
+            )
+        deadline = time.time() + timeout
+        while self._counters[0] - self._counters[1] >= self.nSlots:
+            if time.time() > deadline:
+                raise RuntimeError("ring still full after {} s".format(timeout))
+            time.sleep(0.001)
+        self.push(payload)
+
+    # Take every message that is waiting, oldest first
+    def popAll(self):
+        written, read = self._counters[0], self._counters[1]
+        messages = []
+        view = self._buffer()
+        while read < written:
+            offset = (read % self.nSlots) * self.slotSize
+            length = struct.unpack_from("<H", view, offset)[0]
+            messages.append(bytes(view[offset + 2 : offset + 2 + length]))
+            read += 1
+        self._counters[1] = read
+        return messages
+
+    # Block until something was pushed or timeout (seconds) has passed
+    def wait(self, timeout):
+        if self.backlog():
+            return True
+        if self._ready is None:
+            time.sleep(timeout)
+            return False
+        if not self._ready.acquire(True, timeout):
+            return False
+        # drop the wake-ups of pushes this one already covers
+        while self._ready.acquire(False):
+            pass
+        return True
+
+    def dropped(self):
+        return self._counters[2]
+
+    def backlog(self):
+        return self._counters[0] - self._counters[1]
+
+
+# ------------- WORKERS ---------------
+
+
+def _loggerWorker(rings, eventLogPath, rotations, closedFiles, heartbeats, index, stopEvent):
+    eventFile = openEventLogFile(eventLogPath)
+    csvFiles = {}
+    csvWriters = {}
+    try:
+        while True:
+            heartbeats[index] = time.time()
+            stopping = stopEvent.is_set()
+            rings[0].wait(0.05)
+            chunk = []
+            for ring in rings:
+                for payload in ring.popAll():
+                    tag = payload[0]
+                    if tag == tagEvent:
+                        chunk.append(payload[1:])
+                    elif tag == tagPickle:
+                        message = pickle.loads(payload[1:])
+                        if message[0] == "csvOpen":
+                            csvFiles[message[1]] = open(message[1], "w", newline="")
+                            csvWriters[message[1]] = csv.writer(
+                                csvFiles[message[1]], delimiter=","
+                            )
+                        elif message[0] == "csvRow":
+                            csvWriters[message[1]].writerow(message[2])
+                            csvFiles[message[1]].flush()
+                        elif message[0] == "csvClose":
+                            csvFiles.pop(message[1]).close()
+                            del csvWriters[message[1]]
+                            closedFiles.value += 1
+                        elif message[0] == "rotate":
+                            # events queued before the rotation go to the old file
+                            eventFile.write(b"".join(chunk))
+                            eventFile.close()
+                            eventFile = openEventLogFile(message[1])
+                            chunk = []
+                            rotations.value += 1
+            if chunk:
+                eventFile.write(b"".join(chunk))
+                eventFile.flush()
+            # Only stop once everything queued before the stop request is written
+            if stopping and not chunk and not any(ring.backlog() for ring in rings):
+                break
+    finally:
+        eventFile.close()
+        for f in csvFiles.values():
+            f.close()
+
+
+# stats: shared [triggers sent, latency of the last one (s)]
+def _triggerWorker(requests, events, stats, heartbeats, index, stopEvent, clock):
+    import pyxid2
+
+    devices = pyxid2.get_xid_devices()
+    dev = devices[0] if devices else None
+    if dev is not None:
+        dev.reset_base_timer()
+        dev.reset_rt_timer()
+    else:
+        print("No XID devices detected (trigger worker)")
+    while True:
+        heartbeats[index] = time.time()
+        stopping = stopEvent.is_set()
+        requests.wait(0.05)
+        for payload in requests.popAll():
+            tag, bitmask, requestTime = triggerStruct.unpack(payload)
+            sent = 0
+            if dev is not None:
+                dev.activate_line(bitmask=bitmask)
+                sent = 1
+            sentTime = clock()
+            if sent:
+                # latency first: the count tells the main process it is new
+                stats[1] = sentTime - requestTime
+                stats[0] += 1
+            events.push(
+                eventStruct.pack(tagEvent, requestTime, eventTypes["trigger"], bitmask, sent)
+            )
+            events.push(
+                eventStruct.pack(
+                    tagEvent,
+                    sentTime,
+                    eventTypes["triggerLatency"],
+                    bitmask,
+                    sentTime - requestTime,
+                )
+            )
+        if stopping and not requests.backlog():
+            break
+
+
+def _acquisitionWorker(samples, heartbeats, index, stopEvent, clock, port, baudrate):
+    import serial
+
+    conn = serial.Serial(port, baudrate, timeout=0.05)
+    try:
+        while not stopEvent.is_set():
+            heartbeats[index] = time.time()
+            line = conn.readline()
+            if not line:
+                continue
+            t = clock()
+            try:
+                value = float(line.strip())
+            except ValueError:
+                continue
+            samples.push(eventStruct.pack(tagEvent, t, eventTypes["respiration"], 0, value))
+    finally:
+        conn.close()
+
+
+def _run(target, args):
+    # Process entry point, report crashes on the console of the experiment
+    try:
+        target(*args)
+    except Exception:
+        traceback.print_exc()
+        raise
+
+
+# ------------- MAIN PROCESS SIDE ---------------
+
+
+class WorkerEventLog(object):
+    # Same interface as eventlog.EventLog, records go to the logger worker
+    def __init__(self, ring, dataRing, clock, path, rotations):
+        self._ring = ring
+        self._dataRing = dataRing
+        self.clock = clock
+        self.path = path
+        self._rotations = rotations
+
+    def log(self, eventType, code=0, value=0.0, t=None):
+        if t is None:
+            t = self.clock()
+        self._ring.push(
+            eventStruct.pack(tagEvent, t, eventTypes[eventType], int(code), float(value))
+        )
+
+    # Continue the log in a new file, see eventlog.EventLog.rotate
+    def rotate(self, path, timeout=5.0):
+        expected = self._rotations.value + 1
+        # after every event already queued: the logger takes the data ring last
+        self._dataRing.pushOrRaise(
+            bytes([tagPickle]) + pickle.dumps(("rotate", path), 2), dataTimeout
+        )
+        deadline = time.time() + timeout
+        while self._rotations.value < expected:
+            if time.time() > deadline:
+                raise RuntimeError("logger worker did not rotate to {}".format(path))
+            time.sleep(0.005)
+        oldPath, self.path = self.path, path
+        return oldPath
+
+    def close(self):
+        pass
+
+
+class SessionWorkers(object):
+    # eventLogPath: event log file, written by the logger worker
+    # clock: time base shared with the main process. Must be a module-level
+    #   function (it is pickled to the workers), e.g. core.getTime
+    # triggers: run the StimTracker in the trigger worker (the main process
+    #   must then not open the device itself)
+    # respirationPort: serial port of the respiration belt, None for no acquisition
+    def __init__(
+        self,
+        eventLogPath,
+        clock=time.perf_counter,
+        triggers=True,
+        respirationPort=None,
+        respirationBaud=9600,
+    ):
+        # spawn everywhere: forked children would inherit the OpenGL window
+        ctx = multiprocessing.get_context("spawn")
+        self.clock = clock
+        self._logRing = RingBuffer(ctx)
+        self._dataRing = RingBuffer(
+            ctx, nSlots=dataSlots, slotSize=dataSlotSize, shareWith=self._logRing
+        )
+        rotations = ctx.RawValue("i", 0)
+        self._closedFiles = ctx.RawValue("i", 0)
+        self.eventLog = WorkerEventLog(
+            self._logRing, self._dataRing, clock, eventLogPath, rotations
+        )
+        self._triggerRing = None
+        self._triggerStats = ctx.RawArray("d", 2)
+        self._droppedReported = 0
+        self.names = []
+        workers = []
+        rings = [self._logRing]
+        if triggers:
+            self._triggerRing = RingBuffer(ctx, slotSize=triggerStruct.size + 2)
+            triggerEvents = RingBuffer(ctx, slotSize=eventStruct.size + 2, notify=False)
+            rings.append(triggerEvents)
+            workers.append(
+                (
+                    "trigger",
+                    _triggerWorker,
+                    [self._triggerRing, triggerEvents, self._triggerStats],
+                    [clock],
+                )
+            )
+        if respirationPort is not None:
+            samples = RingBuffer(
+                ctx, nSlots=65536, slotSize=eventStruct.size + 2, notify=False
+            )
+            rings.append(samples)
+            workers.append(
+                (
+                    "acquisition",
+                    _acquisitionWorker,
+                    [samples],
+                    [clock, respirationPort, respirationBaud],
+                )
+            )
+        # CSV messages and rotations last, after the events queued before them
+        rings.append(self._dataRing)
+        workers.insert(
+            0, ("logger", _loggerWorker, [rings, eventLogPath, rotations, self._closedFiles], [])
+        )
+
+        self.heartbeats = ctx.RawArray("d", len(workers))
+        self._rings = rings + [ring for ring in [self._triggerRing] if ring is not None]
+        self.processes = []
+        self._stopEvents = []
+        for index, (name, target, first, last) in enumerate(workers):
+            stopEvent = ctx.Event()
+            args = tuple(first) + (self.heartbeats, index, stopEvent) + tuple(last)
+            self._stopEvents.append(stopEvent)
+            self.names.append(name)
+            self.heartbeats[index] = time.time()
+            self.processes.append(
+                ctx.Process(target=_run, args=(target, args), name=name, daemon=True)
+            )
+        self._start()
+        self._stopped = False
+        atexit.register(self.stop)
+
+    def _start(self):
+        for process in self.processes:
+            process.start()
+
+    # Ask the trigger worker to send a trigger, returns immediately
+    def trigger(self, bitmask):
+        if self._triggerRing is None:
+            return False
+        return self._triggerRing.push(triggerStruct.pack(tagTrigger, bitmask, self.clock()))
+
+    # (triggers sent by the trigger worker, latency from request to sent of the
+    # last one in seconds or None)
+    def triggerStats(self):
+        sent = int(self._triggerStats[0])
+        return sent, self._triggerStats[1] if sent else None
+
+    # Open a CSV file in the logger worker, returns a csv writerow-like function
+    def csvWriter(self, path):
+        self._push(("csvOpen", path))
+
+        def writerow(row):
+            self._push(("csvRow", path, list(row)))
+
+        return writerow
+
+    # Close a CSV file, returns once the logger has written and closed it (so it can
+    # be handed to the collector)
+    def csvClose(self, path, timeout=5.0):
+        expected = self._closedFiles.value + 1
+        self._push(("csvClose", path))
+        deadline = time.time() + timeout
+        while self._closedFiles.value < expected:
+            if time.time() > deadline:
+                raise RuntimeError("logger worker did not close {}".format(path))
+            time.sleep(0.005)
+
+    def _push(self, message):
+        self._dataRing.pushOrRaise(bytes([tagPickle]) + pickle.dumps(message, 2), dataTimeout)
+
+    # Health of every worker: alive, seconds since its last heartbeat, dropped messages
+    def health(self):
+        now = time.time()
+        report = {}
+        dropped = sum(ring.dropped() for ring in self._rings)
+        for index, name in enumerate(self.names):
+            report[name] = {
+                "alive": self.processes[index].is_alive(),
+                "silent": now - self.heartbeats[index],
+            }
+        report["dropped"] = dropped
+        return report
+
+    # Print a warning for dead or stalled workers and messages dropped since the
+    # last check. Cheap, call it between trials. Returns the problems (empty when
+    # healthy).
+    def checkHealth(self):
+        problems = []
+        report = self.health()
+        for name in self.names:
+            if not report[name]["alive"]:
+                problems.append("{} worker is not running".format(name))
+            elif report[name]["silent"] > stallTimeout:
+                problems.append(
+                    "{} worker silent for {:.1f} s".format(name, report[name]["silent"])
+                )
+        dropped = report["dropped"] - self._droppedReported
+        self._droppedReported = report["dropped"]
+        if dropped:
+            problems.append(
+                "{} worker messages dropped ({} in total)".format(dropped, report["dropped"])
+            )
+        for problem in problems:
+            print("WARNING: " + problem)
+        return problems
+
+    # Stop all workers after they have written what is queued
+    def stop(self, timeout=5.0):
+        if self._stopped:
+            return
+        self._stopped = True
+        deadline = time.time() + timeout
+        # Stop the producers first so the logger (index 0) still writes their last messages
+        for index in reversed(range(len(self.processes))):
+            process = self.processes[index]
+            self._stopEvents[index].set()
+            process.join(max(0.0, deadline - time.time()))
+            if process.is_alive():
+                print("WARNING: {} worker did not stop, terminating".format(process.name))
+                process.terminate()